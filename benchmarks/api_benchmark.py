@@ -0,0 +1,44 @@
+"""
+Measure the JSON API on a single thread, with token validation and a cached DQ lookup, so the result is the overhead of the API itself
+per core: Flask routing, RS256 signature and claims checks and JSON encoding. Delta and the database are left out.
+
+Run with: python benchmarks/api_benchmark.py [requests]
+"""
+import sys
+import time
+from unittest.mock import MagicMock, patch
+
+import common  # noqa: F401
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from api import create_app
+from delta import Person
+from utils.keycloak import KeycloakTokenValidator
+
+
+def main(count: int = 2000) -> None:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    validator = KeycloakTokenValidator('https://keycloak.test', 'test', 'telefonbog')
+    validator.jwks_client = MagicMock()
+    validator.jwks_client.get_signing_keys.return_value = [MagicMock(key_id='benchmark', key=key.public_key())]
+
+    token = jwt.encode({'iss': validator.issuer, 'exp': int(time.time()) + 3600, 'azp': 'telefonbog', 'preferred_username': 'benchmark'}, key, algorithm='RS256', headers={'kid': 'benchmark'})
+    headers = {'Authorization': f'Bearer {token}'}
+
+    client = create_app(MagicMock(), validator).test_client()
+
+    with patch('api.search', return_value=[Person(name='Medarbejder', dq_number='DQ000001')]):
+        for _ in range(100):  # warm up
+            client.get('/api/dq/DQ000001', headers=headers)
+
+        start = time.perf_counter()
+        for _ in range(count):
+            assert client.get('/api/dq/DQ000001', headers=headers).status_code == 200
+        seconds = time.perf_counter() - start
+
+    print(f'{count} requests: {count / seconds:8.0f} requests/s on one thread, {seconds / count * 1000:.2f} ms per request')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,37 @@
+import os
+import sys
+
+# Benchmarks import the app modules directly, the settings only need to be present
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC_DIR)
+
+for name in ['DELTA_URL', 'DELTA_CLIENT_ID', 'DELTA_CLIENT_SECRET', 'KEYCLOAK_URL', 'KEYCLOAK_REALM', 'KEYCLOAK_CLIENT', 'DB_USER', 'DB_PASS', 'DB_HOST', 'DB_DATABASE']:
+    os.environ.setdefault(name, 'None')
+os.environ.setdefault('DB_PORT', '5432')
+os.environ.setdefault('CPR_HASH_KEY', 'benchmark')
+
+
+def make_instance(i: int) -> dict:
+    """Synthetic engagement instance shaped like a Delta graph query result with the person identity projected."""
+    return {
+        'identity': {'uuid': f'00000000-0000-0000-0000-{i:012}'},
+        'state': 'STATE_ACTIVE',
+        'attributes': [
+            {'userKey': 'APOS-Types-Engagement-Attribute-Mobile', 'value': f'2{i:07}'},
+            {'userKey': 'APOS-Types-Engagement-Attribute-Phone', 'value': f'8{i:07}'},
+            {'userKey': 'APOS-Types-Engagement-Attribute-Email', 'value': f'medarbejder{i}@randers.dk'}
+        ],
+        'typeRefs': [
+            {'userKey': 'APOS-Types-Engagement-TypeRelation-Person', 'targetObject': {
+                'identity': {'userKey': f'{i % 280000 + 10100000:08}{i % 100:02}'},
+                'state': 'STATE_ACTIVE',
+                'attributes': [{'userKey': 'APOS-Types-Person-Attribute-SurnameAndName', 'value': f'Medarbejder {i}'}],
+                'inTypeRefs': [{'userKey': 'APOS-Types-User-TypeRelation-Person', 'targetObject': {'identity': {'name': f'DQ{i:06}'}}}]
+            }},
+            {'userKey': 'APOS-Types-Engagement-TypeRelation-AdmUnit', 'targetObject': {'identity': {'uuid': f'unit-{i % 400}', 'name': f'Afdeling {i % 400}'}}}
+        ]
+    }
+
+
+def make_payload(count: int) -> dict:
+    return {'graphQueryResult': [{'instances': [make_instance(i) for i in range(count)]}]}
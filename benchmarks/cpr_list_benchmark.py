@@ -0,0 +1,38 @@
+"""
+Measure parsing of a large paste of CPR numbers in the lookup tab, with a share of duplicates and invalid entries.
+
+Run with: python benchmarks/cpr_list_benchmark.py [entries]
+"""
+import sys
+import random
+import timeit
+
+import common  # noqa: F401
+
+from utils.utils import get_cpr_list
+
+
+def make_paste(count: int, rng: random.Random) -> str:
+    entries = []
+    for i in range(count):
+        cpr = f'{rng.randint(1, 28):02}{rng.randint(1, 12):02}{rng.randint(0, 99):02}{rng.choice(["-", ""])}{rng.randint(0, 9999):04}'
+        if i % 50 == 0:
+            cpr = cpr[:-2]  # invalid
+        entries.append(cpr)
+        if i % 20 == 0:
+            entries.append(entries[rng.randrange(len(entries))])  # duplicate
+    separators = [',', ';', '\n', '\t', ', ']
+    return ''.join(entry + rng.choice(separators) for entry in entries)
+
+
+def main(count: int = 100000) -> None:
+    text = make_paste(count, random.Random(1))
+    runs = 5
+    seconds = min(timeit.repeat(lambda: get_cpr_list(text), number=1, repeat=runs))
+    result = get_cpr_list(text)
+    print(f'{len(text) / 1e6:.1f} MB, {len(result.cpr_list)} valid, {len(result.invalid)} invalid, {result.duplicates} duplicates')
+    print(f'parse: {seconds * 1000:8.1f} ms (best of {runs})')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,65 @@
+"""
+Load test the Postgres connection pool with a burst of concurrent sessions, like many users opening the app at once.
+Each session holds its connection for a short query, so requests beyond DB_POOL_SIZE + DB_MAX_OVERFLOW have to wait for a free connection.
+
+Start the database from docker-compose.yml and run with:
+    docker compose up -d db
+    DB_USER=user DB_PASS=pass DB_HOST=localhost DB_DATABASE=demo python benchmarks/db_pool_benchmark.py [users] [queries per user] [query seconds]
+
+Pool settings are read from the DB_POOL_* environment variables, see utils/config.py.
+"""
+import sys
+import time
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import common  # noqa: F401
+
+from sqlalchemy import text
+from sqlalchemy.exc import TimeoutError
+
+from database import get_engine, get_session, get_db_pool_stats
+
+
+def run_user(queries: int, query_seconds: float) -> tuple[list[float], int]:
+    latencies = []
+    timeouts = 0
+    for _ in range(queries):
+        start = time.perf_counter()
+        try:
+            with get_session() as db_session:
+                db_session.execute(text('SELECT pg_sleep(:seconds)'), {'seconds': query_seconds})
+        except TimeoutError:
+            timeouts += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+    return latencies, timeouts
+
+
+def percentile(values: list[float], p: int) -> float:
+    return statistics.quantiles(values, n=100)[p - 1] if len(values) > 1 else (values[0] if values else 0.0)
+
+
+def main(users: int = 50, queries: int = 20, query_seconds: float = 0.02) -> None:
+    # Open the pool before measuring
+    with get_engine().connect() as connection:
+        connection.execute(text('SELECT 1'))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        results = list(executor.map(lambda _: run_user(queries, query_seconds), range(users)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for user_latencies, _ in results for latency in user_latencies]
+    timeouts = sum(user_timeouts for _, user_timeouts in results)
+    stats = get_db_pool_stats()
+
+    print(f'{users} users x {queries} queries of {query_seconds * 1000:.0f} ms, pool size {stats["size"]} + overflow {stats["max_overflow"]}')
+    print(f'completed {len(latencies)} queries in {elapsed:.2f} s ({len(latencies) / elapsed:.0f}/s), {timeouts} pool timeouts')
+    print(f'session latency p50 {percentile(latencies, 50) * 1000:.1f} ms, p95 {percentile(latencies, 95) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms')
+    print(f'checkout wait avg {stats["wait_seconds_avg"] * 1000:.1f} ms, max {stats["wait_seconds_max"] * 1000:.1f} ms, {stats["invalidations"]} invalidated connections')
+    print(f'pool after run: {stats["checked_in"]} checked in, {stats["checked_out"]} checked out, {stats["overflow"]} overflow')
+
+
+if __name__ == '__main__':
+    main(*[convert(arg) for convert, arg in zip([int, int, float], sys.argv[1:])])
@@ -0,0 +1,59 @@
+"""
+Profile the import time of the app modules with python -X importtime, in a fresh interpreter per module so nothing is already imported.
+Shows the total import time of each module and the slowest packages it pulls in, to see what an import at startup costs.
+
+Run with: python benchmarks/import_profile.py [modules] [--top 10]
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+import common
+
+MODULES = ['utils.config', 'delta', 'database', 'directory', 'api', 'main']
+
+
+def profile_import(module: str) -> list[tuple[str, int, int]]:
+    """
+    Import module in a new interpreter with -X importtime.
+
+    :return: A list of (imported module, self microseconds, cumulative microseconds), in import order
+    """
+    code = f'import sys; sys.path.insert(0, {common.SRC_DIR!r}); import {module}'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, env=os.environ.copy(), cwd=common.SRC_DIR)
+    if result.returncode:
+        raise RuntimeError(f'Importing {module} failed:\n{result.stderr[-2000:]}')
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix('import time:').split('|')
+        imports.append((name.rstrip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def top_level(imports: list[tuple[str, int, int]]) -> dict[str, int]:
+    """Sum the self time of the imports by top level package, e.g. all of sqlalchemy.*"""
+    packages = {}
+    for name, self_us, _ in imports:
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+    return packages
+
+
+def main(args: argparse.Namespace) -> None:
+    for module in args.modules:
+        imports = profile_import(module)
+        total = sum(self_us for _, self_us, _ in imports)
+        print(f'{module}: {total / 1000:.0f} ms, {len(imports)} modules')
+        for package, self_us in sorted(top_level(imports).items(), key=lambda item: -item[1])[:args.top]:
+            print(f'    {package:30} {self_us / 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--top', type=int, default=10, help='slowest packages shown per module')
+    main(parser.parse_args())
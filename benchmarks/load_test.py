@@ -0,0 +1,241 @@
+"""
+Load test search(), APIClient and the audit log path with many concurrent users, against the local Delta and IdP stand-in in stub_server.py.
+
+Scenarios:
+    dq           single DQ number lookups through search(), like users of the search field
+    cpr_bulk     500 CPR numbers pasted at once, through get_cpr_batch_search and search_batch
+    token_storm  APIClient requests with access tokens expiring every second, so many threads find an expired token at once
+    audit_log    AuditLogWriter.log calls, written in batches to a session that takes --commit-latency seconds per commit
+
+Run with:
+    python benchmarks/load_test.py [--users 50] [--duration 10] [--scenarios dq,cpr_bulk,token_storm,audit_log] [--latency 0.02] [--error-rate 0.01]
+
+Delta requests are rate limited as in production, set DELTA_RATE_LIMIT=0 to measure without the limit.
+Add --database to write the audit log to the database configured by the DB_* environment variables instead, see db_pool_benchmark.py.
+Results are written to benchmarks/results as JSON named by time and git revision, and compared with the previous result run with the same settings,
+so a regression between two versions shows up as a slower p95 or a lower throughput. Commit a result file to keep it as a baseline.
+"""
+import os
+import json
+import time
+import logging
+import random
+import argparse
+import threading
+import subprocess
+from datetime import datetime
+
+import common  # noqa: F401
+
+from stub_server import StubServer, StubSettings
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+USER = {'username': 'loadtest', 'email': 'loadtest@randers.dk'}
+REGRESSION_THRESHOLD = 0.2  # a p95 this much slower, or a throughput this much lower, than the previous result is reported
+
+
+class StubSession:
+    """Stands in for a database session in the audit log scenario. Each commit takes commit_latency seconds."""
+    def __init__(self, commit_latency: float, stats: dict):
+        self.commit_latency = commit_latency
+        self.stats = stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, stmt, rows=None):
+        self.stats['rows'] += len(rows or ())
+
+    def commit(self):
+        time.sleep(self.commit_latency)
+        self.stats['commits'] += 1
+
+    def rollback(self):
+        pass
+
+
+def percentile(latencies: list[float], fraction: float) -> float:
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] if latencies else 0.0
+
+
+def run_scenario(operation, users: int, duration: float) -> dict:
+    """
+    Call operation from users threads until duration seconds have passed.
+
+    :param operation: Function taking (user number, random generator), one call is one measured operation. Raises if the operation failed,
+                      e.g. Delta did not answer or answered with a 5xx, and returns the number of searched persons that were not found, if any
+    :return: Latency percentiles in milliseconds, throughput in operations per second, the number of errors and of persons not found
+    """
+    latencies = []
+    errors = []
+    not_found = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def user(number: int):
+        rng = random.Random(number)
+        own_latencies = []
+        own_errors = 0
+        own_not_found = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                own_not_found += operation(number, rng) or 0
+            except Exception:
+                own_errors += 1
+            own_latencies.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own_latencies)
+            errors.append(own_errors)
+            not_found.append(own_not_found)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(i,)) for i in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'operations': len(latencies),
+        'errors': sum(errors),
+        'not_found': sum(not_found),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)
+    }
+
+
+def main(args: argparse.Namespace) -> None:
+    settings = StubSettings(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    server = StubServer(settings).start()
+
+    # Imported after the settings are in place, delta_client is created on import
+    import delta
+    from audit import AuditLogWriter
+    from utils.api_requests import APIClient
+    from utils.utils import hash_cpr
+
+    delta.delta_client.base_url = server.url
+    delta.delta_client.auth_url = server.url
+
+    db_stats = {'rows': 0, 'commits': 0}
+    if args.database:
+        from database import get_session
+        session_factory = get_session
+    else:
+        def session_factory():
+            return StubSession(args.commit_latency, db_stats)
+    delta.audit_log = AuditLogWriter(session_factory)
+    logging.getLogger('audit').setLevel(logging.ERROR)  # a full queue is expected when logging as fast as possible, it is written synchronously
+
+    # search raises ValueError when Delta does not answer or answers with a 5xx, an empty result is a person that does not exist
+    def dq_lookup(number, rng):
+        query = delta.get_dq_number_search(f'DQ{rng.randrange(args.employees):06}', USER)
+        return int(delta.search(query, USER) is None)
+
+    def cpr_bulk(number, rng):
+        cpr_list = [f'{rng.randrange(10 ** 9, 10 ** 10):010}' for _ in range(500)]
+        return sum(person is None for person in delta.search_batch(delta.get_cpr_batch_search(cpr_list, USER, True), USER))
+
+    token_client = APIClient(
+        server.url, auth_url=server.url, realm='730', client_id='loadtest', client_secret='loadtest', pool_size=args.users
+    )
+    token_query = delta.get_dq_number_search('DQ000001', USER).body
+
+    def token_storm(number, rng):
+        if token_client.make_request(method='POST', path='api/object/graph-query', data=token_query, headers={'Content-Type': 'application/json'}) is None:
+            raise ValueError('Request failed')
+
+    def audit_log(number, rng):
+        delta.audit_log.log(USER['username'], USER['email'], 'cpr', hash_cpr(f'{rng.randrange(10 ** 10):010}'))
+
+    scenarios = {'dq': dq_lookup, 'cpr_bulk': cpr_bulk, 'token_storm': token_storm, 'audit_log': audit_log}
+
+    results = {}
+    for name in args.scenarios.split(','):
+        delta.search_cache.clear()
+        server.reset_counts()
+        settings.token_ttl = 1 if name == 'token_storm' else 300
+        db_stats.update(rows=0, commits=0)
+
+        result = run_scenario(scenarios[name], args.users, args.duration)
+        if name == 'audit_log':
+            start = time.perf_counter()
+            delta.audit_log.flush()
+            result['flush_ms'] = round((time.perf_counter() - start) * 1000, 2)
+            result |= db_stats
+        result['stub_requests'] = server.reset_counts()
+        results[name] = result
+        print(f'{name:12} {result["operations"]:7} ops {result["throughput"]:9.1f}/s  p50 {result["p50_ms"]:8.2f} ms  p95 {result["p95_ms"]:8.2f} ms  p99 {result["p99_ms"]:8.2f} ms  '
+              f'errors {result["errors"]}  not found {result["not_found"]}  stub {result["stub_requests"]}')
+
+    delta.audit_log.close()
+    token_client.close()
+    server.stop()
+    save_and_compare(results, vars(args))
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_and_compare(results: dict, settings: dict) -> None:
+    """
+    Write results to RESULTS_DIR and compare them with the latest earlier result run with the same settings.
+    Metrics in milliseconds are worse when higher, throughput is worse when lower.
+    """
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    previous_files = sorted(name for name in os.listdir(RESULTS_DIR) if name.endswith('.json'))
+
+    revision = git_revision()
+    path = os.path.join(RESULTS_DIR, f'{datetime.now():%Y%m%d-%H%M%S}-{revision}.json')
+    with open(path, 'w') as file:
+        json.dump({'revision': revision, 'time': datetime.now().isoformat(timespec='seconds'), 'settings': settings, 'results': results}, file, indent=2)
+    print(f'Results written to {path}')
+
+    for name in reversed(previous_files):
+        with open(os.path.join(RESULTS_DIR, name)) as file:
+            previous = json.load(file)
+        if previous['settings'] == settings:
+            break
+    else:
+        print('No earlier result with the same settings, not compared')
+        return
+
+    print(f'Compared with {previous["revision"]} ({previous["time"]}):')
+    for name, result in results.items():
+        before = previous['results'].get(name) or {}
+        changes = []
+        regression = False
+        for metric, value in result.items():
+            if not (metric.endswith('_ms') or metric == 'throughput') or not before.get(metric):
+                continue
+            change = value / before[metric] - 1
+            regression |= change < -REGRESSION_THRESHOLD if metric == 'throughput' else change > REGRESSION_THRESHOLD
+            changes.append(f'{metric} {change:+7.1%}')
+        if changes:
+            print(f'{name:12} {"  ".join(changes)}{"  REGRESSION" if regression else ""}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default='dq,cpr_bulk,token_storm,audit_log')
+    parser.add_argument('--users', type=int, default=50, help='concurrent users')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--employees', type=int, default=12000, help='number of distinct DQ numbers looked up')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds before the stub answers a graph query')
+    parser.add_argument('--jitter', type=float, default=0.01, help='random extra latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of graph queries answered with 503')
+    parser.add_argument('--commit-latency', type=float, default=0.005, help='seconds per audit log commit')
+    parser.add_argument('--database', action='store_true', help='write the audit log to the configured database')
+    main(parser.parse_args())
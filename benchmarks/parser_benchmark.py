@@ -0,0 +1,66 @@
+"""
+Compare the graph query result parser in delta.py with the previous parser, which scanned attributes and typeRefs once per field.
+
+Run with: python benchmarks/parser_benchmark.py [instances]
+"""
+import sys
+import json
+import timeit
+
+from common import make_payload
+
+from delta import parse_people
+
+
+def legacy_parse_person(instance: dict) -> dict:
+    attributes = instance.get('attributes', [])
+
+    email = next((item.get('value', '-') for item in attributes if item['userKey'] == 'APOS-Types-Engagement-Attribute-Email'), '-')
+    mobile = next((item.get('value', '-') for item in attributes if item['userKey'] == 'APOS-Types-Engagement-Attribute-Mobile'), '-')
+    phone = next((item.get('value', '-') for item in attributes if item['userKey'] == 'APOS-Types-Engagement-Attribute-Phone'), '-')
+
+    relations = instance.get('typeRefs', [])
+    department = next((item.get('targetObject', {}).get('identity', {}).get('name', '-') for item in relations if item['userKey'] == 'APOS-Types-Engagement-TypeRelation-AdmUnit'), '-')
+    name = next((item.get('targetObject', {}).get('attributes', [{}])[0].get('value', '-') for item in relations if item['userKey'] == 'APOS-Types-Engagement-TypeRelation-Person'), '-')
+
+    incoming_type_relations = next((item.get('targetObject', {}).get('inTypeRefs', None) for item in relations if item['userKey'] == 'APOS-Types-Engagement-TypeRelation-Person'), None)
+    if incoming_type_relations:
+        user = incoming_type_relations[0].get('targetObject', {}).get('identity', {}).get('name', '-')
+    else:
+        user = '-'
+
+    person = {
+        'Navn': name,
+        'E-mail': email,
+        'Telefon': phone,
+        'Mobil': mobile,
+        'Afdeling': department,
+        'DQ-nummer': user
+    }
+
+    for key, value in person.items():
+        if not value:
+            person[key] = '-'
+
+    return person
+
+
+def main(count: int = 10000, repeat: int = 5) -> None:
+    instances = json.loads(json.dumps(make_payload(count)))['graphQueryResult'][0]['instances']
+
+    # Both parsers must agree before timing them
+    for legacy, person in zip(map(legacy_parse_person, instances), parse_people(instances)):
+        assert (legacy['Navn'], legacy['E-mail'], legacy['Telefon'], legacy['Mobil'], legacy['Afdeling'], legacy['DQ-nummer']) == \
+            (person.name, person.email, person.phone, person.mobile, person.department, person.dq_number)
+
+    legacy = min(timeit.repeat(lambda: [legacy_parse_person(e) for e in instances], number=1, repeat=repeat))
+    current = min(timeit.repeat(lambda: list(parse_people(instances)), number=1, repeat=repeat))
+
+    print(f'{count} instances, best of {repeat}')
+    print(f'legacy parser:  {legacy * 1000:8.2f} ms  ({legacy / count * 1e6:.2f} us/instance)')
+    print(f'current parser: {current * 1000:8.2f} ms  ({current / count * 1e6:.2f} us/instance)')
+    print(f'speedup:        {legacy / current:8.2f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,66 @@
+"""
+Measure build time and search latency of the employee search index, with synthetic employees and queries typed one character at a time.
+
+Run with: python benchmarks/search_index_benchmark.py [employees]
+"""
+import sys
+import time
+import random
+import statistics
+
+import common  # noqa: F401
+
+from delta import Person
+from directory import SearchIndex, _get_person_tokens
+
+FIRST_NAMES = ['Anne', 'Mette', 'Kirsten', 'Hanne', 'Susanne', 'Lene', 'Jens', 'Peter', 'Lars', 'Michael', 'Henrik', 'Søren', 'Thomas', 'Niels', 'Rasmus', 'Mads', 'Sofie', 'Ida', 'Freja', 'Mikkel']
+LAST_NAMES = ['Nielsen', 'Jensen', 'Hansen', 'Pedersen', 'Andersen', 'Christensen', 'Larsen', 'Sørensen', 'Rasmussen', 'Jørgensen', 'Petersen', 'Madsen', 'Kristensen', 'Olsen', 'Thomsen', 'Christiansen', 'Poulsen', 'Johansen', 'Møller', 'Mortensen']
+UNITS = ['Skole', 'Børnehave', 'Plejecenter', 'Jobcenter', 'Borgerservice', 'Vej og Park', 'Digitalisering', 'Løn og Personale', 'Tandpleje', 'Bibliotek']
+QUERIES = ['hansen', 'jens han', 'mette jørgensen', 'hasnen', 'kirsetn', 'plejecenter 12', 'borgerservice', 'jens.hansen', '8612', 'dq0001', 'søren chrsitensen']
+
+
+def make_person(i: int, rng: random.Random) -> Person:
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    return Person(
+        name=f'{first} {rng.choice(FIRST_NAMES)} {last}',
+        email=f'{first}.{last}{i}@randers.dk'.lower(),
+        phone=f'8915{i % 10000:04}',
+        mobile=f'2{rng.randrange(10 ** 7):07}',
+        department=f'{rng.choice(UNITS)} {i % 60}',
+        dq_number=f'DQ{i:06}'
+    )
+
+
+def main(count: int = 12000) -> None:
+    rng = random.Random(1)
+    documents = {i: (0, make_person(i, rng)) for i in range(count)}
+
+    index = SearchIndex(_get_person_tokens, sort_key=lambda person: person.name)
+    start = time.perf_counter()
+    index.update(documents)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index.update({i: (1, make_person(i, rng)) for i in range(100)}, removed=range(100, 150))
+    incremental = time.perf_counter() - start
+
+    latencies = []
+    for query in QUERIES:
+        for length in range(1, len(query) + 1):  # search as you type
+            start = time.perf_counter()
+            index.search(query[:length])
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies.sort()
+    print(f'{count} employees, {len(latencies)} searches')
+    print(f'build:             {build * 1000:8.1f} ms')
+    print(f'incremental (150): {incremental * 1000:8.1f} ms')
+    print(f'search p50:        {statistics.median(latencies):8.2f} ms')
+    print(f'search p95:        {latencies[int(len(latencies) * 0.95)]:8.2f} ms')
+    print(f'search max:        {latencies[-1]:8.2f} ms')
+    for query in ('hasnen', 'kirsetn', 'søren chrsitensen'):
+        print(f'{query!r}: {[p.name for p in index.search(query, limit=3)]}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 12000)
@@ -0,0 +1,79 @@
+"""
+Measure the time from starting a new Python process until it has served its first lookup, like a replica after a scale-up.
+Each run starts a fresh interpreter that imports the app modules and searches for a DQ number in the stand-in for Delta and its IdP
+from stub_server.py, so the first lookup includes fetching the access token and opening the connection.
+
+Run with: python benchmarks/startup_benchmark.py [--runs 5] [--modules main] [--latency 0.02] [--token-latency 0.05]
+
+Results are stored and compared like load_test.py.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+import common
+
+from load_test import save_and_compare
+from stub_server import StubServer, StubSettings
+
+CHILD = '''
+import sys, time, json
+started = time.time()
+sys.path.insert(0, {src_dir!r})
+for module in {modules!r}:
+    __import__(module)
+imported = time.time()
+
+import delta
+delta.delta_client.base_url = delta.delta_client.auth_url = {url!r}
+user = {{'username': 'startup', 'email': 'startup@randers.dk'}}
+if delta.search(delta.get_dq_number_search('DQ000001', user), user) is None:
+    raise SystemExit('Lookup failed')
+print(json.dumps({{'started': started, 'imported': imported, 'served': time.time()}}))
+'''
+
+
+def run_once(url: str, modules: list[str]) -> dict:
+    """
+    Start a new interpreter and time it until the first lookup is served.
+
+    :return: Milliseconds until the interpreter ran its first line, until the modules were imported, for the first lookup and in total
+    """
+    code = CHILD.format(src_dir=common.SRC_DIR, modules=modules, url=url)
+    spawned = time.time()
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=os.environ | {'DELTA_RATE_LIMIT': '0'}, cwd=common.SRC_DIR)
+    if result.returncode:
+        raise RuntimeError(f'Startup run failed:\n{result.stderr[-2000:]}')
+
+    times = json.loads(result.stdout.strip().splitlines()[-1])
+    return {
+        'interpreter_ms': (times['started'] - spawned) * 1000,
+        'import_ms': (times['imported'] - times['started']) * 1000,
+        'first_lookup_ms': (times['served'] - times['imported']) * 1000,
+        'total_ms': (times['served'] - spawned) * 1000
+    }
+
+
+def main(args: argparse.Namespace) -> None:
+    server = StubServer(StubSettings(latency=args.latency, jitter=0, token_latency=args.token_latency, not_found_rate=0)).start()
+    modules = args.modules.split(',')
+
+    runs = [run_once(server.url, modules) for _ in range(args.runs)]
+    server.stop()
+
+    result = {metric: round(statistics.median(run[metric] for run in runs), 1) for metric in runs[0]}
+    print('  '.join(f'{metric} {value:8.1f}' for metric, value in result.items()), f'(median of {args.runs} runs)')
+    save_and_compare({'startup': result}, {'benchmark': 'startup'} | vars(args))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--modules', default='main', help='modules imported before the first lookup, main imports everything the app starts with')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds before the stub answers a graph query')
+    parser.add_argument('--token-latency', type=float, default=0.05, help='seconds before the stub answers a token request')
+    main(parser.parse_args())
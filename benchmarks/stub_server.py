@@ -0,0 +1,123 @@
+"""
+Local stand-in for Delta and its IdP, for load tests. Serves the Keycloak token endpoint and the graph query endpoint
+with payloads shaped like Delta's, with configurable latency and injected errors.
+"""
+import re
+import json
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from common import make_instance
+
+TOKEN_PATH = re.compile(r'^/realms/[^/]+/protocol/openid-connect/token$')
+GRAPH_QUERY_PATH = '/api/object/graph-query'
+MATCH = re.compile(r'"alias": "([^"]+)"}, "right": \{"source": "STATIC", "value": "([^"]+)"}')
+
+
+class StubSettings:
+    """Behaviour of the stub server, can be changed while it runs, e.g. between scenarios."""
+    def __init__(self, latency: float = 0.02, jitter: float = 0.01, token_latency: float = 0.05, error_rate: float = 0.0, token_ttl: int = 300, not_found_rate: float = 0.05):
+        """
+        :param latency: Seconds before a graph query is answered
+        :param jitter: Random extra seconds, up to this, added to each latency
+        :param token_latency: Seconds before a token request is answered
+        :param error_rate: Fraction of graph queries answered with 503
+        :param token_ttl: expires_in of issued access tokens, in seconds
+        :param not_found_rate: Fraction of searched DQ and CPR numbers without an engagement
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.token_latency = token_latency
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.not_found_rate = not_found_rate
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, settings: StubSettings | None = None):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.settings = settings or StubSettings()
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.counts = {'token': 0, 'graph_query': 0, 'error': 0}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.counts[name] += 1
+
+    def reset_counts(self) -> dict:
+        with self._lock:
+            counts, self.counts = self.counts, dict.fromkeys(self.counts, 0)
+        return counts
+
+    def start(self) -> 'StubServer':
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05}, name='stub-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def make_engagement(value: str, alias: str) -> dict:
+    """An engagement for a searched DQ or CPR number, with the number in the place Delta returns it."""
+    instance = make_instance(abs(hash(value)) % 10 ** 6)
+    person = instance['typeRefs'][0]['targetObject']
+    if alias.endswith('user.$userKey'):
+        person['inTypeRefs'][0]['targetObject']['identity']['name'] = value
+    else:
+        person['identity']['userKey'] = value
+    return instance
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server: StubServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, payload: dict | None = None) -> None:
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        settings = self.server.settings
+
+        if TOKEN_PATH.match(self.path):
+            self.server.count('token')
+            time.sleep(settings.token_latency)
+            self._send(200, {
+                'access_token': f'stub-{time.time_ns()}', 'expires_in': settings.token_ttl,
+                'refresh_token': 'stub-refresh', 'refresh_expires_in': settings.token_ttl * 2
+            })
+        elif self.path == GRAPH_QUERY_PATH:
+            self.server.count('graph_query')
+            time.sleep(settings.latency + random.uniform(0, settings.jitter))
+            if random.random() < settings.error_rate:
+                self.server.count('error')
+                self._send(503)
+                return
+
+            instances = [
+                make_engagement(value, alias)
+                for alias, value in MATCH.findall(body.decode())
+                if value != 'STATE_ACTIVE' and random.random() >= settings.not_found_rate
+            ]
+            self._send(200, {'graphQueryResult': [{'instances': instances}]})
+        else:
+            self._send(404)
+
+    def do_GET(self):
+        # Any answer below 500 counts as reachable for the readiness probe
+        self._send(200, {})
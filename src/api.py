@@ -0,0 +1,144 @@
+import logging
+from collections.abc import Callable
+from dataclasses import asdict
+from functools import wraps
+
+import jwt
+from flask import Flask, g, jsonify, request
+from sqlalchemy.orm import Session
+
+from delta import get_cpr_search, get_dq_number_search, get_cpr_batch_search, search, search_batch, search_concurrent, get_emails
+from health import monitoring
+from utils.config import KEYCLOAK_URL, KEYCLOAK_REALM, KEYCLOAK_CLIENT, KEYCLOAK_AUDIENCE, API_PORT, API_THREADS, API_MAX_BATCH_SIZE
+from utils.keycloak import KeycloakTokenValidator
+from utils.utils import verify_cpr
+
+logger = logging.getLogger(__name__)
+
+CPR_ROLE = 'cpr'
+
+
+def create_app(session_factory: Callable[[], Session], validator: KeycloakTokenValidator | None = None) -> Flask:
+    """
+    Create the JSON API for DQ number, CPR number and batch CPR lookups. All lookups require a Keycloak bearer token,
+    CPR lookups also require the cpr client role, like in the Streamlit app. /healthz, /readyz and /metrics are served without a token.
+
+    :param session_factory: Function returning a new database session, e.g. database.get_session
+    :param validator: Validator for the bearer tokens. Defaults to the configured Keycloak realm and client
+    :return: The Flask app
+    """
+    app = Flask(__name__)
+    app.json.sort_keys = False
+    app.register_blueprint(monitoring)
+    validator = validator or KeycloakTokenValidator(KEYCLOAK_URL, KEYCLOAK_REALM, KEYCLOAK_CLIENT, KEYCLOAK_AUDIENCE)
+
+    def error(message: str, status: int):
+        return jsonify({'error': message}), status
+
+    def authenticated(cpr_rights: bool = False):
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+                if scheme.lower() != 'bearer' or not token:
+                    return error('Missing bearer token', 401)
+                try:
+                    claims = validator.validate(token)
+                except jwt.PyJWTError as e:
+                    logger.info(f'Rejected token: {e.__class__.__name__} {e}')
+                    return error('Invalid bearer token', 401)
+
+                if cpr_rights and CPR_ROLE not in validator.get_roles(claims):
+                    return error('Missing the cpr role', 403)
+
+                # Tokens of service accounts usually have no e-mail, and may have no username, the audit log needs both
+                username = claims.get('preferred_username') or claims.get('azp') or claims.get('client_id') or claims.get('sub')
+                if not username:
+                    return error('Token has no user or client', 401)
+                g.user = {'username': username, 'email': claims.get('email') or ''}
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @app.errorhandler(ValueError)
+    def delta_error(e):
+        # search raises ValueError when Delta does not answer
+        logger.error(f'Lookup failed: {e}')
+        return error(str(e), 502)
+
+    @app.get('/api/dq/<dq_number>')
+    @authenticated()
+    def dq_lookup(dq_number: str):
+        with session_factory() as db_session:
+            people = search(get_dq_number_search(dq_number, g.user), g.user, db_session)
+        return jsonify({'results': [asdict(p) for p in people or []]})
+
+    @app.post('/api/dq/batch')
+    @authenticated()
+    def dq_batch_lookup():
+        dq_numbers = (request.get_json(silent=True) or {}).get('dq')
+        if not isinstance(dq_numbers, list) or not dq_numbers or not all(isinstance(dq, str) and dq.strip() for dq in dq_numbers):
+            return error('Ugyldigt DQ-nummer', 400)
+        if len(dq_numbers) > API_MAX_BATCH_SIZE:
+            return error(f'Højst {API_MAX_BATCH_SIZE} DQ-numre pr. opslag', 400)
+
+        # DQ numbers can not be batched into one graph query, each is looked up on its own with its own session
+        dq_numbers = [dq.strip() for dq in dq_numbers]
+        results = search_concurrent([get_dq_number_search(dq, g.user) for dq in dq_numbers], g.user, session_factory)
+        return jsonify({'results': [
+            {'dq': dq, 'results': [asdict(p) for p in people or []]}
+            for dq, people in zip(dq_numbers, results)
+        ]})
+
+    @app.post('/api/cpr')
+    @authenticated(cpr_rights=True)
+    def cpr_lookup():
+        cpr = (request.get_json(silent=True) or {}).get('cpr')
+        if not isinstance(cpr, str) or not verify_cpr(cpr.strip()):
+            return error('Ugyldigt CPR-nummer', 400)
+
+        query = get_cpr_search(cpr.strip().replace('-', ''), g.user, True)
+        with session_factory() as db_session:
+            people = search(query, g.user, db_session)
+        return jsonify({'results': [asdict(p) for p in people or []]})
+
+    @app.post('/api/cpr/batch')
+    @authenticated(cpr_rights=True)
+    def cpr_batch_lookup():
+        cpr_list = (request.get_json(silent=True) or {}).get('cpr')
+        if not isinstance(cpr_list, list) or not cpr_list or not all(isinstance(cpr, str) and verify_cpr(cpr.strip()) for cpr in cpr_list):
+            return error('Ugyldigt CPR-nummer', 400)
+        if len(cpr_list) > API_MAX_BATCH_SIZE:
+            return error(f'Højst {API_MAX_BATCH_SIZE} CPR-numre pr. opslag', 400)
+
+        cpr_list = [cpr.strip().replace('-', '') for cpr in cpr_list]
+        queries = get_cpr_batch_search(cpr_list, g.user, True)
+        with session_factory() as db_session:
+            people = search_batch(queries, g.user, db_session)
+        return jsonify({'results': [
+            {'cpr': cpr, 'email': email, 'person': asdict(p) if p else None}
+            for cpr, email, p in zip(cpr_list, get_emails(people), people)
+        ]})
+
+    return app
+
+
+if __name__ == '__main__':
+    import signal
+    import sys
+
+    from waitress import serve
+
+    from database import get_session
+    from delta import use_shared_cache
+    from utils.config import SHARED_CACHE
+    from utils.logging import set_logging_configuration
+    from utils.utils import verify_cpr_hash_key
+
+    set_logging_configuration()
+    verify_cpr_hash_key()
+    if SHARED_CACHE:
+        use_shared_cache(get_session)
+    # Waitress does not handle SIGTERM, exit normally so atexit writes the queued audit log events before the pod stops
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    serve(create_app(get_session), host='0.0.0.0', port=API_PORT, threads=API_THREADS)
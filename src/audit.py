@@ -0,0 +1,433 @@
+import os
+import re
+import gzip
+import time
+import queue
+import atexit
+import hashlib
+import logging
+import threading
+from collections.abc import Callable
+from datetime import date, datetime
+
+from sqlalchemy import insert, select, text, inspect
+from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Session
+
+from models import Log
+from utils.config import DB_SCHEMA, AUDIT_LOG_QUEUE_SIZE, AUDIT_LOG_BATCH_SIZE, AUDIT_LOG_FLUSH_INTERVAL, AUDIT_LOG_STRICT, AUDIT_LOG_PARTITIONS_AHEAD, AUDIT_LOG_RETENTION_MONTHS, AUDIT_LOG_ARCHIVE_DIR, AUDIT_LOG_MAINTENANCE_INTERVAL
+from utils.utils import hash_cpr
+
+logger = logging.getLogger(__name__)
+
+SEARCH_TYPE_CPR = 'cpr'
+SEARCH_TYPE_CPR_BATCH = 'cpr_batch'
+SEARCH_TYPE_LEGACY = 'legacy'  # messages from the old log table that were not CPR searches
+
+AUDIT_LOCK_KEY = 730_002  # Postgres advisory lock, makes sure only one replica changes partitions at a time
+LEGACY_TABLE = 'log'
+LEGACY_BATCH_SIZE = 10000
+LEGACY_CPR_MESSAGE = re.compile(r'^Searched for cpr: (.+)$')
+PARTITION_NAME = re.compile(rf'^{Log.__tablename__}_(\d{{4}})_(\d{{2}})$')
+
+
+class AuditLogWriter:
+    """
+    Writes audit log events to the log table from a bounded in-memory queue.
+    A background thread flushes the queue with a single multi-row INSERT when batch_size events are queued or flush_interval seconds have passed.
+    In strict mode, or if the queue is full, events are written synchronously before log returns.
+    """
+    def __init__(self, session_factory: Callable[[], Session], queue_size: int = 10000, batch_size: int = 500, flush_interval: float = 1.0, strict: bool = False, retry_interval: float = 5.0):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.strict = strict
+        self.retry_interval = retry_interval
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stopped = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def log(self, username: str, email: str, search_type: str, subject_hash: str, strict: bool | None = None) -> None:
+        self.log_many([(username, email, search_type, subject_hash)], strict)
+
+    def log_many(self, events: list[tuple[str, str, str, str]], strict: bool | None = None) -> None:
+        """
+        Queue audit log events for writing.
+
+        :param events: Tuples of (username, email, search_type, subject_hash). The subject is hashed with hash_cpr
+        :param strict: Write the events before returning. Defaults to the strict setting of the writer
+        """
+        now = datetime.now()
+        rows = [
+            {'username': username, 'email': email, 'search_type': search_type, 'subject_hash': subject_hash, 'created_at': now}
+            for username, email, search_type, subject_hash in events
+        ]
+
+        if (self.strict if strict is None else strict) or self._stopped.is_set():
+            self._write(rows)
+            return
+
+        self._start()
+        for i, row in enumerate(rows):
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                logger.warning('Audit log queue is full, writing synchronously')
+                self._write(rows[i:])
+                return
+
+    def flush(self, timeout: float | None = 30) -> None:
+        """
+        Block until all queued events are written.
+
+        :param timeout: Seconds to wait, None to wait for good. The background thread retries failed writes until the database is back
+        :raises TimeoutError: If the events are not written within timeout
+        """
+        if self._thread and self._thread.is_alive():
+            with self._queue.all_tasks_done:
+                if not self._queue.all_tasks_done.wait_for(lambda: not self._queue.unfinished_tasks, timeout):
+                    raise TimeoutError(f'{self._queue.unfinished_tasks} audit log events not written after {timeout} seconds')
+        else:
+            self._drain()
+
+    def close(self) -> None:
+        """Stop the background thread and write all remaining events."""
+        self._stopped.set()
+        if self._thread:
+            # Stops after its current write and queues a failed batch again, so it never writes at the same time as the drain below
+            self._thread.join()
+        try:
+            self._drain()
+        except Exception as e:
+            # Runs at exit, where nothing can retry the events
+            logger.error(f'Writing the remaining audit log events while stopping failed with error: {e.__class__} {e}')
+
+    def _start(self) -> None:
+        if self._thread is None:
+            with self._thread_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='audit-log-writer', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            pending = batch
+            while pending:
+                try:
+                    self._write(pending)
+                    break
+                except Exception as e:
+                    logger.error(f'Writing {len(pending)} audit log events failed with error: {e.__class__} {e}')
+                    if not _is_transient_error(e):
+                        # A bad row fails the whole INSERT, write the rows one at a time so only the bad rows are dropped
+                        pending = self._write_each(pending)
+                        if not pending:
+                            break
+                    # Audit events are never dropped while the database is down, keep retrying until it is back
+                    if self._stopped.wait(self.retry_interval):
+                        self._requeue(pending)
+                        break
+
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write_each(self, rows: list[dict]) -> list[dict]:
+        # Returns the rows that are not written yet if the database goes down on the way
+        for i, row in enumerate(rows):
+            try:
+                self._write([row])
+            except Exception as e:
+                if _is_transient_error(e):
+                    return rows[i:]
+                logger.error(f'Dropping audit log event that can not be written: {e.__class__} {e} '
+                             f'(username={row.get("username")!r}, search_type={row.get("search_type")!r}, created_at={row.get("created_at")})')
+        return []
+
+    def _requeue(self, rows: list[dict]) -> None:
+        # Only called while stopping, close writes them synchronously after the thread has stopped
+        overflow = []
+        for row in rows:
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                overflow.append(row)
+
+        if overflow:
+            try:
+                self._write(overflow)
+            except Exception as e:
+                logger.error(f'Writing {len(overflow)} audit log events while stopping failed with error: {e.__class__} {e}')
+
+    def _drain(self) -> None:
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            for i in range(0, len(rows), self.batch_size):
+                self._write(rows[i:i + self.batch_size])
+        finally:
+            for _ in rows:
+                self._queue.task_done()
+
+    def _write(self, rows: list[dict]) -> None:
+        if not rows:
+            return
+        with self.session_factory() as db_session:
+            db_session.execute(insert(Log), rows)
+            db_session.commit()
+
+
+def _is_transient_error(e: Exception) -> bool:
+    # Lost connections and full pools pass, while e.g. IntegrityError and DataError fail the same rows again
+    return isinstance(e, (OperationalError, PoolTimeoutError)) or (isinstance(e, DBAPIError) and e.connection_invalidated)
+
+
+def _get_session() -> Session:
+    # Imported on first write, so modules that log searches can be imported without a database connection
+    from database import get_session
+    return get_session()
+
+
+def find_searches(db_session: Session, cpr: str | None = None, username: str | None = None, start: datetime | None = None, end: datetime | None = None, limit: int = 100) -> list[Log]:
+    """
+    Find logged searches, e.g. who searched for a CPR number in a period. Uses the subject and username indexes,
+    and only scans the monthly partitions between start and end.
+
+    :param db_session: Database session
+    :param cpr: Only searches for this CPR number
+    :param username: Only searches made by this user
+    :param start: Only searches made at or after this time
+    :param end: Only searches made before this time
+    :param limit: Maximum number of searches to return
+    :return: A list of logged searches, newest first
+    """
+    stmt = select(Log)
+    if cpr:
+        stmt = stmt.where(Log.subject_hash == hash_cpr(cpr.strip()))
+    if username:
+        stmt = stmt.where(Log.username == username)
+    if start:
+        stmt = stmt.where(Log.created_at >= start)
+    if end:
+        stmt = stmt.where(Log.created_at < end)
+    return list(db_session.scalars(stmt.order_by(Log.created_at.desc()).limit(limit)))
+
+
+def _add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _get_partition_name(month: date) -> str:
+    return f'{Log.__tablename__}_{month.year}_{month.month:02}'
+
+
+def get_partitions(db_session: Session) -> dict[str, date]:
+    """
+    Get the monthly partitions of the audit log table.
+
+    :param db_session: Database session
+    :return: A dictionary of partition name to the first day of its month
+    """
+    names = db_session.execute(text(
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+        'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+        'JOIN pg_namespace ON pg_namespace.oid = parent.relnamespace '
+        'WHERE parent.relname = :table AND pg_namespace.nspname = :schema'
+    ), {'table': Log.__tablename__, 'schema': DB_SCHEMA}).scalars()
+
+    partitions = {}
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions[name] = date(int(match[1]), int(match[2]), 1)
+    return partitions
+
+
+def ensure_partitions(db_session: Session, start: date | None = None, months_ahead: int = AUDIT_LOG_PARTITIONS_AHEAD) -> list[str]:
+    """
+    Create missing monthly partitions of the audit log table, from the month of start to months_ahead after the current month.
+    The caller commits.
+
+    :param db_session: Database session
+    :param start: First month to create a partition for. Defaults to the current month
+    :param months_ahead: Number of future months to create partitions for
+    :return: A list of the created partition names
+    """
+    this_month = date.today().replace(day=1)
+    month = (start or this_month).replace(day=1)
+    last = _add_months(this_month, months_ahead)
+    existing = get_partitions(db_session)
+
+    created = []
+    while month <= last:
+        name = _get_partition_name(month)
+        if name not in existing:
+            db_session.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {DB_SCHEMA}.{name} PARTITION OF {DB_SCHEMA}.{Log.__tablename__} "
+                f"FOR VALUES FROM ('{month}') TO ('{_add_months(month, 1)}')"
+            ))
+            created.append(name)
+        month = _add_months(month, 1)
+    return created
+
+
+def archive_partitions(db_session: Session, retention_months: int = AUDIT_LOG_RETENTION_MONTHS, archive_dir: str = AUDIT_LOG_ARCHIVE_DIR) -> list[str]:
+    """
+    Archive monthly partitions older than the retention period to gzip compressed CSV files, then detach and drop them.
+    A partition is only dropped once its file is written and synced to disk. Each partition is archived in its own transaction.
+    Nothing is archived or dropped unless archive_dir is set, as a directory in the container is lost when the pod restarts.
+
+    :param db_session: Database session
+    :param retention_months: Number of months to keep in the database, not counting the current month
+    :param archive_dir: Directory for the archive files, e.g. a mounted persistent volume
+    :return: A list of the written archive files
+    """
+    cutoff = _add_months(date.today().replace(day=1), -retention_months)
+    expired = sorted((month, name) for name, month in get_partitions(db_session).items() if month < cutoff)
+    if expired and not archive_dir:
+        logger.warning(f'{len(expired)} audit log partitions are older than {retention_months} months, set AUDIT_LOG_ARCHIVE_DIR to archive and drop them')
+        return []
+
+    archived = []
+    for month, name in expired:
+        if not _try_lock(db_session):
+            logger.info('Audit log maintenance already running on another replica')
+            break
+
+        path = os.path.join(archive_dir, f'{name}.csv.gz')
+        _export_partition(db_session, name, path)
+        db_session.execute(text(f'ALTER TABLE {DB_SCHEMA}.{Log.__tablename__} DETACH PARTITION {DB_SCHEMA}.{name}'))
+        db_session.execute(text(f'DROP TABLE {DB_SCHEMA}.{name}'))
+        db_session.commit()
+
+        logger.info(f'Archived audit log partition {name} to {path}')
+        archived.append(path)
+    return archived
+
+
+def _export_partition(db_session: Session, name: str, path: str) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    cursor = db_session.connection().connection.cursor()
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as file:
+        with gzip.GzipFile(fileobj=file, mode='wb') as gzip_file:
+            cursor.copy_expert(f'COPY {DB_SCHEMA}.{name} TO STDOUT WITH (FORMAT csv, HEADER)', gzip_file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def migrate_legacy_log(db_session: Session) -> int:
+    """
+    Move rows from the old unpartitioned log table to the audit log table, replacing the message with a search type and hashed CPR number.
+    The old table is renamed to log_legacy afterwards, so it is only migrated once. The caller commits.
+
+    :param db_session: Database session
+    :return: Number of migrated rows
+    """
+    if not inspect(db_session.connection()).has_table(LEGACY_TABLE, schema=DB_SCHEMA):
+        return 0
+
+    first = db_session.execute(text(f'SELECT min(created_at) FROM {DB_SCHEMA}.{LEGACY_TABLE}')).scalar()
+    if first:
+        ensure_partitions(db_session, first)
+
+    count = 0
+    last_id = 0
+    while True:
+        rows = db_session.execute(text(
+            f'SELECT id, message, email, username, created_at FROM {DB_SCHEMA}.{LEGACY_TABLE} WHERE id > :id ORDER BY id LIMIT :limit'
+        ), {'id': last_id, 'limit': LEGACY_BATCH_SIZE}).all()
+        if not rows:
+            break
+
+        db_session.execute(insert(Log), [_get_legacy_row(row.message, row.email, row.username, row.created_at) for row in rows])
+        last_id = rows[-1].id
+        count += len(rows)
+
+    db_session.execute(text(f'ALTER TABLE {DB_SCHEMA}.{LEGACY_TABLE} RENAME TO {LEGACY_TABLE}_legacy'))
+    logger.info(f'Migrated {count} rows from the legacy log table')
+    return count
+
+
+def _get_legacy_row(message: str, email: str, username: str, created_at: datetime) -> dict:
+    match = LEGACY_CPR_MESSAGE.match(message)
+    if match:
+        search_type, subject_hash = SEARCH_TYPE_CPR, hash_cpr(match[1].strip())
+    else:
+        search_type, subject_hash = SEARCH_TYPE_LEGACY, hashlib.sha256(message.encode()).hexdigest()
+    return {'username': username, 'email': email, 'search_type': search_type, 'subject_hash': subject_hash, 'created_at': created_at}
+
+
+def prepare_audit_log() -> None:
+    """Migrate the legacy log table and create the partitions for the current and coming months. Run before the app starts."""
+    with _get_session() as db_session:
+        db_session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': AUDIT_LOCK_KEY})
+        migrate_legacy_log(db_session)
+        ensure_partitions(db_session)
+        db_session.commit()
+
+
+def run_audit_maintenance() -> list[str] | None:
+    """
+    Create the coming monthly partitions and archive partitions older than the retention period.
+
+    :return: A list of the written archive files or None if another replica is already running maintenance
+    """
+    with _get_session() as db_session:
+        if not _try_lock(db_session):
+            logger.info('Audit log maintenance already running on another replica')
+            return None
+        ensure_partitions(db_session)
+        db_session.commit()
+        return archive_partitions(db_session)
+
+
+def _try_lock(db_session: Session) -> bool:
+    # Held until the end of the current transaction
+    return db_session.execute(text('SELECT pg_try_advisory_xact_lock(:key)'), {'key': AUDIT_LOCK_KEY}).scalar()
+
+
+def start_audit_maintenance(interval: int = AUDIT_LOG_MAINTENANCE_INTERVAL) -> threading.Thread:
+    """
+    Start a background thread that runs the audit log maintenance on a schedule.
+
+    :param interval: Seconds between runs
+    :return: The started daemon thread
+    """
+    def run():
+        while True:
+            try:
+                run_audit_maintenance()
+            except Exception as e:
+                logger.error(f'Audit log maintenance failed: {e.__class__} {e}')
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='audit-maintenance', daemon=True)
+    thread.start()
+    return thread
+
+
+audit_log = AuditLogWriter(_get_session, queue_size=AUDIT_LOG_QUEUE_SIZE, batch_size=AUDIT_LOG_BATCH_SIZE, flush_interval=AUDIT_LOG_FLUSH_INTERVAL, strict=AUDIT_LOG_STRICT)
@@ -0,0 +1,154 @@
+import io
+import csv
+import logging
+from collections.abc import Callable, Iterable, Iterator
+from itertools import islice
+from typing import IO
+
+from sqlalchemy.orm import Session
+
+from delta import get_cpr_batch_search, search_batch, get_emails
+from utils.config import CPR_BATCH_SIZE
+from utils.utils import verify_cpr
+
+logger = logging.getLogger(__name__)
+
+INVALID_CPR = 'UGYLDIGT_CPR'
+RESULT_COLUMNS = ['række', 'cpr', 'email']
+
+
+class CountingReader(io.RawIOBase):
+    """Wraps a binary file and counts the bytes read, so progress can be reported while the file is streamed."""
+    def __init__(self, file: IO[bytes]):
+        self.file = file
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.file.read(len(buffer))
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+
+class CprFileReader:
+    """
+    Streams CPR numbers from an uploaded CSV or XLSX file, one row at a time. The CPR number is taken from the column with a CPR header,
+    or the first column if there is no header. Empty rows are skipped.
+    """
+    def __init__(self, file: IO[bytes], filename: str, size: int | None = None):
+        self.file = file
+        self.filename = filename
+        self.size = size
+        self.rows_read = 0
+        self._total_rows = None
+        self._reader = None
+
+    @property
+    def progress(self) -> float:
+        """Fraction of the file read so far, between 0 and 1."""
+        if self._total_rows:
+            return min(self.rows_read / self._total_rows, 1.0)
+        if self.size and self._reader:
+            return min(self._reader.bytes_read / self.size, 1.0)
+        return 0.0
+
+    def __iter__(self) -> Iterator[tuple[int, str]]:
+        """
+        :return: A generator of (row number, CPR number as written in the file)
+        """
+        rows = self._read_xlsx() if self.filename.lower().endswith('.xlsx') else self._read_csv()
+
+        column = 0
+        for row_number, row in enumerate(rows, start=1):
+            self.rows_read = row_number
+            values = [_cell_to_str(value) for value in row]
+            if not any(values):
+                continue
+
+            if row_number == 1:
+                headers = [value.lower() for value in values]
+                header = next((i for i, value in enumerate(headers) if 'cpr' in value or value == 'personnummer'), None)
+                if header is not None:
+                    column = header
+                    continue
+                if not any(verify_cpr(value) for value in values):
+                    continue  # another header row
+
+            yield row_number, values[column] if column < len(values) else ''
+
+    def _read_csv(self) -> Iterator[list[str]]:
+        self._reader = CountingReader(self.file)
+        text = io.TextIOWrapper(io.BufferedReader(self._reader), encoding='utf-8-sig', errors='replace', newline='')
+
+        sample = text.readline()
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+
+        yield from csv.reader(io.StringIO(sample), dialect)
+        yield from csv.reader(text, dialect)
+
+    def _read_xlsx(self) -> Iterator[tuple]:
+        from openpyxl import load_workbook
+
+        # Read only mode streams the rows instead of loading the whole workbook
+        workbook = load_workbook(self.file, read_only=True, data_only=True)
+        try:
+            sheet = workbook.worksheets[0]
+            self._total_rows = sheet.max_row
+            yield from sheet.iter_rows(values_only=True)
+        finally:
+            workbook.close()
+
+
+def _cell_to_str(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and float(value).is_integer():
+        # Excel stores CPR numbers typed as numbers without the leading zero
+        return f'{int(value):010d}'
+    return str(value).strip()
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def lookup_rows(rows: Iterable[tuple[int, str]], user: dict, session_factory: Callable[[], Session], chunk_size: int = CPR_BATCH_SIZE, log: bool = True) -> Iterator[list[dict]]:
+    """
+    Look up e-mails for streamed CPR rows, one chunk at a time, so only one chunk is held in memory.
+
+    :param rows: (row number, CPR number) tuples, e.g. from CprFileReader
+    :param user: User information dictionary containing 'username' and 'email' keys
+    :param session_factory: Function returning a new database session, e.g. database.get_session
+    :param chunk_size: Number of rows looked up at a time
+    :param log: Log the searches in the audit log, see delta.get_cpr_batch_search
+    :return: A generator of result chunks, with a dictionary of RESULT_COLUMNS for each row in the order of the file
+    """
+    for chunk in chunked(rows, chunk_size):
+        valid = [cpr.replace('-', '') for _, cpr in chunk if verify_cpr(cpr)]
+
+        emails = iter([])
+        if valid:
+            queries = get_cpr_batch_search(valid, user, True, log=log)
+            with session_factory() as db_session:
+                emails = iter(get_emails(search_batch(queries, user, db_session)))
+
+        yield [
+            {'række': row_number, 'cpr': cpr, 'email': next(emails) if verify_cpr(cpr) else INVALID_CPR}
+            for row_number, cpr in chunk
+        ]
+
+
+def write_csv(results: list[dict], file: IO[str], header: bool = False) -> None:
+    """Append result rows from lookup_rows to a CSV file."""
+    writer = csv.DictWriter(file, fieldnames=RESULT_COLUMNS, delimiter=';')
+    if header:
+        writer.writeheader()
+    writer.writerows(results)
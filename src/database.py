@@ -1,33 +1,71 @@
+import threading
 import urllib.parse
 
 from sqlalchemy import create_engine, Engine
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.schema import CreateSchema
 
-from utils.config import DB_USER, DB_PASS, DB_HOST, DB_PORT, DB_DATABASE, DB_SCHEMA
+from utils.config import DB_USER, DB_PASS, DB_HOST, DB_PORT, DB_DATABASE, DB_SCHEMA, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING
+from utils.db_pool import MeasuredQueuePool, track_invalidations, track_commits, get_pool_stats
+from utils.metrics import PoolCollector, register_collector
 from models import Base
 
+# Created on first use, so importing this module does not load the database driver or build the pool
+_engine = None
+_session_factory = None
+_engine_lock = threading.Lock()
 
-def get_engine() -> Engine:
+
+def create_db_engine() -> Engine:
     """Create and return a SQLAlchemy engine connected to the PostgreSQL database."""
     password = urllib.parse.quote_plus(DB_PASS)
     connection_string = f'postgresql+psycopg2://{DB_USER}:{password}@{DB_HOST}:{DB_PORT}/{DB_DATABASE}'
-    engine = create_engine(connection_string)
+    engine = create_engine(
+        connection_string,
+        poolclass=MeasuredQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING
+    )
+    track_invalidations(engine)
     return engine
 
 
-engine = get_engine()
-SessionLocal = sessionmaker(bind=engine)
+def get_engine() -> Engine:
+    """Return the engine shared by the process, created on first use."""
+    global _engine, _session_factory
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = create_db_engine()
+                _session_factory = sessionmaker(bind=engine)
+                track_commits(_session_factory)
+                _engine = engine
+    return _engine
 
 
 def get_session() -> Session:
     """Create and return a new SQLAlchemy session."""
-    session = SessionLocal()
+    get_engine()
+    session = _session_factory()
     return session
 
 
+def get_db_pool_stats() -> dict:
+    """Return statistics for the connection pool of the engine. All zero until the engine is created."""
+    if _engine is None:
+        return {'size': 0, 'checked_out': 0, 'checked_in': 0, 'overflow': 0, 'max_overflow': DB_MAX_OVERFLOW}
+    return get_pool_stats(_engine.pool)
+
+
+register_collector(PoolCollector(get_db_pool_stats))
+
+
 def create_database() -> None:
-    """Create the database schema and tables if they do not exist."""
+    """Create the database schema and tables if they do not exist. Run through migrate.py."""
+    engine = get_engine()
     with engine.connect() as connection:
         connection.execute(CreateSchema(DB_SCHEMA, if_not_exists=True))
         connection.commit()
@@ -1,326 +1,639 @@
+import json
 import logging
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass, asdict
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
-from utils.config import DELTA_URL, DELTA_AUTH_URL, DELTA_REALM, DELTA_CLIENT_ID, DELTA_CLIENT_SECRET
-from utils.api_requests import APIClient
-from models import Log
+from utils.config import DELTA_URL, DELTA_AUTH_URL, DELTA_REALM, DELTA_CLIENT_ID, DELTA_CLIENT_SECRET, CPR_BATCH_SIZE, SEARCH_CONCURRENCY, SEARCH_TIMEOUT, DELTA_POOL_SIZE, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEARCH_CACHE_NEGATIVE_TTL, SHARED_CACHE_MEMORY_TTL, DELTA_CONNECT_TIMEOUT, DELTA_READ_TIMEOUT, DELTA_MAX_RETRIES, DELTA_BACKOFF_FACTOR, DELTA_BACKOFF_MAX, DELTA_CIRCUIT_FAILURES, DELTA_CIRCUIT_RESET, DELTA_RATE_LIMIT, DELTA_RATE_BURST
+from utils.api_requests import APIClient, CircuitBreaker, TokenBucket
+from utils.cache import TieredCache, SingleFlight
+from utils.utils import hash_cpr
+from utils.metrics import SEARCH_PARSE_SECONDS, SEARCH_BATCH_SIZE, SEARCH_COALESCED, DELTA_ERRORS, CacheCollector, register_collector
+from models import Employee
+from audit import audit_log, SEARCH_TYPE_CPR, SEARCH_TYPE_CPR_BATCH
 
 logger = logging.getLogger(__name__)
 
+NOT_FOUND = 'IKKE_FUNDET'
+ENGAGEMENTS_PER_PERSON = 5  # Raises the limit of batch queries, as a person can have more than one active engagement
+DQ_ALIAS = 'employee.person.user.$userKey'
+CPR_ALIAS = 'employee.person.$userKey'
 
-delta_client = APIClient(DELTA_URL, auth_url=DELTA_AUTH_URL, realm=DELTA_REALM, client_id=DELTA_CLIENT_ID, client_secret=DELTA_CLIENT_SECRET)
 
+@dataclass(slots=True)
+class Person:
+    name: str = '-'
+    email: str = '-'
+    phone: str = '-'
+    mobile: str = '-'
+    department: str = '-'
+    dq_number: str = '-'
 
-def search(search_dict: dict | None = None, user: dict | None = None) -> list[dict] | None:
+
+delta_client = APIClient(
+    DELTA_URL, auth_url=DELTA_AUTH_URL, realm=DELTA_REALM, client_id=DELTA_CLIENT_ID, client_secret=DELTA_CLIENT_SECRET, pool_size=DELTA_POOL_SIZE, background_refresh=True,
+    connect_timeout=DELTA_CONNECT_TIMEOUT, read_timeout=DELTA_READ_TIMEOUT, max_retries=DELTA_MAX_RETRIES, backoff_factor=DELTA_BACKOFF_FACTOR, backoff_max=DELTA_BACKOFF_MAX,
+    circuit_breaker=CircuitBreaker(DELTA_CIRCUIT_FAILURES, DELTA_CIRCUIT_RESET), rate_limiter=TokenBucket(DELTA_RATE_LIMIT, DELTA_RATE_BURST) if DELTA_RATE_LIMIT > 0 else None
+)
+search_cache = TieredCache(max_entries=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL, negative_ttl=SEARCH_CACHE_NEGATIVE_TTL, memory_ttl=SHARED_CACHE_MEMORY_TTL)
+register_collector(CacheCollector('search', search_cache))
+search_flight = SingleFlight()
+
+
+def use_shared_cache(session_factory: Callable[[], Session]) -> None:
+    """
+    Share search results and the Delta access token with the other replicas through the cache_entry table, see shared_cache.py.
+    Search results are still kept in memory for SHARED_CACHE_MEMORY_TTL seconds.
+
+    :param session_factory: Function returning a new database session, e.g. database.get_session
+    """
+    from shared_cache import PostgresCache
+
+    search_cache.shared = PostgresCache(session_factory, 'search', ttl=SEARCH_CACHE_TTL, negative_ttl=SEARCH_CACHE_NEGATIVE_TTL, dumps=_dump_people, loads=_load_people)
+    delta_client.token_cache = PostgresCache(session_factory, 'token')
+
+
+def _dump_people(people: list[Person] | None) -> str:
+    return json.dumps([asdict(person) for person in people] if people is not None else None)
+
+
+def _load_people(data: bytes) -> list[Person] | None:
+    people = json.loads(data)
+    return [Person(**person) for person in people] if people is not None else None
+
+
+_STRUCTURE = {
+    "alias": "employee",
+    "userKey": "APOS-Types-Engagement",
+    "attributes": [
+        {
+            "alias": "email",
+            "userKey": "APOS-Types-Engagement-Attribute-Email"
+        },
+        {
+            "alias": "phone",
+            "userKey": "APOS-Types-Engagement-Attribute-Phone"
+        },
+        {
+            "alias": "mobile",
+            "userKey": "APOS-Types-Engagement-Attribute-Mobile"
+        }
+    ],
+    "relations": [
+        {
+            "alias": "person",
+            "title": "APOS-Types-Engagement-TypeRelation-Person",
+            "userKey": "APOS-Types-Engagement-TypeRelation-Person",
+            "typeUserKey": "APOS-Types-Person",
+            "direction": "OUT",
+            "relations": [
+                {
+                    "alias": "user",
+                    "userKey": "APOS-Types-User-TypeRelation-Person",
+                    "typeUserKey": "APOS-Types-User",
+                    "direction": "IN"
+                }
+            ]
+        },
+        {
+            "alias": "unit",
+            "title": "APOS-Types-Engagement-TypeRelation-AdmUnit",
+            "userKey": "APOS-Types-Engagement-TypeRelation-AdmUnit",
+            "typeUserKey": "APOS-Types-AdministrativeUnit",
+            "direction": "OUT"
+        }
+    ]
+}
+
+_STATE_CRITERIA = {
+    "type": "MATCH",
+    "operator": "EQUAL",
+    "left": {
+        "source": "DEFINITION",
+        "alias": "employee.$state"
+    },
+    "right": {
+        "source": "STATIC",
+        "value": "STATE_ACTIVE"
+    }
+}
+
+_MATCH_TEMPLATE = '{"type": "MATCH", "operator": "EQUAL", "left": {"source": "DEFINITION", "alias": %s}, "right": {"source": "STATIC", "value": %s}}'
+_MATCH_PLACEHOLDER = '$match'
+_PAGE_PLACEHOLDER = '$page'
+
+
+def _get_projection(person_identity: bool = False) -> dict:
+    person_projection = {
+        "state": True,
+        "attributes": [
+            "APOS-Types-Person-Attribute-SurnameAndName"
+        ],
+        "incomingTypeRelations": [
+            {
+                "userKey": "APOS-Types-User-TypeRelation-Person",
+                "projection": {
+                    "identity": True
+                }
+            }
+        ]
+    }
+
+    if person_identity:
+        person_projection = {"identity": True} | person_projection
+
+    return {
+        "identity": True,
+        "state": True,
+        "attributes": [
+            "APOS-Types-Engagement-Attribute-Mobile",
+            "APOS-Types-Engagement-Attribute-Phone",
+            "APOS-Types-Engagement-Attribute-Email"
+        ],
+        "typeRelations": [
+            {
+                "userKey": "APOS-Types-Engagement-TypeRelation-Person",
+                "projection": person_projection
+            },
+            {
+                "userKey": "APOS-Types-Engagement-TypeRelation-AdmUnit",
+                "projection": {
+                    "identity": True
+                }
+            }
+        ]
+    }
+
+
+def _compile_template(person_identity: bool = False) -> tuple[str, str, str]:
+    """
+    Serialize the static part of a graph query once. The result is split around the match criteria and the paging,
+    which are the only parts that differ between queries.
+
+    :param person_identity: Whether to project the person identity, which holds the CPR number
+    :return: A tuple of JSON fragments (before match criteria, between match criteria and paging, after paging)
+    """
+    query = {
+        "graphQueries": [
+            {
+                "computeAvailablePages": False,
+                "graphQuery": {
+                    "structure": _STRUCTURE,
+                    "criteria": {
+                        "type": "AND",
+                        "criteria": [_MATCH_PLACEHOLDER, _STATE_CRITERIA]
+                    },
+                    "projection": _get_projection(person_identity)
+                },
+                "validDate": "NOW",
+                _PAGE_PLACEHOLDER: None
+            }
+        ]
+    }
+    prefix, rest = json.dumps(query).split(json.dumps(_MATCH_PLACEHOLDER) + ', ')
+    middle, suffix = rest.split(json.dumps(_PAGE_PLACEHOLDER) + ': null')
+    return prefix, middle, suffix
+
+
+_TEMPLATES = {
+    False: _compile_template(False),
+    True: _compile_template(True)
+}
+
+
+class GraphQuery:
+    """
+    A graph query for active engagements in Delta, optionally matching one or more values of an alias.
+    The request body is spliced together from a pre-serialized template, so only the match criteria and paging are encoded per query.
+    """
+    __slots__ = ('alias', 'values', 'limit', 'offset', 'person_identity')
+
+    def __init__(self, alias: str | None = None, values: list[str] | None = None, limit: int = 1, offset: int | None = None, person_identity: bool = False):
+        self.alias = alias
+        self.values = values or []
+        self.limit = limit
+        self.offset = offset
+        self.person_identity = person_identity
+
+    def __repr__(self):
+        return f'GraphQuery(alias={self.alias!r}, values={len(self.values)}, limit={self.limit}, offset={self.offset})'
+
+    @property
+    def body(self) -> bytes:
+        prefix, middle, suffix = _TEMPLATES[self.person_identity]
+
+        if not self.values:
+            match = ''
+        elif len(self.values) == 1:
+            match = _MATCH_TEMPLATE % (json.dumps(self.alias), json.dumps(self.values[0])) + ', '
+        else:
+            alias = json.dumps(self.alias)
+            match = '{"type": "OR", "criteria": [' + ', '.join(_MATCH_TEMPLATE % (alias, json.dumps(value)) for value in self.values) + ']}, '
+
+        if self.offset is None:
+            page = f'"limit": {int(self.limit)}'
+        else:
+            page = f'"offset": {int(self.offset)}, "limit": {int(self.limit)}'
+
+        return f'{prefix}{match}{middle}{page}{suffix}'.encode()
+
+    def to_dict(self) -> dict:
+        return json.loads(self.body)
+
+
+def search(query: GraphQuery | None = None, user: dict | None = None, db_session: Session | None = None, timeout: float | None = SEARCH_TIMEOUT) -> list[Person] | None:
+    """
+    Search for persons in Delta based on the provided graph query.
+    Results are cached by the searched DQ or CPR number. On a cache miss the local employee directory is tried first,
+    if a database session is given, and Delta is only queried if the person is not in the directory.
+    Identical searches running at the same time, e.g. from different Streamlit sessions, share one lookup and its result.
+
+    :param query: Graph query for Delta. Generated via get_cpr_search or get_dq_number_search
+    :param user: User information dictionary containing 'username' and 'email' keys
+    :param db_session: Optional database session used to look up the local employee directory
+    :param timeout: Seconds to wait for Delta before giving up
+    :return: A list of persons (name, email, phone, mobile, department, DQ-number) or None if no results found
+    """
+    if user:
+        if query:
+            key = get_cache_key(query)
+            if not key:
+                return _search(query, db_session, timeout)
+
+            # The single flight coalesces searches in this process, the lease of the shared cache searches across replicas
+            people, shared = search_flight.do(key, lambda: search_cache.get_or_load(key, lambda: _search(query, db_session, timeout)))
+            if shared:
+                SEARCH_COALESCED.inc()
+            return people
+
+
+def _search(query: GraphQuery, db_session: Session | None = None, timeout: float | None = SEARCH_TIMEOUT) -> list[Person] | None:
+    if db_session:
+        people = search_directory(db_session, query)
+        if people:
+            return people
+
+    res = _post_query(query, timeout)
+
+    if res:
+        res = res.get('graphQueryResult', [])
+    else:
+        DELTA_ERRORS.labels('no_response').inc()
+        raise ValueError('Intet svar fra Delta')
+
+    if len(res) > 0:
+        instances = res[0].get('instances', [])
+        if len(instances) < 1:
+            return None
+        else:
+            with SEARCH_PARSE_SECONDS.time():
+                return list(parse_people(instances))
+
+
+def get_cache_key(query: GraphQuery) -> str | None:
+    """
+    Get the search cache key for a graph query. CPR numbers are hashed, so the cache never holds a raw CPR number.
+
+    :param query: Graph query for Delta. Generated via get_cpr_search or get_dq_number_search
+    :return: The cache key or None if the search can not be cached
+    """
+    if len(query.values) != 1:
+        return None
+
+    if query.alias == DQ_ALIAS:
+        return f'dq:{query.values[0]}:{query.limit}'
+    elif query.alias == CPR_ALIAS:
+        return _get_cpr_cache_key(query.values[0], query.limit)
+
+
+def _get_cpr_cache_key(cpr: str, limit: int = 1) -> str:
+    return f'cpr:{hash_cpr(cpr.strip())}:{limit}'
+
+
+def parse_instance(instance: dict) -> tuple[Person, str | None, str | None]:
+    """
+    Parse a single engagement instance from a Delta graph query result.
+    Attributes and type relations are indexed by user key in a single pass over each list.
+
+    :param instance: An instance from the graph query result
+    :return: A tuple of (person, engagement uuid, person user key). The person user key is the CPR number, if the person identity is projected
+    """
+    attributes = {}
+    for item in instance.get('attributes') or ():
+        attributes.setdefault(item.get('userKey'), item.get('value'))
+
+    relations = {}
+    for item in instance.get('typeRefs') or ():
+        relations.setdefault(item.get('userKey'), item.get('targetObject') or {})
+
+    person = relations.get('APOS-Types-Engagement-TypeRelation-Person', {})
+    unit = relations.get('APOS-Types-Engagement-TypeRelation-AdmUnit', {})
+
+    names = person.get('attributes') or ({},)
+    users = person.get('inTypeRefs')
+    user = (users[0].get('targetObject') or {}).get('identity', {}).get('name') if users else None
+
+    return Person(
+        name=names[0].get('value') or '-',
+        email=attributes.get('APOS-Types-Engagement-Attribute-Email') or '-',
+        phone=attributes.get('APOS-Types-Engagement-Attribute-Phone') or '-',
+        mobile=attributes.get('APOS-Types-Engagement-Attribute-Mobile') or '-',
+        department=unit.get('identity', {}).get('name') or '-',
+        dq_number=user or '-'
+    ), instance.get('identity', {}).get('uuid'), person.get('identity', {}).get('userKey')
+
+
+def parse_people(instances: Iterable[dict]) -> Iterator[Person]:
+    """
+    Parse the instances of a Delta graph query result one at a time.
+
+    :param instances: Instances from the graph query result
+    :return: A generator of persons, in the same order as the instances
+    """
+    for instance in instances:
+        yield parse_instance(instance)[0]
+
+
+def search_directory(db_session: Session, query: GraphQuery) -> list[Person] | None:
+    """
+    Search for persons in the local employee directory based on the provided graph query.
+
+    :param db_session: Database session
+    :param query: Graph query for Delta. Generated via get_cpr_search or get_dq_number_search
+    :return: A list of persons or None if not found or the directory is unavailable
+    """
+    if len(query.values) != 1:
+        return None
+
+    if query.alias == DQ_ALIAS:
+        criteria = Employee.dq_number == query.values[0]
+    elif query.alias == CPR_ALIAS:
+        criteria = Employee.cpr_hash == hash_cpr(query.values[0])
+    else:
+        return None
+
+    try:
+        employees = db_session.query(Employee).filter(criteria).limit(query.limit).all()
+    except SQLAlchemyError as e:
+        logger.warning(f'Employee directory lookup failed, falling back to Delta: {e}')
+        db_session.rollback()
+        return None
+
+    if employees:
+        return [employee_to_person(e) for e in employees]
+
+
+def search_directory_batch(db_session: Session, cpr_list: list[str]) -> dict[str, Person]:
+    """
+    Search for multiple CPR numbers in the local employee directory with a single query.
+
+    :param db_session: Database session
+    :param cpr_list: CPR numbers to search for
+    :return: A dictionary mapping found CPR numbers to persons. Empty if none are found or the directory is unavailable
+    """
+    hashes = {hash_cpr(cpr): cpr for cpr in cpr_list}
+
+    try:
+        employees = db_session.query(Employee).filter(Employee.cpr_hash.in_(hashes.keys())).all()
+    except SQLAlchemyError as e:
+        logger.warning(f'Employee directory lookup failed, falling back to Delta: {e}')
+        db_session.rollback()
+        return {}
+
+    people = {}
+    for e in employees:
+        people.setdefault(hashes[e.cpr_hash], employee_to_person(e))
+    return people
+
+
+def employee_to_person(employee: Employee) -> Person:
+    """Convert a row of the local employee directory to a person, like the ones parsed from Delta."""
+    return Person(
+        name=employee.name,
+        email=employee.email,
+        phone=employee.phone,
+        mobile=employee.mobile,
+        department=employee.department,
+        dq_number=employee.dq_number
+    )
+
+
+def search_batch(queries: list[GraphQuery] | None = None, user: dict | None = None, db_session: Session | None = None, max_workers: int = SEARCH_CONCURRENCY, timeout: float | None = SEARCH_TIMEOUT) -> list[Person | None] | None:
+    """
+    Search for multiple persons by CPR number, sending one graph query to Delta per chunk instead of one per CPR number.
+    Each CPR number is looked up in the search cache first. If a database session is given, the local employee directory
+    is tried next and only the remaining misses are sent to Delta. Chunks are sent to Delta concurrently.
+
+    :param queries: Batch graph queries for Delta. Generated via get_cpr_batch_search
+    :param user: User information dictionary containing 'username' and 'email' keys
+    :param db_session: Optional database session used to look up the local employee directory
+    :param max_workers: Maximum number of concurrent requests to Delta
+    :param timeout: Seconds to wait for Delta before giving up, per request
+    :return: A list with a person or None for each searched CPR number, in the order they were searched
+    """
+    if user:
+        if queries:
+            chunks = [query.values for query in queries]
+            cpr_list = [cpr for chunk in chunks for cpr in chunk]
+            SEARCH_BATCH_SIZE.observe(len(cpr_list))
+
+            keys = {_get_cpr_cache_key(cpr): cpr for cpr in dict.fromkeys(cpr_list)}
+            found = {keys[key]: people[0] if people else None for key, people in search_cache.get_many(keys).items()}
+
+            uncached = [cpr for cpr in dict.fromkeys(cpr_list) if cpr not in found]
+
+            if db_session and uncached:
+                found |= search_directory_batch(db_session, uncached)
+            missing = [[cpr for cpr in dict.fromkeys(chunk) if cpr not in found] for chunk in chunks]
+
+            for people in run_concurrent(lambda chunk: _search_cpr_chunk(chunk, timeout), [chunk for chunk in missing if chunk], max_workers):
+                found |= people
+
+            search_cache.set_many({_get_cpr_cache_key(cpr): [found[cpr]] if found.get(cpr) else None for cpr in uncached})
+
+            return [found.get(cpr) for cpr in cpr_list]
+
+
+def search_concurrent(queries: list[GraphQuery] | None = None, user: dict | None = None, session_factory: Callable[[], Session] | None = None, max_workers: int = SEARCH_CONCURRENCY, timeout: float | None = SEARCH_TIMEOUT) -> list[list[Person] | None] | None:
     """
-    Search for persons in Delta based on the provided search dictionary.
+    Run search for each graph query on a bounded thread pool. Used for lookups that can not be batched into one graph query, e.g. mixed DQ and CPR numbers.
 
-    :param search_dict: All search parameters for Delta graph query. Generated via get_cpr_search or get_dq_number_search
+    :param queries: Graph queries for Delta. Generated via get_cpr_search or get_dq_number_search
     :param user: User information dictionary containing 'username' and 'email' keys
-    :return: A list of dictionaries with person information (name, email, phone, mobile, department, DQ-number) or None if no results found
+    :param session_factory: Optional function returning a new database session, e.g. database.get_session. Each search gets its own session, as sessions are not thread safe
+    :param max_workers: Maximum number of concurrent searches
+    :param timeout: Seconds to wait for Delta before giving up, per request
+    :return: A list with the result of search for each graph query, in the same order
     """
     if user:
-        if search_dict:
-            res = delta_client.make_request(method='POST', path='api/object/graph-query', json=search_dict)
+        if queries:
+            def run(query):
+                if session_factory:
+                    with session_factory() as db_session:
+                        return search(query, user, db_session, timeout)
+                return search(query, user, timeout=timeout)
 
-            if res:
-                res = res.get('graphQueryResult', [])
-            else:
-                raise ValueError('Intet svar fra Delta')
+            return run_concurrent(run, queries, max_workers)
 
-            if len(res) > 0:
-                instances = res[0].get('instances', [])
-                if len(instances) < 1:
-                    return None
-                else:
-                    people = []
-                    for e in instances:
-                        attributes = e.get('attributes', [])
 
-                        email = next((item.get('value', '-') for item in attributes if item['userKey'] == 'APOS-Types-Engagement-Attribute-Email'), '-')
-                        mobile = next((item.get('value', '-') for item in attributes if item['userKey'] == 'APOS-Types-Engagement-Attribute-Mobile'), '-')
-                        phone = next((item.get('value', '-') for item in attributes if item['userKey'] == 'APOS-Types-Engagement-Attribute-Phone'), '-')
+def run_concurrent(function: Callable, items: list, max_workers: int = SEARCH_CONCURRENCY) -> list:
+    """
+    Call function for each item on a bounded thread pool. If a call fails, the remaining calls are cancelled and the exception is raised.
 
-                        relations = e.get('typeRefs', [])
-                        department = next((item.get('targetObject', {}).get('identity', {}).get('name', '-') for item in relations if item['userKey'] == 'APOS-Types-Engagement-TypeRelation-AdmUnit'), '-')
-                        name = next((item.get('targetObject', {}).get('attributes', [{}])[0].get('value', '-') for item in relations if item['userKey'] == 'APOS-Types-Engagement-TypeRelation-Person'), '-')
+    :param function: Function taking a single item
+    :param items: Items to call function with
+    :param max_workers: Maximum number of concurrent calls
+    :return: A list with the result for each item, in the same order as items
+    """
+    if len(items) < 2 or max_workers < 2:
+        return [function(item) for item in items]
 
-                        incoming_type_relations = next((item.get('targetObject', {}).get('inTypeRefs', None) for item in relations if item['userKey'] == 'APOS-Types-Engagement-TypeRelation-Person'), None)
-                        if incoming_type_relations:
-                            user = incoming_type_relations[0].get('targetObject', {}).get('identity', {}).get('name', '-')
-                        else:
-                            user = '-'
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items)), thread_name_prefix='delta-search') as executor:
+        futures = [executor.submit(function, item) for item in items]
+        try:
+            return [future.result() for future in futures]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
 
-                        person = {
-                            'Navn': name,
-                            'E-mail': email,
-                            'Telefon': phone,
-                            'Mobil': mobile,
-                            'Afdeling': department,
-                            'DQ-nummer': user
-                        }
 
-                        for key, value in person.items():
-                            if not value:
-                                person[key] = '-'
+def _search_cpr_chunk(cpr_list: list[str], timeout: float | None = SEARCH_TIMEOUT) -> dict[str, Person]:
+    """
+    Send a single graph query to Delta for a chunk of CPR numbers and map the returned instances back to the CPR numbers.
+    If Delta truncated the result, CPR numbers not in the result are searched one at a time.
+
+    :param cpr_list: Unique CPR numbers to search for
+    :param timeout: Seconds to wait for Delta before giving up, per request
+    :return: A dictionary mapping found CPR numbers to persons
+    """
+    query = _get_cpr_batch_query(cpr_list)
+    instances = get_instances(query, timeout)
+
+    people = {}
+    with SEARCH_PARSE_SECONDS.time():
+        for e in instances:
+            person, _, cpr = parse_instance(e)
+            if cpr:
+                people.setdefault(cpr.replace('-', ''), person)
+
+    if len(instances) >= query.limit:
+        for cpr in cpr_list:
+            if cpr not in people:
+                instances = get_instances(_get_cpr_batch_query([cpr]), timeout)
+                if instances:
+                    people[cpr] = parse_instance(instances[0])[0]
+
+    return people
 
-                        people.append(person)
 
-                    return people
+def _post_query(query: GraphQuery, timeout: float | None = SEARCH_TIMEOUT) -> dict | None:
+    # Graph queries only read, so they are safe to retry
+    return delta_client.make_request(method='POST', path='api/object/graph-query', data=query.body, headers={'Content-Type': 'application/json'}, timeout=timeout, idempotent=True)
 
 
-def get_cpr_search(db_session: Session, cpr: str, user: dict | None = None, has_cpr_rights: bool = False) -> dict | None:
+def get_instances(query: GraphQuery, timeout: float | None = SEARCH_TIMEOUT) -> list[dict]:
     """
-    Generate a search dictionary for querying Delta by CPR number. Logs the search action in the database.
+    Send a graph query to Delta and return the instances of the first result.
+
+    :param query: Graph query for Delta
+    :param timeout: Seconds to wait for Delta before giving up
+    :return: A list of instances, empty if nothing was found
+    """
+    res = _post_query(query, timeout)
+
+    if res:
+        res = res.get('graphQueryResult', [])
+    else:
+        DELTA_ERRORS.labels('no_response').inc()
+        raise ValueError('Intet svar fra Delta')
+
+    return res[0].get('instances', []) if res else []
+
+
+def get_emails(people: list[Person | None]) -> list[str]:
+    """
+    Get the e-mail of each person in a batch search result. Persons not found or without a user are marked as IKKE_FUNDET.
+
+    :param people: Result of search_batch
+    :return: A list of e-mails in the same order as the search result
+    """
+    return [p.email if p and p.dq_number != '-' else NOT_FOUND for p in people]
+
+
+def get_cpr_search(cpr: str, user: dict | None = None, has_cpr_rights: bool = False) -> GraphQuery | None:
+    """
+    Generate a graph query for searching Delta by CPR number. Logs the search action via the audit log writer.
 
     :param cpr: CPR number to search for
     :param user: User information dictionary containing 'username' and 'email' keys
     :param has_cpr_rights: Indicates if the user has rights to search by CPR number
-    :return: A dictionary containing the search query if user and has_cpr_rights are provided, otherwise None.
+    :return: A graph query if user and has_cpr_rights are provided, otherwise None.
     """
     if user and has_cpr_rights:
-        search_log = Log(username=user["username"], email=user["email"], message=f"Searched for cpr: {cpr}")
-        db_session.add(search_log)
-        return {
-            "graphQueries": [
-                {
-                    "computeAvailablePages": False,
-                    "graphQuery": {
-                        "structure": {
-                            "alias": "employee",
-                            "userKey": "APOS-Types-Engagement",
-                            "attributes": [
-                                {
-                                    "alias": "email",
-                                    "userKey": "APOS-Types-Engagement-Attribute-Email"
-                                },
-                                {
-                                    "alias": "phone",
-                                    "userKey": "APOS-Types-Engagement-Attribute-Phone"
-                                },
-                                {
-                                    "alias": "mobile",
-                                    "userKey": "APOS-Types-Engagement-Attribute-Mobile"
-                                }
-                            ],
-                            "relations": [
-                                {
-                                    "alias": "person",
-                                    "title": "APOS-Types-Engagement-TypeRelation-Person",
-                                    "userKey": "APOS-Types-Engagement-TypeRelation-Person",
-                                    "typeUserKey": "APOS-Types-Person",
-                                    "direction": "OUT",
-                                    "relations": [
-                                        {
-                                            "alias": "user",
-                                            "userKey": "APOS-Types-User-TypeRelation-Person",
-                                            "typeUserKey": "APOS-Types-User",
-                                            "direction": "IN"
-                                        }
-                                    ]
-                                },
-                                {
-                                    "alias": "unit",
-                                    "title": "APOS-Types-Engagement-TypeRelation-AdmUnit",
-                                    "userKey": "APOS-Types-Engagement-TypeRelation-AdmUnit",
-                                    "typeUserKey": "APOS-Types-AdministrativeUnit",
-                                    "direction": "OUT"
-                                }
-                            ]
-                        },
-                        "criteria": {
-                            "type": "AND",
-                            "criteria": [
-                                {
-                                    "type": "MATCH",
-                                    "operator": "EQUAL",
-                                    "left": {
-                                        "source": "DEFINITION",
-                                        "alias": "employee.person.$userKey"
-                                    },
-                                    "right": {
-                                        "source": "STATIC",
-                                        "value": cpr
-                                    }
-                                },
-                                {
-                                    "type": "MATCH",
-                                    "operator": "EQUAL",
-                                    "left": {
-                                        "source": "DEFINITION",
-                                        "alias": "employee.$state"
-                                    },
-                                    "right": {
-                                        "source": "STATIC",
-                                        "value": "STATE_ACTIVE"
-                                    }
-                                }
-                            ]
-                        },
-                        "projection": {
-                            "identity": True,
-                            "state": True,
-                            "attributes": [
-                                "APOS-Types-Engagement-Attribute-Mobile",
-                                "APOS-Types-Engagement-Attribute-Phone",
-                                "APOS-Types-Engagement-Attribute-Email"
-                            ],
-                            "typeRelations": [
-                                {
-                                    "userKey": "APOS-Types-Engagement-TypeRelation-Person",
-                                    "projection": {
-                                        "state": True,
-                                        "attributes": [
-                                            "APOS-Types-Person-Attribute-SurnameAndName"
-                                        ],
-                                        "incomingTypeRelations": [
-                                            {
-                                                "userKey": "APOS-Types-User-TypeRelation-Person",
-                                                "projection": {
-                                                    "identity": True
-                                                }
-                                            }
-                                        ]
-                                    }
-                                },
-                                {
-                                    "userKey": "APOS-Types-Engagement-TypeRelation-AdmUnit",
-                                    "projection": {
-                                        "identity": True
-                                    }
-                                }
-                            ]
-                        }
-                    },
-                    "validDate": "NOW",
-                    "limit": 1
-                }
-            ]
-        }
+        audit_log.log(user["username"], user["email"], SEARCH_TYPE_CPR, hash_cpr(cpr.strip()))
+        return GraphQuery(CPR_ALIAS, [cpr])
+
+
+def get_cpr_batch_search(cpr_list: list[str], user: dict | None = None, has_cpr_rights: bool = False, chunk_size: int = CPR_BATCH_SIZE, log: bool = True) -> list[GraphQuery] | None:
+    """
+    Generate graph queries for searching Delta by multiple CPR numbers, one per chunk. Logs each searched CPR number via the audit log writer.
+
+    :param cpr_list: CPR numbers to search for
+    :param user: User information dictionary containing 'username' and 'email' keys
+    :param has_cpr_rights: Indicates if the user has rights to search by CPR number
+    :param chunk_size: Maximum number of CPR numbers in each graph query
+    :param log: Log the searches. Callers that pass False must call log_cpr_batch_search themselves
+    :return: A list of graph queries if user and has_cpr_rights are provided, otherwise None.
+    """
+    if user and has_cpr_rights:
+        cpr_list = [cpr.replace('-', '') for cpr in cpr_list]
+        if log:
+            log_cpr_batch_search(cpr_list, user)
+        return [_get_cpr_batch_query(cpr_list[i:i + chunk_size]) for i in range(0, len(cpr_list), chunk_size)]
 
 
-def get_dq_number_search(dq_number: str, user: dict | None = None) -> dict | None:
+def log_cpr_batch_search(cpr_list: list[str], user: dict) -> None:
     """
-    Generate a search dictionary for querying Delta by DQ number. Logs the search action in the database.
+    Log a search for multiple CPR numbers via the audit log writer.
 
-    :param dq_number: DQ number to search for
+    :param cpr_list: Searched CPR numbers
     :param user: User information dictionary containing 'username' and 'email' keys
-    :return: A search dictionary for querying Delta by DQ number if user is provided, otherwise None.
+    """
+    audit_log.log_many([(user["username"], user["email"], SEARCH_TYPE_CPR_BATCH, hash_cpr(cpr.replace('-', ''))) for cpr in cpr_list])
+
+
+def _get_cpr_batch_query(cpr_list: list[str]) -> GraphQuery:
+    """
+    Generate a graph query matching any of the given CPR numbers. The person identity is projected so results can be mapped back to the CPR numbers.
+
+    :param cpr_list: CPR numbers to search for
+    :return: A graph query for searching Delta by multiple CPR numbers
+    """
+    return GraphQuery(CPR_ALIAS, cpr_list, limit=len(set(cpr_list)) * ENGAGEMENTS_PER_PERSON, person_identity=True)
+
+
+def get_dq_number_search(dq_number: str, user: dict | None = None) -> GraphQuery | None:
+    """
+    Generate a graph query for searching Delta by DQ number.
+
+    :param dq_number: DQ number to search for, surrounding whitespace is removed
+    :param user: User information dictionary containing 'username' and 'email' keys
+    :return: A graph query if user is provided, otherwise None.
     """
     if user:
-        return {
-            "graphQueries": [
-                {
-                    "computeAvailablePages": False,
-                    "graphQuery": {
-                        "structure": {
-                            "alias": "employee",
-                            "userKey": "APOS-Types-Engagement",
-                            "attributes": [
-                                {
-                                    "alias": "email",
-                                    "userKey": "APOS-Types-Engagement-Attribute-Email"
-                                },
-                                {
-                                    "alias": "phone",
-                                    "userKey": "APOS-Types-Engagement-Attribute-Phone"
-                                },
-                                {
-                                    "alias": "mobile",
-                                    "userKey": "APOS-Types-Engagement-Attribute-Mobile"
-                                }
-                            ],
-                            "relations": [
-                                {
-                                    "alias": "person",
-                                    "title": "APOS-Types-Engagement-TypeRelation-Person",
-                                    "userKey": "APOS-Types-Engagement-TypeRelation-Person",
-                                    "typeUserKey": "APOS-Types-Person",
-                                    "direction": "OUT",
-                                    "relations": [
-                                        {
-                                            "alias": "user",
-                                            "userKey": "APOS-Types-User-TypeRelation-Person",
-                                            "typeUserKey": "APOS-Types-User",
-                                            "direction": "IN"
-                                        }
-                                    ]
-                                },
-                                {
-                                    "alias": "unit",
-                                    "title": "APOS-Types-Engagement-TypeRelation-AdmUnit",
-                                    "userKey": "APOS-Types-Engagement-TypeRelation-AdmUnit",
-                                    "typeUserKey": "APOS-Types-AdministrativeUnit",
-                                    "direction": "OUT"
-                                }
-                            ]
-                        },
-                        "criteria": {
-                            "type": "AND",
-                            "criteria": [
-                                {
-                                    "type": "MATCH",
-                                    "operator": "EQUAL",
-                                    "left": {
-                                        "source": "DEFINITION",
-                                        "alias": "employee.person.user.$userKey"
-                                    },
-                                    "right": {
-                                        "source": "STATIC",
-                                        "value": dq_number
-                                    }
-                                },
-                                {
-                                    "type": "MATCH",
-                                    "operator": "EQUAL",
-                                    "left": {
-                                        "source": "DEFINITION",
-                                        "alias": "employee.$state"
-                                    },
-                                    "right": {
-                                        "source": "STATIC",
-                                        "value": "STATE_ACTIVE"
-                                    }
-                                }
-                            ]
-                        },
-                        "projection": {
-                            "identity": True,
-                            "state": True,
-                            "attributes": [
-                                "APOS-Types-Engagement-Attribute-Mobile",
-                                "APOS-Types-Engagement-Attribute-Phone",
-                                "APOS-Types-Engagement-Attribute-Email"
-                            ],
-                            "typeRelations": [
-                                {
-                                    "userKey": "APOS-Types-Engagement-TypeRelation-Person",
-                                    "projection": {
-                                        "state": True,
-                                        "attributes": [
-                                            "APOS-Types-Person-Attribute-SurnameAndName"
-                                        ],
-                                        "incomingTypeRelations": [
-                                            {
-                                                "userKey": "APOS-Types-User-TypeRelation-Person",
-                                                "projection": {
-                                                    "identity": True
-                                                }
-                                            }
-                                        ]
-                                    }
-                                },
-                                {
-                                    "userKey": "APOS-Types-Engagement-TypeRelation-AdmUnit",
-                                    "projection": {
-                                        "identity": True
-                                    }
-                                }
-                            ]
-                        }
-                    },
-                    "validDate": "NOW",
-                    "limit": 1
-                }
-            ]
-        }
+        # Stripped once here, so the Delta query, the directory lookup and the cache key all use the same value
+        return GraphQuery(DQ_ALIAS, [dq_number.strip()])
+
+
+def get_directory_search(offset: int = 0, limit: int = 1000) -> GraphQuery:
+    """
+    Generate a graph query for fetching a page of all active engagements from Delta. Used to sync the local employee directory.
+
+    :param offset: Number of engagements to skip
+    :param limit: Maximum number of engagements to return
+    :return: A graph query for a page of active engagements.
+    """
+    return GraphQuery(limit=limit, offset=offset, person_identity=True)
@@ -0,0 +1,244 @@
+import json
+import logging
+from collections.abc import Iterator
+from dataclasses import dataclass
+
+from sqlalchemy import select, insert, delete, func, tuple_
+from sqlalchemy.orm import Session
+
+from delta import Person, get_instances, employee_to_person
+from models import AdmUnit, Employee
+from utils.config import DIRECTORY_PAGE_SIZE, DEPARTMENT_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+UNIT_TYPE = 'APOS-Types-AdministrativeUnit'
+UNIT_PARENT_RELATION = 'APOS-Types-AdministrativeUnit-TypeRelation-Parent'
+ENGAGEMENT_UNIT_RELATION = 'APOS-Types-Engagement-TypeRelation-AdmUnit'
+FETCH_TIMEOUT = 60  # seconds, like the employee directory sync
+WRITE_BATCH_SIZE = 1000
+
+
+class UnitQuery:
+    """A graph query for a page of active AdmUnits in Delta, with the uuid of their parent unit."""
+    __slots__ = ('offset', 'limit')
+
+    def __init__(self, offset: int = 0, limit: int = DIRECTORY_PAGE_SIZE):
+        self.offset = offset
+        self.limit = limit
+
+    def __repr__(self):
+        return f'UnitQuery(offset={self.offset}, limit={self.limit})'
+
+    @property
+    def body(self) -> bytes:
+        return json.dumps({
+            "graphQueries": [
+                {
+                    "computeAvailablePages": False,
+                    "graphQuery": {
+                        "structure": {
+                            "alias": "unit",
+                            "userKey": UNIT_TYPE,
+                            "relations": [
+                                {
+                                    "alias": "parent",
+                                    "title": UNIT_PARENT_RELATION,
+                                    "userKey": UNIT_PARENT_RELATION,
+                                    "typeUserKey": UNIT_TYPE,
+                                    "direction": "OUT"
+                                }
+                            ]
+                        },
+                        "criteria": {
+                            "type": "MATCH",
+                            "operator": "EQUAL",
+                            "left": {"source": "DEFINITION", "alias": "unit.$state"},
+                            "right": {"source": "STATIC", "value": "STATE_ACTIVE"}
+                        },
+                        "projection": {
+                            "identity": True,
+                            "state": True,
+                            "typeRelations": [{"userKey": UNIT_PARENT_RELATION, "projection": {"identity": True}}]
+                        }
+                    },
+                    "validDate": "NOW",
+                    "offset": int(self.offset),
+                    "limit": int(self.limit)
+                }
+            ]
+        }).encode()
+
+
+@dataclass(slots=True)
+class UnitRef:
+    id: str
+    name: str
+    parent_id: str | None
+
+
+def get_unit_id(instance: dict) -> str | None:
+    """Get the AdmUnit uuid of an engagement instance from a Delta graph query result."""
+    for item in instance.get('typeRefs') or ():
+        if item.get('userKey') == ENGAGEMENT_UNIT_RELATION:
+            return ((item.get('targetObject') or {}).get('identity') or {}).get('uuid')
+
+
+def _parse_unit(instance: dict) -> UnitRef | None:
+    identity = instance.get('identity') or {}
+    if not identity.get('uuid'):
+        return None
+
+    parent_id = None
+    for item in instance.get('typeRefs') or ():
+        if item.get('userKey') == UNIT_PARENT_RELATION:
+            parent_id = ((item.get('targetObject') or {}).get('identity') or {}).get('uuid')
+            break
+    return UnitRef(identity['uuid'], identity.get('name') or '-', parent_id)
+
+
+def fetch_units(page_size: int = DIRECTORY_PAGE_SIZE) -> Iterator[UnitRef]:
+    """
+    Fetch all active AdmUnits from Delta, one page at a time.
+
+    :param page_size: Number of units per graph query
+    :return: A generator of units
+    """
+    offset = 0
+    while True:
+        instances = get_instances(UnitQuery(offset, page_size), FETCH_TIMEOUT)
+
+        for instance in instances:
+            unit = _parse_unit(instance)
+            if unit:
+                yield unit
+
+        if len(instances) < page_size:
+            break
+        offset += page_size
+
+
+def build_unit_tree(units: list[UnitRef], employee_counts: dict[str, int]) -> list[dict]:
+    """
+    Precompute the path, depth and counts of every unit, so browsing the tree never has to walk it.
+    Units whose parent is unknown, e.g. inactive, become top level units, and so do units in a parent cycle.
+
+    :param units: All active units
+    :param employee_counts: Number of engagements directly in each unit
+    :return: Rows for the adm_unit table
+    """
+    by_id = {unit.id: unit for unit in units}
+    paths = {}
+
+    for unit in units:
+        chain = []
+        seen = set()
+        current = unit.id
+        while current in by_id and current not in paths and current not in seen:
+            seen.add(current)
+            chain.append(current)
+            current = by_id[current].parent_id
+
+        # Stopped at a unit with a known path, at an unknown parent or where the chain loops back on itself
+        path = paths[current] if current in paths else []
+        for id_ in reversed(chain):
+            path = path + [id_]
+            paths[id_] = path
+
+    child_count = {}
+    total_count = {}
+    for unit in units:
+        path = paths[unit.id]
+        if len(path) > 1:
+            child_count[path[-2]] = child_count.get(path[-2], 0) + 1
+        for ancestor in path:
+            total_count[ancestor] = total_count.get(ancestor, 0) + employee_counts.get(unit.id, 0)
+
+    return [
+        {
+            'id': unit.id,
+            'name': unit.name,
+            'parent_id': paths[unit.id][-2] if len(paths[unit.id]) > 1 else None,
+            'path': '/'.join(paths[unit.id]),
+            'depth': len(paths[unit.id]) - 1,
+            'child_count': child_count.get(unit.id, 0),
+            'employee_count': employee_counts.get(unit.id, 0),
+            'total_count': total_count.get(unit.id, 0)
+        }
+        for unit in units
+    ]
+
+
+def sync_units(db_session: Session) -> int:
+    """
+    Replace the organisation tree with the active units in Delta. Run in the directory sync transaction, after the employees are written,
+    so the counts match the employee table. Readers see the previous tree until the caller commits.
+
+    :param db_session: Database session
+    :return: Number of units
+    """
+    units = list(fetch_units())
+    if not units:
+        logger.warning('Delta returned no active units, keeping existing organisation tree')
+        return 0
+
+    employee_counts = dict(db_session.execute(
+        select(Employee.unit_id, func.count()).where(Employee.unit_id.is_not(None)).group_by(Employee.unit_id)
+    ).all())
+    rows = build_unit_tree(units, employee_counts)
+
+    db_session.execute(delete(AdmUnit))
+    for i in range(0, len(rows), WRITE_BATCH_SIZE):
+        db_session.execute(insert(AdmUnit), rows[i:i + WRITE_BATCH_SIZE])
+    return len(rows)
+
+
+def get_child_units(db_session: Session, parent_id: str | None = None) -> list[AdmUnit]:
+    """
+    Get the units directly below a unit, or the top level units.
+
+    :param db_session: Database session
+    :param parent_id: Uuid of the parent unit, None for the top level units
+    :return: A list of units ordered by name
+    """
+    criteria = AdmUnit.parent_id == parent_id if parent_id else AdmUnit.parent_id.is_(None)
+    return list(db_session.scalars(select(AdmUnit).where(criteria).order_by(AdmUnit.name)))
+
+
+def get_unit_path(db_session: Session, unit_id: str) -> list[AdmUnit]:
+    """
+    Get a unit and the units above it, from the top level unit down, e.g. for breadcrumbs.
+
+    :param db_session: Database session
+    :param unit_id: Uuid of the unit
+    :return: A list of units, empty if the unit does not exist
+    """
+    unit = db_session.get(AdmUnit, unit_id)
+    if not unit:
+        return []
+    ids = unit.path.split('/')
+    units = {u.id: u for u in db_session.scalars(select(AdmUnit).where(AdmUnit.id.in_(ids)))}
+    return [units[id_] for id_ in ids if id_ in units]
+
+
+def get_unit_employees(db_session: Session, unit_id: str, after: tuple[str, str] | None = None, limit: int = DEPARTMENT_PAGE_SIZE) -> tuple[list[Person], tuple[str, str] | None]:
+    """
+    Get a page of the employees in a unit, ordered by name. Pages are found by seeking the (unit_id, name, id) index
+    from the last row of the previous page, so late pages of a large unit are as fast as the first.
+
+    :param db_session: Database session
+    :param unit_id: Uuid of the unit
+    :param after: Cursor returned with the previous page, None for the first page
+    :param limit: Number of employees per page
+    :return: A tuple of (employees, cursor for the next page or None if this is the last page)
+    """
+    stmt = select(Employee).where(Employee.unit_id == unit_id)
+    if after:
+        stmt = stmt.where(tuple_(Employee.name, Employee.id) > tuple_(*after))
+    employees = list(db_session.scalars(stmt.order_by(Employee.name, Employee.id).limit(limit + 1)))
+
+    cursor = None
+    if len(employees) > limit:
+        employees = employees[:limit]
+        cursor = (employees[-1].name, employees[-1].id)
+    return [employee_to_person(e) for e in employees], cursor
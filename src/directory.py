@@ -0,0 +1,207 @@
+import time
+import hashlib
+import logging
+import threading
+
+from sqlalchemy import select, delete, text, func
+from sqlalchemy.dialects.postgresql import insert
+
+from delta import Person, get_directory_search, get_instances, parse_instance, employee_to_person
+from database import get_session
+from departments import get_unit_id, sync_units
+from models import Employee, AdmUnit
+from utils.config import DB_SCHEMA, DIRECTORY_SYNC_INTERVAL, DIRECTORY_PAGE_SIZE, SEARCH_INDEX_REFRESH_INTERVAL
+from utils.utils import hash_cpr
+from utils.search_index import SearchIndex, tokenize, email_tokens, phone_tokens
+
+logger = logging.getLogger(__name__)
+
+SYNC_LOCK_KEY = 730_001  # Postgres advisory lock, makes sure only one replica syncs at a time
+WRITE_BATCH_SIZE = 1000
+FETCH_TIMEOUT = 60  # seconds, pages are much larger than interactive lookups
+
+
+def _get_person_tokens(person: Person) -> list[str]:
+    return tokenize(person.name) + tokenize(person.department) + tokenize(person.dq_number) + email_tokens(person.email) + phone_tokens(person.phone) + phone_tokens(person.mobile)
+
+
+# Name, e-mail, department and phone search over the local employee directory, kept up to date by refresh_search_index
+employee_index = SearchIndex(_get_person_tokens, sort_key=lambda person: person.name)
+
+
+def _get_employee_row(instance: dict) -> dict | None:
+    """
+    Convert an engagement instance from a Delta graph query result to a row in the employee table.
+
+    :param instance: An instance from the graph query result generated via get_directory_search
+    :return: A dictionary with the employee table columns or None if the instance has no identity or person
+    """
+    person, uuid, cpr = parse_instance(instance)
+
+    if not uuid or not cpr:
+        return None
+
+    row = {
+        'id': uuid,
+        'name': person.name,
+        'email': person.email,
+        'phone': person.phone,
+        'mobile': person.mobile,
+        'department': person.department,
+        'unit_id': get_unit_id(instance),
+        'dq_number': person.dq_number,
+        'cpr_hash': hash_cpr(cpr)
+    }
+    row['row_hash'] = hashlib.sha256('|'.join(value or '' for value in row.values()).encode()).hexdigest()
+    return row
+
+
+def prepare_directory() -> None:
+    """Add the department column and index to an employee table created before departments could be browsed. Run before the app starts."""
+    with get_session() as db_session:
+        db_session.execute(text(f'ALTER TABLE {DB_SCHEMA}.{Employee.__tablename__} ADD COLUMN IF NOT EXISTS unit_id VARCHAR'))
+        db_session.execute(text(f'CREATE INDEX IF NOT EXISTS ix_employee_unit_id_name ON {DB_SCHEMA}.{Employee.__tablename__} (unit_id, name, id)'))
+        db_session.commit()
+
+
+def fetch_directory(page_size: int = DIRECTORY_PAGE_SIZE):
+    """
+    Fetch all active engagements from Delta, one page at a time.
+
+    :param page_size: Number of engagements per graph query
+    :return: A generator of rows for the employee table
+    """
+    offset = 0
+    while True:
+        instances = get_instances(get_directory_search(offset, page_size), FETCH_TIMEOUT)
+
+        for instance in instances:
+            row = _get_employee_row(instance)
+            if row:
+                yield row
+
+        if len(instances) < page_size:
+            break
+        offset += page_size
+
+
+def sync_directory(min_age: float = 0) -> tuple[int, int] | None:
+    """
+    Sync the local employee directory with Delta. The first run bulk loads all active engagements,
+    later runs only write rows that have changed and delete engagements that are no longer active.
+
+    :param min_age: Skip the sync if the directory was synced less than this many seconds ago, e.g. by another replica
+    :return: A tuple of (upserted, deleted) row counts or None if another replica is already syncing or synced recently
+    """
+    with get_session() as db_session:
+        if not db_session.execute(text('SELECT pg_try_advisory_xact_lock(:key)'), {'key': SYNC_LOCK_KEY}).scalar():
+            logger.info('Employee directory sync already running on another replica')
+            return None
+
+        if min_age:
+            # The organisation tree is replaced by every sync, so its age is the age of the last sync
+            age = db_session.execute(select(func.extract('epoch', func.now() - func.max(AdmUnit.synced_at)))).scalar()
+            if age is not None and age < min_age:
+                logger.info(f'Employee directory was synced {age:.0f} seconds ago, skipping sync')
+                return None
+
+        existing = dict(db_session.execute(select(Employee.id, Employee.row_hash)).all())
+
+        seen = set()
+        changed = {}
+        for row in fetch_directory():
+            seen.add(row['id'])
+            if existing.get(row['id']) != row['row_hash']:
+                changed[row['id']] = row
+
+        rows = list(changed.values())
+        for i in range(0, len(rows), WRITE_BATCH_SIZE):
+            stmt = insert(Employee).values(rows[i:i + WRITE_BATCH_SIZE])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Employee.id],
+                set_={column: stmt.excluded[column] for column in rows[0] if column != 'id'} | {'synced_at': stmt.excluded.synced_at}
+            )
+            db_session.execute(stmt)
+
+        removed = list(existing.keys() - seen)
+        if removed and not seen:
+            logger.warning('Delta returned no active engagements, keeping existing employee directory')
+            removed = []
+
+        for i in range(0, len(removed), WRITE_BATCH_SIZE):
+            db_session.execute(delete(Employee).where(Employee.id.in_(removed[i:i + WRITE_BATCH_SIZE])))
+
+        units = sync_units(db_session)
+
+        db_session.commit()
+
+    logger.info(f'Employee directory synced: {len(rows)} upserted, {len(removed)} deleted, {units} units')
+    return len(rows), len(removed)
+
+
+def start_directory_sync(interval: int = DIRECTORY_SYNC_INTERVAL) -> threading.Thread:
+    """
+    Start a background thread that syncs the local employee directory with Delta on a schedule. A sync is skipped if another replica
+    synced less than interval seconds ago, so a replica that starts up does not fetch the whole directory while it serves its first lookups.
+
+    :param interval: Seconds between syncs
+    :return: The started daemon thread
+    """
+    def run():
+        while True:
+            try:
+                sync_directory(min_age=interval)
+            except Exception as e:
+                logger.error(f'Employee directory sync failed: {e.__class__} {e}')
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='directory-sync', daemon=True)
+    thread.start()
+    return thread
+
+
+def refresh_search_index(index: SearchIndex = employee_index) -> tuple[int, int]:
+    """
+    Update the search index with the employees that changed since the last refresh. Only the row hashes are read,
+    and full rows only for employees that are new or changed, so a refresh without changes is a single small query.
+
+    :param index: The index to update
+    :return: A tuple of (updated, removed) employee counts
+    """
+    with get_session() as db_session:
+        current = dict(db_session.execute(select(Employee.id, Employee.row_hash)).all())
+        indexed = index.versions()
+
+        changed = [id_ for id_, row_hash in current.items() if indexed.get(id_) != row_hash]
+        removed = indexed.keys() - current.keys()
+
+        documents = {}
+        for i in range(0, len(changed), WRITE_BATCH_SIZE):
+            for employee in db_session.scalars(select(Employee).where(Employee.id.in_(changed[i:i + WRITE_BATCH_SIZE]))):
+                documents[employee.id] = (employee.row_hash, employee_to_person(employee))
+
+    index.update(documents, removed)
+    if documents or removed:
+        logger.info(f'Employee search index refreshed: {len(documents)} updated, {len(removed)} removed, {len(index)} indexed')
+    return len(documents), len(removed)
+
+
+def start_search_index_refresh(interval: int = SEARCH_INDEX_REFRESH_INTERVAL) -> threading.Thread:
+    """
+    Start a background thread that keeps employee_index up to date with the employee table. Every replica keeps its own index,
+    while only one of them syncs the table with Delta.
+
+    :param interval: Seconds between refreshes
+    :return: The started daemon thread
+    """
+    def run():
+        while True:
+            try:
+                refresh_search_index()
+            except Exception as e:
+                logger.error(f'Employee search index refresh failed: {e.__class__} {e}')
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='search-index-refresh', daemon=True)
+    thread.start()
+    return thread
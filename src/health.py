@@ -0,0 +1,153 @@
+import time
+import logging
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from datetime import datetime
+
+from flask import Blueprint, Flask, Response, jsonify
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from sqlalchemy import text
+
+from delta import delta_client
+from utils.config import DELTA_URL, HEALTH_CACHE_SECONDS, HEALTH_PROBE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class HealthCheck:
+    """
+    Runs readiness probes concurrently and caches the result for cache_seconds, so frequent probes from the orchestrator
+    do not turn into load on the database, Delta or the IdP. Only one thread runs the probes at a time, the others get the cached result.
+    A probe that does not finish within timeout seconds fails. If only probes that are not required fail, the status is degraded.
+    """
+    def __init__(self, probes: dict[str, Callable[[], dict | None]], required: set[str] | None = None, cache_seconds: float = HEALTH_CACHE_SECONDS, timeout: float = HEALTH_PROBE_TIMEOUT):
+        self.probes = probes
+        self.required = set(probes) if required is None else required
+        self.cache_seconds = cache_seconds
+        self.timeout = timeout
+
+        self._result = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+        self._running = {}
+
+    def check(self) -> dict:
+        """
+        Get the readiness of all dependencies.
+
+        :return: A dictionary with the overall status (ok, degraded or fail), when the probes ran and the status, latency and details of each probe
+        """
+        if time.monotonic() < self._expires:
+            return self._result | {'cached': True}
+
+        with self._lock:
+            if time.monotonic() >= self._expires:
+                checks = self._run_probes()
+                failed = {name for name, check in checks.items() if check['status'] != 'ok'}
+                self._result = {
+                    'status': 'fail' if failed & self.required else 'degraded' if failed else 'ok',
+                    'checked_at': datetime.now().isoformat(timespec='seconds'),
+                    'checks': checks
+                }
+                self._expires = time.monotonic() + self.cache_seconds
+                return self._result | {'cached': False}
+            return self._result | {'cached': True}
+
+    def _run_probes(self) -> dict[str, dict]:
+        for name, function in self.probes.items():
+            # A probe still hanging from an earlier check is waited for again instead of started twice
+            if name not in self._running or self._running[name].done():
+                self._running[name] = self._start_probe(name, function)
+
+        deadline = time.monotonic() + self.timeout
+        checks = {}
+        for name in self.probes:
+            try:
+                checks[name] = self._running[name].result(max(deadline - time.monotonic(), 0))
+            except FutureTimeoutError:
+                logger.warning(f'Readiness probe {name} did not finish within {self.timeout} seconds')
+                checks[name] = {'status': 'fail', 'latency_ms': round(self.timeout * 1000, 1), 'error': f'Timed out after {self.timeout} seconds'}
+        return checks
+
+    def _start_probe(self, name: str, function: Callable[[], dict | None]) -> Future:
+        # Daemon threads, as a probe that never returns must not keep the process from exiting
+        future = Future()
+        threading.Thread(target=lambda: future.set_result(self._run_probe(name, function)), name=f'health-{name}', daemon=True).start()
+        return future
+
+    def _run_probe(self, name: str, function: Callable[[], dict | None]) -> dict:
+        start = time.perf_counter()
+        try:
+            details = function() or {}
+            result = {'status': 'ok'}
+        except Exception as e:
+            logger.warning(f'Readiness probe {name} failed: {e.__class__} {e}')
+            details = {'error': f'{e.__class__.__name__}: {e}'}
+            result = {'status': 'fail'}
+        result['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+        return result | details
+
+
+def probe_database() -> dict:
+    """Check out a connection from the pool of the database engine and run a trivial query."""
+    from database import get_engine, get_db_pool_stats  # imported on first probe, so the API can be imported without a database connection
+
+    with get_engine().connect() as connection:
+        connection.execute(text('SELECT 1'))
+    stats = get_db_pool_stats()
+    return {'checked_out': stats['checked_out'], 'overflow': stats['overflow']}
+
+
+def probe_token() -> dict:
+    """Make sure delta_client has a valid access token. A new token is only fetched from the IdP if the current one has expired."""
+    delta_client._authenticate()
+    return {'expires_in': round(delta_client.token_expiry - time.time()) if delta_client.token_expiry else None}
+
+
+def probe_delta() -> dict:
+    """Check that Delta answers HTTP requests. Any response below 500 means it is reachable."""
+    response = delta_client.session.get(DELTA_URL, timeout=HEALTH_PROBE_TIMEOUT, allow_redirects=False)
+    if response.status_code >= 500:
+        raise ConnectionError(f'Delta responded with status {response.status_code}')
+    return {'http_status': response.status_code}
+
+
+# Only the database makes a replica unready, without Delta it can still serve the directory and cached searches
+health_check = HealthCheck({'database': probe_database, 'token': probe_token, 'delta': probe_delta}, required={'database'})
+
+monitoring = Blueprint('monitoring', __name__)
+
+
+@monitoring.get('/healthz')
+def liveness():
+    # The process is able to serve requests, dependencies are checked by readiness
+    return jsonify({'status': 'ok'})
+
+
+@monitoring.get('/readyz')
+def readiness():
+    result = health_check.check()
+    return jsonify(result), 503 if result['status'] == 'fail' else 200
+
+
+@monitoring.get('/metrics')
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def start_monitoring_server(port: int) -> threading.Thread:
+    """
+    Serve /healthz, /readyz and /metrics in a background thread, for processes that do not serve them already, like the Streamlit app.
+
+    :param port: Port to listen on
+    :return: The started daemon thread
+    """
+    from waitress import serve
+
+    app = Flask(__name__)
+    app.register_blueprint(monitoring)
+
+    thread = threading.Thread(target=serve, args=(app,), kwargs={'host': '0.0.0.0', 'port': port, 'threads': 2}, name='monitoring-server', daemon=True)
+    thread.start()
+    return thread
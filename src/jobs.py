@@ -0,0 +1,282 @@
+import time
+import logging
+import threading
+from collections.abc import Callable, Iterable, Iterator
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.orm import Session, aliased
+
+from bulk import chunked, lookup_rows
+from delta import log_cpr_batch_search
+from models import BulkJob, BulkJobChunk
+from utils.api_requests import TokenBucket
+from utils.utils import verify_cpr
+from utils.config import POD_NAME, BULK_JOB_WORKERS, BULK_JOB_CHUNK_SIZE, BULK_JOB_LEASE, BULK_JOB_MAX_ATTEMPTS, BULK_JOB_CHUNK_RATE, BULK_JOB_POLL_INTERVAL, BULK_JOB_RETENTION_DAYS
+
+logger = logging.getLogger(__name__)
+
+SUBMITTING = 'submitting'
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+INSERT_BATCH_SIZE = 50  # chunks per INSERT while a job is submitted
+
+# Shared by all workers in the process, keeps background jobs from using up the Delta rate limit needed by interactive lookups
+chunk_rate_limiter = TokenBucket(BULK_JOB_CHUNK_RATE, 1) if BULK_JOB_CHUNK_RATE > 0 else None
+
+
+def submit_job(db_session: Session, rows: Iterable[tuple[int, str]], user: dict, filename: str, chunk_size: int = BULK_JOB_CHUNK_SIZE) -> int:
+    """
+    Persist a bulk lookup as a background job. Rows are streamed into the database one chunk at a time, so the file is never held in memory.
+
+    :param db_session: Database session
+    :param rows: (row number, CPR number) tuples, e.g. from CprFileReader
+    :param user: User information dictionary containing 'username' and 'email' keys
+    :param filename: Name of the uploaded file, shown in the job list
+    :param chunk_size: Number of rows per chunk, the unit of work and checkpointing
+    :return: The id of the job
+    """
+    job = BulkJob(username=user['username'], email=user['email'], filename=filename, status=SUBMITTING)
+    db_session.add(job)
+    db_session.flush()
+
+    total_rows = 0
+    chunk_count = 0
+    for batch in chunked(chunked(rows, chunk_size), INSERT_BATCH_SIZE):
+        db_session.add_all([BulkJobChunk(job_id=job.id, chunk_index=chunk_count + i, rows=chunk) for i, chunk in enumerate(batch)])
+        db_session.flush()
+        db_session.expunge_all()
+        db_session.add(job)
+        total_rows += sum(len(chunk) for chunk in batch)
+        chunk_count += len(batch)
+
+    job.total_rows = total_rows
+    job.chunk_count = chunk_count
+    job.status = QUEUED if chunk_count else DONE
+    job.finished_at = None if chunk_count else datetime.now()
+    db_session.commit()
+
+    logger.info(f'Bulk job {job.id} submitted by {job.username}: {total_rows} rows in {chunk_count} chunks')
+    return job.id
+
+
+def claim_chunk(db_session: Session, worker: str = POD_NAME, lease: int = BULK_JOB_LEASE) -> BulkJobChunk | None:
+    """
+    Claim the next chunk to work on. Only the oldest unfinished job of each user is served, and jobs are served round robin,
+    so one user's big job does not hold up other users. Chunks claimed by a worker that stopped are claimed again when the lease runs out.
+
+    :param db_session: Database session
+    :param worker: Name of the claiming worker
+    :param lease: Seconds a claim is held before another worker may take the chunk
+    :return: The claimed chunk, with its job loaded, or None if there is nothing to do
+    """
+    now = datetime.now()
+    other = aliased(BulkJob)
+    oldest_job = select(func.min(other.id)).where(other.username == BulkJob.username, other.status.in_([QUEUED, RUNNING])).scalar_subquery()
+
+    stmt = (
+        select(BulkJobChunk)
+        .join(BulkJob, BulkJob.id == BulkJobChunk.job_id)
+        .where(
+            BulkJob.status.in_([QUEUED, RUNNING]),
+            BulkJob.id == oldest_job,
+            BulkJobChunk.done_at.is_(None),
+            (BulkJobChunk.claimed_at.is_(None)) | (BulkJobChunk.claimed_at < now - timedelta(seconds=lease))
+        )
+        .order_by(BulkJob.served_at.asc().nulls_first(), BulkJob.id, BulkJobChunk.chunk_index)
+        .limit(1)
+        .with_for_update(of=BulkJobChunk, skip_locked=True)
+    )
+    chunk = db_session.scalars(stmt).first()
+    if not chunk:
+        db_session.rollback()
+        return None
+
+    chunk.claimed_by = worker
+    chunk.claimed_at = now
+    chunk.attempts += 1
+    db_session.execute(update(BulkJob).where(BulkJob.id == chunk.job_id).values(served_at=now, status=RUNNING))
+    db_session.commit()
+    return chunk
+
+
+def complete_chunk(db_session: Session, chunk: BulkJobChunk, results: list[dict]) -> bool:
+    """
+    Checkpoint the results of a chunk and mark the job done when it was the last chunk.
+    The CPR numbers of the chunk are removed, only the results are kept for download.
+
+    :return: True if the chunk was completed, False if another worker completed it first
+    """
+    updated = db_session.execute(
+        update(BulkJobChunk)
+        .where(BulkJobChunk.job_id == chunk.job_id, BulkJobChunk.chunk_index == chunk.chunk_index, BulkJobChunk.done_at.is_(None))
+        .values(results=results, rows=[], done_at=datetime.now())
+    ).rowcount
+    if updated:
+        # Another worker may have finished the chunk after our lease ran out, then it is already counted
+        db_session.execute(
+            update(BulkJob)
+            .where(BulkJob.id == chunk.job_id)
+            .values(rows_done=BulkJob.rows_done + len(results), chunks_done=BulkJob.chunks_done + 1)
+        )
+        db_session.execute(
+            update(BulkJob)
+            .where(BulkJob.id == chunk.job_id, BulkJob.chunks_done >= BulkJob.chunk_count, BulkJob.status != FAILED)
+            .values(status=DONE, finished_at=datetime.now())
+        )
+    db_session.commit()
+    return bool(updated)
+
+
+def fail_chunk(db_session: Session, chunk: BulkJobChunk, error: Exception, max_attempts: int = BULK_JOB_MAX_ATTEMPTS) -> None:
+    """Release a chunk that failed so it is retried, or fail the job after max_attempts."""
+    db_session.execute(
+        update(BulkJobChunk)
+        .where(BulkJobChunk.job_id == chunk.job_id, BulkJobChunk.chunk_index == chunk.chunk_index)
+        .values(claimed_at=None, claimed_by=None)
+    )
+    if chunk.attempts >= max_attempts:
+        # The remaining chunks are never looked up
+        db_session.execute(update(BulkJobChunk).where(BulkJobChunk.job_id == chunk.job_id, BulkJobChunk.done_at.is_(None)).values(rows=[]))
+        db_session.execute(
+            update(BulkJob)
+            .where(BulkJob.id == chunk.job_id)
+            .values(status=FAILED, error=f'{error.__class__.__name__}: {error}', finished_at=datetime.now())
+        )
+    db_session.commit()
+
+
+def process_next_chunk(session_factory: Callable[[], Session], worker: str = POD_NAME) -> bool:
+    """
+    Claim, look up and checkpoint one chunk. The searches are audit logged once the results are committed,
+    so a chunk that fails and is retried is only logged once.
+
+    :param session_factory: Function returning a new database session, e.g. database.get_session
+    :param worker: Name of the worker
+    :return: True if a chunk was processed, False if there was nothing to do
+    """
+    with session_factory() as db_session:
+        chunk = claim_chunk(db_session, worker)
+        if not chunk:
+            return False
+        job = db_session.get(BulkJob, chunk.job_id)
+        user = {'username': job.username, 'email': job.email}
+        rows = [(row_number, cpr) for row_number, cpr in chunk.rows]
+        attempts = chunk.attempts
+    # The connection goes back to the pool while Delta is queried
+
+    if chunk_rate_limiter:
+        chunk_rate_limiter.acquire()
+    try:
+        results = [result for results in lookup_rows(rows, user, session_factory, len(rows), log=False) for result in results]
+    except Exception as e:
+        logger.error(f'Bulk job {chunk.job_id} chunk {chunk.chunk_index} failed (attempt {attempts}): {e.__class__} {e}')
+        with session_factory() as db_session:
+            fail_chunk(db_session, chunk, e)
+        return True
+
+    with session_factory() as db_session:
+        completed = complete_chunk(db_session, chunk, results)
+    if completed:
+        log_cpr_batch_search([cpr for _, cpr in rows if verify_cpr(cpr)], user)
+    return True
+
+
+def get_user_jobs(db_session: Session, username: str, limit: int = 20) -> list[BulkJob]:
+    """Get the newest jobs of a user."""
+    return list(db_session.scalars(select(BulkJob).where(BulkJob.username == username).order_by(BulkJob.id.desc()).limit(limit)))
+
+
+def iter_job_results(db_session: Session, job_id: int, username: str) -> Iterator[list[dict]]:
+    """
+    Stream the results of a finished job, one chunk at a time in the order of the file.
+
+    :param db_session: Database session
+    :param job_id: Id of the job
+    :param username: Only jobs submitted by this user are returned
+    :return: A generator of result chunks, see bulk.lookup_rows
+    """
+    job = db_session.get(BulkJob, job_id)
+    if not job or job.username != username:
+        return
+
+    index = -1
+    while True:
+        chunk = db_session.scalars(
+            select(BulkJobChunk)
+            .where(BulkJobChunk.job_id == job_id, BulkJobChunk.chunk_index > index)
+            .order_by(BulkJobChunk.chunk_index)
+            .limit(1)
+        ).first()
+        if not chunk:
+            break
+        index = chunk.chunk_index
+        if chunk.results:
+            yield chunk.results
+        db_session.expunge(chunk)
+
+
+def get_recent_results(db_session: Session, job_id: int, username: str, limit: int = 100, chunk_size: int = BULK_JOB_CHUNK_SIZE) -> list[dict]:
+    """
+    Get the newest results of a job, e.g. to show the progress of a running job. Chunks can finish out of order, so these are
+    the rows of the chunks finished last rather than the last rows of the file.
+
+    :param db_session: Database session
+    :param job_id: Id of the job
+    :param username: Only jobs submitted by this user are returned
+    :param limit: Maximum number of rows
+    :param chunk_size: Rows per chunk, to read no more chunks than needed
+    :return: At most limit result rows, newest last
+    """
+    chunks = db_session.scalars(
+        select(BulkJobChunk.results)
+        .join(BulkJob, BulkJob.id == BulkJobChunk.job_id)
+        .where(BulkJobChunk.job_id == job_id, BulkJob.username == username, BulkJobChunk.done_at.is_not(None))
+        .order_by(BulkJobChunk.done_at.desc())
+        .limit(-(-limit // chunk_size))
+    ).all()
+    return [row for results in reversed(chunks) for row in results or ()][-limit:]
+
+
+def delete_expired_jobs(db_session: Session, retention_days: int = BULK_JOB_RETENTION_DAYS) -> int:
+    """Delete jobs, with their CPR numbers and results, that were created more than retention_days ago."""
+    deleted = db_session.execute(delete(BulkJob).where(BulkJob.created_at < datetime.now() - timedelta(days=retention_days))).rowcount
+    # Submissions that never finished, e.g. the pod stopped during upload
+    deleted += db_session.execute(delete(BulkJob).where(BulkJob.status == SUBMITTING, BulkJob.created_at < datetime.now() - timedelta(days=1))).rowcount
+    db_session.commit()
+    return deleted
+
+
+def start_job_workers(session_factory: Callable[[], Session], count: int = BULK_JOB_WORKERS, poll_interval: float = BULK_JOB_POLL_INTERVAL) -> list[threading.Thread]:
+    """
+    Start background threads that work on bulk jobs. Workers on all replicas share the queue in the database.
+
+    :param session_factory: Function returning a new database session, e.g. database.get_session
+    :param count: Number of worker threads
+    :param poll_interval: Seconds to wait when there is nothing to do
+    :return: The started daemon threads
+    """
+    def run(worker: str, cleanup: bool):
+        last_cleanup = 0.0
+        while True:
+            try:
+                if cleanup and time.monotonic() - last_cleanup > 3600:
+                    with session_factory() as db_session:
+                        delete_expired_jobs(db_session)
+                    last_cleanup = time.monotonic()
+
+                if not process_next_chunk(session_factory, worker):
+                    time.sleep(poll_interval)
+            except Exception as e:
+                logger.error(f'Bulk job worker {worker} failed: {e.__class__} {e}')
+                time.sleep(poll_interval)
+
+    threads = []
+    for i in range(count):
+        thread = threading.Thread(target=run, args=(f'{POD_NAME}-{i}', i == 0), name=f'bulk-job-worker-{i}', daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
@@ -1,11 +1,33 @@
 import sys
-from streamlit.web import cli as stcli
 
-from database import create_database
+from database import get_session
+from delta import use_shared_cache
+from directory import start_directory_sync, start_search_index_refresh
+from audit import start_audit_maintenance
+from health import start_monitoring_server
+from jobs import start_job_workers
+from migrate import migrate
+from utils.config import METRICS_PORT, SHARED_CACHE, MIGRATE_ON_START
+from utils.utils import verify_cpr_hash_key
 
 
 if __name__ == '__main__':
-    create_database()
+    verify_cpr_hash_key()
+    if MIGRATE_ON_START:
+        migrate()
+    if SHARED_CACHE:
+        from shared_cache import start_cache_cleanup
+
+        use_shared_cache(get_session)
+        start_cache_cleanup(get_session)
+    start_directory_sync()
+    start_search_index_refresh()
+    start_audit_maintenance()
+    start_monitoring_server(METRICS_PORT)
+    start_job_workers(get_session)
+
+    # Imported after the background threads are started, so they load the directory and search index while Streamlit is imported
+    from streamlit.web import cli as stcli
 
     sys.argv = ["streamlit", "run", "streamlit_app.py", "--client.toolbarMode=minimal", "--server.port=8080"]
     sys.exit(stcli.main())
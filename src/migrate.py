@@ -0,0 +1,82 @@
+import sys
+import hashlib
+import logging
+
+from sqlalchemy import select, text, func
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+from models import Base, SchemaVersion
+from utils.config import DB_SCHEMA
+
+logger = logging.getLogger(__name__)
+
+MIGRATE_LOCK_KEY = 730_003  # Postgres advisory lock, replicas starting at the same time wait for the one migrating
+MIGRATION_VERSION = 1  # bump when a step in run_migrations changes without a change to models.py
+
+
+def get_schema_fingerprint() -> str:
+    """Get a fingerprint of the tables and indexes in models.py and MIGRATION_VERSION. The migrations run when it changes."""
+    dialect = postgresql.dialect()
+    ddl = [f'migration version {MIGRATION_VERSION}']
+    for table in Base.metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+        ddl.extend(str(CreateIndex(index).compile(dialect=dialect)) for index in sorted(table.indexes, key=lambda index: index.name))
+    return hashlib.sha256('\n'.join(ddl).encode()).hexdigest()[:16]
+
+
+def get_schema_version(db_session: Session) -> str | None:
+    """Get the fingerprint recorded by the latest migration, None if the database has never been migrated."""
+    if not db_session.execute(text('SELECT to_regclass(:name)'), {'name': f'{DB_SCHEMA}.{SchemaVersion.__tablename__}'}).scalar():
+        return None
+    return db_session.scalars(select(SchemaVersion.version).order_by(SchemaVersion.migrated_at.desc()).limit(1)).first()
+
+
+def run_migrations() -> None:
+    """Create the schema and tables, migrate the legacy audit log and add columns to tables created by older versions."""
+    from database import create_database
+    from audit import prepare_audit_log
+    from directory import prepare_directory
+
+    create_database()
+    prepare_audit_log()
+    prepare_directory()
+
+
+def migrate(force: bool = False) -> bool:
+    """
+    Run the migrations if the schema does not match models.py. When it does, this is a couple of small queries,
+    so it is cheap enough to run on every start.
+
+    :param force: Run the migrations even if the schema is current
+    :return: True if the migrations ran
+    """
+    from database import get_session
+
+    fingerprint = get_schema_fingerprint()
+    with get_session() as db_session:
+        if not force and get_schema_version(db_session) == fingerprint:
+            logger.info(f'Database schema is current ({fingerprint}), skipping migrations')
+            return False
+
+        # Held until commit, checked again as another replica may have migrated while this one waited
+        db_session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATE_LOCK_KEY})
+        if not force and get_schema_version(db_session) == fingerprint:
+            return False
+
+        run_migrations()
+        stmt = insert(SchemaVersion).values(version=fingerprint)
+        db_session.execute(stmt.on_conflict_do_update(index_elements=[SchemaVersion.version], set_={'migrated_at': func.now()}))
+        db_session.commit()
+
+    logger.info(f'Database schema migrated to {fingerprint}')
+    return True
+
+
+if __name__ == '__main__':
+    from utils.logging import set_logging_configuration
+
+    set_logging_configuration()
+    migrate(force='--force' in sys.argv[1:])
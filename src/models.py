@@ -2,7 +2,7 @@ from sqlalchemy import MetaData
 from sqlalchemy.ext.declarative import declarative_base
 
 from utils.config import DB_SCHEMA
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, BigInteger, Integer, String, DateTime, Index, ForeignKey, JSON, LargeBinary
 from sqlalchemy.sql import func
 
 metadata = MetaData(schema=DB_SCHEMA)
@@ -10,9 +10,99 @@ Base = declarative_base(metadata=metadata)
 
 
 class Log(Base):
-    __tablename__ = "log"
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    message = Column(String, nullable=False)
+    # Audit log of searches, range partitioned by month on created_at. Partitions are created and archived in audit.py
+    __tablename__ = "audit_log"
+    __table_args__ = (
+        Index('ix_audit_log_username_created_at', 'username', 'created_at'),
+        Index('ix_audit_log_subject_hash_created_at', 'subject_hash', 'created_at'),
+        {'postgresql_partition_by': 'RANGE (created_at)'}
+    )
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime, primary_key=True, server_default=func.now(), nullable=False)  # the partition key has to be part of the primary key
+    username = Column(String, nullable=False)
+    email = Column(String, nullable=False)
+    search_type = Column(String, nullable=False)
+    subject_hash = Column(String, nullable=False)  # hash_cpr of the searched CPR number
+
+
+class Employee(Base):
+    __tablename__ = "employee"
+    __table_args__ = (
+        Index('ix_employee_unit_id_name', 'unit_id', 'name', 'id'),  # pages through a department by name, see departments.py
+    )
+    id = Column(String, primary_key=True)  # Delta engagement uuid
+    name = Column(String, nullable=False)
     email = Column(String, nullable=False)
+    phone = Column(String, nullable=False)
+    mobile = Column(String, nullable=False)
+    department = Column(String, nullable=False)
+    unit_id = Column(String)  # Delta AdmUnit uuid of the department
+    dq_number = Column(String, nullable=False, index=True)
+    cpr_hash = Column(String, nullable=False, index=True)
+    row_hash = Column(String, nullable=False)
+    synced_at = Column(DateTime, server_default=func.now(), onupdate=func.now(), nullable=False)
+
+
+class AdmUnit(Base):
+    # Organisation tree precomputed from Delta by the directory sync, see departments.py
+    __tablename__ = "adm_unit"
+    id = Column(String, primary_key=True)  # Delta AdmUnit uuid
+    name = Column(String, nullable=False)
+    parent_id = Column(String, index=True)  # None for top level units
+    path = Column(String, nullable=False)  # uuids from the top level unit down to this unit, separated by /
+    depth = Column(Integer, nullable=False)
+    child_count = Column(Integer, nullable=False)
+    employee_count = Column(Integer, nullable=False)  # engagements in the unit itself
+    total_count = Column(Integer, nullable=False)  # engagements in the unit and all units below it
+    synced_at = Column(DateTime, server_default=func.now(), nullable=False)
+
+
+class BulkJob(Base):
+    # Bulk lookup running in the background, see jobs.py
+    __tablename__ = "bulk_job"
+    __table_args__ = (
+        Index('ix_bulk_job_username_status', 'username', 'status'),
+    )
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
     username = Column(String, nullable=False)
+    email = Column(String, nullable=False)
+    filename = Column(String, nullable=False)
+    status = Column(String, nullable=False)  # submitting, queued, running, done or failed
+    total_rows = Column(Integer, nullable=False, default=0)
+    rows_done = Column(Integer, nullable=False, default=0)
+    chunk_count = Column(Integer, nullable=False, default=0)
+    chunks_done = Column(Integer, nullable=False, default=0)
+    error = Column(String)
+    served_at = Column(DateTime)  # when a chunk of the job was last claimed, jobs are served round robin
     created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    finished_at = Column(DateTime)
+
+
+class BulkJobChunk(Base):
+    # Input and checkpointed result of one chunk of a bulk job
+    __tablename__ = "bulk_job_chunk"
+    job_id = Column(BigInteger, ForeignKey(BulkJob.id, ondelete='CASCADE'), primary_key=True)
+    chunk_index = Column(Integer, primary_key=True)
+    rows = Column(JSON, nullable=False)  # [row number, CPR number] pairs, emptied when the chunk is done
+    results = Column(JSON)  # lookup_rows results, set when the chunk is done
+    attempts = Column(Integer, nullable=False, default=0)
+    claimed_by = Column(String)
+    claimed_at = Column(DateTime)
+    done_at = Column(DateTime)
+
+
+class CacheEntry(Base):
+    # Search results and access tokens shared by all replicas, see shared_cache.py. Keys are HMACs and values are encrypted
+    __tablename__ = "cache_entry"
+    namespace = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    value = Column(LargeBinary)  # None until the first value is stored
+    expires_at = Column(DateTime, nullable=False, index=True)
+    lease_until = Column(DateTime)  # a replica is loading the value until then, the others wait for it
+
+
+class SchemaVersion(Base):
+    # Fingerprint of the schema after each run of migrate.py, a replica skips the migrations if the latest matches its models
+    __tablename__ = "schema_version"
+    version = Column(String, primary_key=True)
+    migrated_at = Column(DateTime, server_default=func.now(), nullable=False)
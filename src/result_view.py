@@ -0,0 +1,72 @@
+import hashlib
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from delta import Person, GraphQuery, get_cache_key
+from utils.cache import TTLCache, MISSING
+from utils.config import SESSION_RESULT_CACHE_SIZE, SEARCH_CACHE_TTL
+
+
+@dataclass(slots=True)
+class ResultCard:
+    title: str
+    markdown: list[str]
+    expanded: bool
+
+
+@dataclass(slots=True)
+class ResultView:
+    people: list[Person] | None
+    cards: list[ResultCard]
+
+
+def create_result_store() -> TTLCache:
+    """Create the store of one Streamlit session, kept in st.session_state, so reruns show stored results instead of searching again."""
+    return TTLCache(max_entries=SESSION_RESULT_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+
+
+def get_query_key(query: GraphQuery) -> str:
+    """Get the key of a DQ or CPR search, with CPR numbers hashed like in the search cache."""
+    return get_cache_key(query) or f'query:{hashlib.sha256(query.body).hexdigest()}'
+
+
+def get_free_text_key(text: str, generation: int) -> str:
+    """Get the key of a free text search. The generation of the search index is part of the key, so a refreshed index is searched again."""
+    return f'free:{generation}:{" ".join(text.lower().split())}'
+
+
+def _table(headers: list[str], values: list[str]) -> str:
+    return '| ' + ' | '.join(headers) + ' |\n| ' + ' | '.join(['---'] * len(headers)) + ' |\n| ' + ' | '.join(values) + ' |'
+
+
+def render_cards(people: list[Person] | None) -> list[ResultCard]:
+    """Render the markdown tables shown for each person. A single person is shown expanded."""
+    return [
+        ResultCard(
+            title=person.name,
+            markdown=[
+                _table(['Navn', 'DQ-nummer', 'Afdeling'], [person.name, person.dq_number, person.department]),
+                _table(['E-mail', 'Telefon', 'Mobil'], [person.email, person.phone, person.mobile])
+            ],
+            expanded=len(people) == 1
+        )
+        for person in people or ()
+    ]
+
+
+def get_result_view(store: TTLCache, key: str, search: Callable[[], list[Person] | None]) -> ResultView:
+    """
+    Get the stored result of a search, or run the search and store its result and rendered cards.
+    Failed searches raise and are not stored, so they are tried again on the next rerun.
+
+    :param store: Store of the session, see create_result_store
+    :param key: Key of the search, see get_query_key and get_free_text_key
+    :param search: Function running the search
+    :return: The people found and their rendered cards
+    """
+    view = store.get(key)
+    if view is MISSING:
+        people = search()
+        view = ResultView(people, render_cards(people))
+        store.set(key, view)
+    return view
@@ -0,0 +1,285 @@
+import hmac
+import json
+import time
+import base64
+import hashlib
+import logging
+import threading
+from collections.abc import Callable, Iterable
+from datetime import timedelta
+
+from cryptography.fernet import Fernet, InvalidToken
+from sqlalchemy import select, update, delete, func, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from models import CacheEntry
+from utils.cache import MISSING
+from utils.config import SHARED_CACHE_KEY, SHARED_CACHE_LEASE, SHARED_CACHE_CLEANUP_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.05  # seconds between checks while another replica loads a value
+
+
+class PostgresCache:
+    """
+    A cache shared by all replicas, in the cache_entry table. Keys are stored as HMACs and values are encrypted with a key derived
+    from secret, so the table never holds a CPR number or an access token in the clear.
+    Errors from the database are logged and treated as cache misses, so searches keep working without the shared cache.
+    """
+    def __init__(self, session_factory: Callable[[], Session], namespace: str, secret: str = SHARED_CACHE_KEY, ttl: float = 300, negative_ttl: float | None = None,
+                 lease: float = SHARED_CACHE_LEASE, dumps: Callable = json.dumps, loads: Callable = json.loads):
+        """
+        :param session_factory: Function returning a new database session, e.g. database.get_session
+        :param namespace: Separates caches in the same table, e.g. search results and tokens
+        :param secret: Hashes the keys and encrypts the values, must be the same on all replicas
+        :param ttl: Default seconds to keep a value
+        :param negative_ttl: Default seconds to keep None, e.g. a search without result. Defaults to ttl
+        :param lease: Seconds other replicas wait for a value being loaded by get_or_load, before loading it themselves
+        :param dumps: Serializes a value to a string or bytes
+        :param loads: Deserializes a value serialized by dumps
+        """
+        if not secret:
+            raise ValueError('A secret is required for the shared cache, set SHARED_CACHE_KEY')
+
+        self.session_factory = session_factory
+        self.namespace = namespace
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.lease = lease
+        self.dumps = dumps
+        self.loads = loads
+
+        self._key_secret = hmac.new(secret.encode(), b'shared-cache-key', hashlib.sha256).digest()
+        self._fernet = Fernet(base64.urlsafe_b64encode(hmac.new(secret.encode(), b'shared-cache-value', hashlib.sha256).digest()))
+
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.lease_waits = 0
+
+    def _hash(self, key: str) -> str:
+        return hmac.new(self._key_secret, key.encode(), hashlib.sha256).hexdigest()
+
+    def _encrypt(self, value) -> bytes:
+        data = self.dumps(value)
+        return self._fernet.encrypt(data.encode() if isinstance(data, str) else data)
+
+    def _decrypt(self, token: bytes):
+        try:
+            return self.loads(self._fernet.decrypt(token))
+        except (InvalidToken, ValueError) as e:
+            # Written with another secret or serializer, e.g. during a rolling update
+            logger.warning(f'Shared cache value could not be read: {e.__class__} {e}')
+            return MISSING
+
+    def _get_ttl(self, value, ttl) -> float:
+        if ttl is None:
+            return self.negative_ttl if value is None else self.ttl
+        return ttl(value) if callable(ttl) else ttl
+
+    def get(self, key: str, default=MISSING, fresh_for: float = 0):
+        """
+        Get a cached value.
+
+        :param key: Cache key, hashed before it is sent to the database
+        :param default: Returned if the key is not cached
+        :param fresh_for: Only return a value that is valid for at least this many seconds more
+        """
+        value = self.get_many([key], fresh_for).get(key, MISSING)
+        return default if value is MISSING else value
+
+    def get_many(self, keys: Iterable[str], fresh_for: float = 0) -> dict:
+        """
+        Get the cached values of several keys in one query.
+
+        :return: A dictionary of the keys found and their values
+        """
+        hashed = {self._hash(key): key for key in keys}
+        if not hashed:
+            return {}
+
+        try:
+            with self.session_factory() as db_session:
+                rows = db_session.execute(
+                    select(CacheEntry.key, CacheEntry.value).where(
+                        CacheEntry.namespace == self.namespace,
+                        CacheEntry.key.in_(hashed),
+                        CacheEntry.value.is_not(None),
+                        CacheEntry.expires_at > func.now() + timedelta(seconds=fresh_for)
+                    )
+                ).all()
+        except SQLAlchemyError as e:
+            self.errors += 1
+            logger.warning(f'Shared cache read failed: {e.__class__} {e}')
+            return {}
+
+        found = {}
+        for key, token in rows:
+            value = self._decrypt(token)
+            if value is not MISSING:
+                found[hashed[key]] = value
+        self.hits += len(found)
+        self.misses += len(hashed) - len(found)
+        return found
+
+    def set(self, key: str, value, ttl: float | Callable | None = None) -> None:
+        """
+        Cache a value. None is cached as a miss, with the shorter negative ttl.
+
+        :param ttl: Seconds to keep the value, a function returning the seconds for the value, or None for the default
+        """
+        self._write({key: value}, ttl)
+
+    def set_many(self, items: dict, ttl: float | Callable | None = None) -> None:
+        """Cache several values in one statement."""
+        self._write(items, ttl)
+
+    def _write(self, items: dict, ttl) -> bool:
+        rows = []
+        for key, value in items.items():
+            seconds = self._get_ttl(value, ttl)
+            if seconds > 0:
+                rows.append({'namespace': self.namespace, 'key': self._hash(key), 'value': self._encrypt(value), 'expires_at': func.now() + timedelta(seconds=seconds), 'lease_until': None})
+        if not rows:
+            return False
+
+        stmt = insert(CacheEntry).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[CacheEntry.namespace, CacheEntry.key],
+            set_={'value': stmt.excluded.value, 'expires_at': stmt.excluded.expires_at, 'lease_until': None}
+        )
+        try:
+            with self.session_factory() as db_session:
+                db_session.execute(stmt)
+                db_session.commit()
+            return True
+        except SQLAlchemyError as e:
+            self.errors += 1
+            logger.warning(f'Shared cache write failed: {e.__class__} {e}')
+            return False
+
+    def delete(self, key: str) -> None:
+        try:
+            with self.session_factory() as db_session:
+                db_session.execute(delete(CacheEntry).where(CacheEntry.namespace == self.namespace, CacheEntry.key == self._hash(key)))
+                db_session.commit()
+        except SQLAlchemyError as e:
+            self.errors += 1
+            logger.warning(f'Shared cache delete failed: {e.__class__} {e}')
+
+    def _acquire_lease(self, key: str) -> bool | None:
+        """
+        Take the lease on loading a key, unless another replica holds it. Creates an empty entry if the key is not cached.
+
+        :return: True if the lease was taken, False if another replica holds it and None if the database failed
+        """
+        stmt = insert(CacheEntry).values(
+            namespace=self.namespace, key=self._hash(key), value=None, expires_at=func.now(), lease_until=func.now() + timedelta(seconds=self.lease)
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[CacheEntry.namespace, CacheEntry.key],
+            set_={'lease_until': stmt.excluded.lease_until},
+            where=or_(CacheEntry.lease_until.is_(None), CacheEntry.lease_until < func.now())
+        ).returning(CacheEntry.key)
+        try:
+            with self.session_factory() as db_session:
+                acquired = db_session.execute(stmt).first() is not None
+                db_session.commit()
+                return acquired
+        except SQLAlchemyError as e:
+            self.errors += 1
+            logger.warning(f'Shared cache lease failed: {e.__class__} {e}')
+            return None
+
+    def _release_lease(self, key: str) -> None:
+        try:
+            with self.session_factory() as db_session:
+                db_session.execute(
+                    update(CacheEntry)
+                    .where(CacheEntry.namespace == self.namespace, CacheEntry.key == self._hash(key))
+                    .values(lease_until=None)
+                )
+                db_session.commit()
+        except SQLAlchemyError as e:
+            self.errors += 1
+            logger.warning(f'Shared cache lease release failed: {e.__class__} {e}')
+
+    def get_or_load(self, key: str, load: Callable, ttl: float | Callable | None = None, fresh_for: float = 0):
+        """
+        Get a cached value, or call load and cache its result. Only one replica loads a key at a time, the others poll
+        for its result for up to lease seconds and then load it themselves, e.g. if the loading replica stopped.
+        If the lease can not be taken because the database fails, the value is loaded without waiting, so callers
+        should coalesce loads of the same key in the process, see delta.search.
+
+        :param key: Cache key
+        :param load: Function returning the value
+        :param ttl: Seconds to keep the value, a function returning the seconds for the value, or None for the default
+        :param fresh_for: Only use a cached value that is valid for at least this many seconds more
+        """
+        value = self.get(key, fresh_for=fresh_for)
+        if value is not MISSING:
+            return value
+
+        deadline = time.monotonic() + self.lease
+        while (acquired := self._acquire_lease(key)) is False:
+            self.lease_waits += 1
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(POLL_INTERVAL)
+            value = self.get(key, fresh_for=fresh_for)
+            if value is not MISSING:
+                return value
+
+        try:
+            value = load()
+        except BaseException:
+            if acquired:
+                self._release_lease(key)
+            raise
+        if not self._write({key: value}, ttl) and acquired:
+            self._release_lease(key)
+        return value
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'lease_waits': self.lease_waits
+        }
+
+
+def delete_expired_entries(db_session: Session) -> int:
+    """Delete cache entries that have expired and are not being loaded."""
+    deleted = db_session.execute(
+        delete(CacheEntry).where(CacheEntry.expires_at < func.now(), or_(CacheEntry.lease_until.is_(None), CacheEntry.lease_until < func.now()))
+    ).rowcount
+    db_session.commit()
+    return deleted
+
+
+def start_cache_cleanup(session_factory: Callable[[], Session], interval: int = SHARED_CACHE_CLEANUP_INTERVAL) -> threading.Thread:
+    """
+    Start a background thread deleting expired cache entries every interval seconds. Runs on every replica, deleting twice is harmless.
+
+    :param session_factory: Function returning a new database session, e.g. database.get_session
+    :param interval: Seconds between cleanups
+    :return: The started daemon thread
+    """
+    def run():
+        while True:
+            try:
+                with session_factory() as db_session:
+                    deleted = delete_expired_entries(db_session)
+                if deleted:
+                    logger.info(f'Deleted {deleted} expired shared cache entries')
+            except Exception as e:
+                logger.error(f'Shared cache cleanup failed: {e.__class__} {e}')
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='shared-cache-cleanup', daemon=True)
+    thread.start()
+    return thread
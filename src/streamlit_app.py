@@ -1,18 +1,45 @@
+import hashlib
+import tempfile
 import streamlit as st
 
 from dataclasses import asdict
 from streamlit_keycloak import login
 
-from delta import get_cpr_search, get_dq_number_search, search
+from delta import get_cpr_search, get_dq_number_search, get_cpr_batch_search, search, search_batch, get_emails
 from database import get_session
+from directory import employee_index, refresh_search_index
+from departments import get_child_units, get_unit_path, get_unit_employees
+from bulk import CprFileReader, write_csv
+from jobs import submit_job, get_user_jobs, get_recent_results, iter_job_results, QUEUED, RUNNING, DONE, FAILED
+from result_view import create_result_store, get_query_key, get_free_text_key, get_result_view
 from utils.utils import set_logging_configuration, verify_cpr, get_cpr_list
-from utils.config import KEYCLOAK_URL, KEYCLOAK_REALM, KEYCLOAK_CLIENT
+from utils.config import KEYCLOAK_URL, KEYCLOAK_REALM, KEYCLOAK_CLIENT, DEPARTMENT_CACHE_TTL, BULK_JOB_POLL_INTERVAL
 
 set_logging_configuration()
 
 st.set_page_config(page_title="Telefonbog", page_icon="📞")
 st.markdown('<style>table {width:100%;}</style>', unsafe_allow_html=True)
 
+JOB_STATUS_TEXT = {QUEUED: 'i kø', RUNNING: 'kører', DONE: 'færdig', FAILED: 'fejlet'}
+
+
+@st.cache_resource(show_spinner=False)
+def get_employee_index():
+    # Filled by main.py, loaded here once per process when the app runs without it, e.g. during development
+    if not len(employee_index):
+        refresh_search_index()
+    return employee_index
+
+
+@st.cache_data(ttl=DEPARTMENT_CACHE_TTL, show_spinner=False)
+def load_department(unit_id: str | None, cursor: tuple[str, str] | None) -> dict:
+    # Shared by all sessions, the tree only changes when the directory is synced
+    with get_session() as db_session:
+        path = [(unit.id, unit.name) for unit in get_unit_path(db_session, unit_id)] if unit_id else []
+        children = [(unit.id, unit.name, unit.total_count) for unit in get_child_units(db_session, unit_id)]
+        people, next_cursor = get_unit_employees(db_session, unit_id, cursor) if unit_id else ([], None)
+    return {'path': path, 'children': children, 'people': people, 'next_cursor': next_cursor}
+
 
 keycloak = login(
     url=KEYCLOAK_URL,
@@ -41,21 +68,25 @@ if keycloak.authenticated:
     if "error" not in st.session_state:
         st.session_state.error = None
 
+    if "results" not in st.session_state:
+        st.session_state.results = create_result_store()
+
+    if "unit_id" not in st.session_state:
+        st.session_state.unit_id = None
+        st.session_state.unit_pages = []  # cursor of each page opened after the first, see get_unit_employees
+
     def cpr_change():
         if st.session_state.CPR:
             st.session_state.free = ""
             st.session_state.dq = ""
             if st.session_state.cpr:
                 if verify_cpr(st.session_state.cpr):
-                    with get_session() as db_session:
-                        st.session_state.search = get_cpr_search(
-                            db_session=db_session,
-                            cpr=st.session_state.cpr,
-                            user=st.session_state.USER,
-                            has_cpr_rights=st.session_state.CPR
-                        )
-                        db_session.commit()
-                        st.session_state.error = None
+                    st.session_state.search = get_cpr_search(
+                        cpr=st.session_state.cpr,
+                        user=st.session_state.USER,
+                        has_cpr_rights=st.session_state.CPR
+                    )
+                    st.session_state.error = None
                 else:
                     st.session_state.error = "Ugyldigt CPR-nummer"
                     st.session_state.search = None
@@ -69,9 +100,19 @@ if keycloak.authenticated:
         if st.session_state.dq:
             st.session_state.search = get_dq_number_search(st.session_state.dq, st.session_state.USER)
 
+    def open_unit(unit_id):
+        st.session_state.unit_id = unit_id
+        st.session_state.unit_pages = []
+
+    def free_change():
+        st.session_state.cpr = ""
+        st.session_state.dq = ""
+        st.session_state.error = None
+        st.session_state.search = None
+
     st.title('Telefonbog')
 
-    seacrh, lookup = st.tabs(["Find medarbejder", "Slå e-mails op med cpr-numre"])
+    seacrh, departments, lookup = st.tabs(["Find medarbejder", "Afdelinger", "Slå e-mails op med cpr-numre"])
 
     with seacrh:
         left_column, right_column = st.columns(2)
@@ -82,67 +123,164 @@ if keycloak.authenticated:
         with right_column:
             st.text_input("DQ-nummer", placeholder="Brugernavn", key="dq", on_change=dq_change)
 
+        st.text_input("Navn, e-mail, afdeling eller telefon", placeholder="Søg", key="free", on_change=free_change)
+
         if st.session_state.error:
             st.error(st.session_state.error)
-        if st.session_state.search:
-            with st.spinner('Søger...'):
-                try:
-                    if st.session_state.search:
-                        result = search(st.session_state.search, st.session_state.USER)
-                        if result:
-                            if len(result) == 1:
-                                r = result[0]
-                                with st.expander(r['Navn'], expanded=True):
-                                    top_line = '| ' + ' | '.join(['Navn', 'DQ-nummer', 'Afdeling']) + ' |' + '\n| ' + ' | '.join(['---'] * 3) + ' |' + '\n| ' + ' | '.join([r['Navn'], r['DQ-nummer'], r['Afdeling']]) + ' |'
-                                    buttom_line = '| ' + ' | '.join(['E-mail', 'Telefon', 'Mobil']) + ' |' + '\n| ' + ' | '.join(['---'] * 3) + ' |' + '\n| ' + ' | '.join([r['E-mail'], r['Telefon'], r['Mobil']]) + ' |'
-                                    st.markdown(top_line)
-                                    st.markdown(buttom_line)
-                            elif len(result) > 1:
-                                for r in result:
-                                    with st.expander(r['Navn'], expanded=False):
-                                        top_line = '| ' + ' | '.join(['Navn', 'DQ-nummer', 'Afdeling']) + ' |' + '\n| ' + ' | '.join(['---'] * 3) + ' |' + '\n| ' + ' | '.join([r['Navn'], r['DQ-nummer'], r['Afdeling']]) + ' |'
-                                        buttom_line = '| ' + ' | '.join(['E-mail', 'Telefon', 'Mobil']) + ' |' + '\n| ' + ' | '.join(['---'] * 3) + ' |' + '\n| ' + ' | '.join([r['E-mail'], r['Telefon'], r['Mobil']]) + ' |'
-                                        st.markdown(top_line)
-                                        st.markdown(buttom_line)
-                            else:
-                                st.write("Ingen resultater")
-                        else:
-                            st.write("Ingen resultater")
-                except Exception as e:
-                    st.error(f'Fejl: {e}')
-    with lookup:
-        txt = st.text_area(label="CPR-numre", placeholder="Indsæt CPR-numre her - adskildt med ' , ' (komma)", disabled=not st.session_state.CPR)
+        if st.session_state.search or st.session_state.get('free'):
+            # Results are stored in the session, so reruns that do not change the search, e.g. opening a card or a tab, do not search again
+            free = st.session_state.get('free')
 
-        disable_button = True
+            def run_search():
+                if free:
+                    return index.search(free)
+                with get_session() as db_session:
+                    return search(st.session_state.search, st.session_state.USER, db_session)
 
-        if txt:
-            if get_cpr_list(txt) and st.session_state.CPR:
-                disable_button = False
-                st.write("Tryk på knappen 'Slå e-mails op' for at få e-mails for indtastede CPR-numre")
+            try:
+                if free:
+                    index = get_employee_index()
+                    key = get_free_text_key(free, index.generation)
+                else:
+                    key = get_query_key(st.session_state.search)
+                with st.spinner('Søger...'):
+                    view = get_result_view(st.session_state.results, key, run_search)
+
+                for card in view.cards:
+                    with st.expander(card.title, expanded=card.expanded):
+                        for markdown in card.markdown:
+                            st.markdown(markdown)
+                if not view.cards:
+                    st.write("Ingen resultater")
+            except Exception as e:
+                st.error(f'Fejl: {e}')
+    with departments:
+        # Only the selected unit and page cursors are kept in the session, pages of the precomputed tree are cached for all sessions
+        unit_id = st.session_state.unit_id
+        cursor = st.session_state.unit_pages[-1] if st.session_state.unit_pages else None
+        department = load_department(unit_id, cursor)
+
+        breadcrumbs = st.columns(len(department['path']) + 1)
+        breadcrumbs[0].button("Alle afdelinger", key="unit_root", on_click=open_unit, args=(None,))
+        for column, (id_, name) in zip(breadcrumbs[1:], department['path']):
+            column.button(name, key=f'unit_path_{id_}', on_click=open_unit, args=(id_,), disabled=id_ == unit_id)
+
+        for id_, name, total_count in department['children']:
+            st.button(f'{name} ({total_count})', key=f'unit_{id_}', on_click=open_unit, args=(id_,))
+
+        if unit_id:
+            if department['people']:
+                st.dataframe(
+                    [{'Navn': p.name, 'DQ-nummer': p.dq_number, 'E-mail': p.email, 'Telefon': p.phone, 'Mobil': p.mobile} for p in department['people']],
+                    hide_index=True, use_container_width=True
+                )
             else:
-                st.error('Ugyldigt CPR-nummer')
+                st.write("Ingen medarbejdere direkte i afdelingen")
+
+            previous_column, next_column = st.columns(2)
+            if previous_column.button("Forrige side", disabled=not st.session_state.unit_pages):
+                st.session_state.unit_pages.pop()
+                st.rerun()
+            if next_column.button("Næste side", disabled=not department['next_cursor']):
+                st.session_state.unit_pages.append(department['next_cursor'])
+                st.rerun()
+
+    with lookup:
+        txt = st.text_area(label="CPR-numre", placeholder="Indsæt CPR-numre her - adskilt med komma, semikolon, tabulator eller linjeskift", disabled=not st.session_state.CPR)
+
+        parsed = None
+        if txt:
+            # Parsed once per paste, reruns with the same text reuse the result kept in the session
+            digest = hashlib.sha256(txt.encode()).digest()
+            if st.session_state.get('cpr_paste', (None, None))[0] != digest:
+                st.session_state.cpr_paste = (digest, get_cpr_list(txt))
+            parsed = st.session_state.cpr_paste[1]
+
+            if parsed.cpr_list and st.session_state.CPR:
+                duplicates = f', {parsed.duplicates} dubletter er fjernet' if parsed.duplicates else ''
+                st.write(f"{len(parsed.cpr_list)} gyldige CPR-numre{duplicates}. Tryk på knappen 'Slå e-mails op' for at få e-mails for dem")
+            if parsed.invalid:
+                st.error(f'{len(parsed.invalid)} ugyldige CPR-numre' + (' - de slås ikke op' if parsed.cpr_list else ''))
+                with st.expander("Vis ugyldige CPR-numre"):
+                    st.dataframe([{'Linje': i.line, 'Nummer': i.entry, 'Værdi': i.value} for i in parsed.invalid], hide_index=True, use_container_width=True)
 
-        if st.button("Slå e-mails op", disabled=disable_button):
+        if st.button("Slå e-mails op", disabled=not (parsed and parsed.cpr_list and st.session_state.CPR)):
             with st.spinner('Søger...'):
                 try:
-                    cpr_list = get_cpr_list(txt)
-                    if cpr_list:
-                        with get_session() as db_session:
-                            cpr_dict_list = [get_cpr_search(
-                                db_session=db_session,
-                                cpr=cpr,
-                                user=st.session_state.USER,
-                                has_cpr_rights=st.session_state.CPR
-                            ) for cpr in cpr_list]
-                            db_session.commit()
-                            search_result = [search(cpr_dict, st.session_state.USER) for cpr_dict in cpr_dict_list]
-                            email_list = [r[0]['E-mail'] if r[0]['DQ-nummer'] != '-' else 'IKKE_FUNDET' for r in search_result]
-                            emails = f'''{','.join(email_list)}'''
-                            st.code(emails)
-                    else:
-                        st.error('Ugyldigt CPR-nummer')
+                    cpr_dict_list = get_cpr_batch_search(
+                        cpr_list=parsed.cpr_list,
+                        user=st.session_state.USER,
+                        has_cpr_rights=st.session_state.CPR
+                    )
+                    with get_session() as db_session:
+                        search_result = search_batch(cpr_dict_list, st.session_state.USER, db_session)
+                        email_list = get_emails(search_result)
+                        emails = f'''{','.join(email_list)}'''
+                        st.code(emails)
                 except Exception as e:
                     st.error(f'Fejl: {e}')
 
+        st.divider()
+        uploaded_file = st.file_uploader("Eller upload en CSV- eller Excel-fil med CPR-numre", type=['csv', 'xlsx'], disabled=not st.session_state.CPR)
+
+        def load_jobs():
+            # Jobs only change while they are queued or running, so the list is read when a job is submitted and polled while one is active
+            with get_session() as db_session:
+                jobs = get_user_jobs(db_session, st.session_state.USER['username'])
+                st.session_state.job_results = {job.id: get_recent_results(db_session, job.id, job.username) for job in jobs if job.status == RUNNING}
+            st.session_state.jobs = jobs
+
+        if st.button("Slå e-mails op fra fil", disabled=not (uploaded_file and st.session_state.CPR)):
+            try:
+                reader = CprFileReader(uploaded_file, uploaded_file.name, uploaded_file.size)
+                with st.spinner('Indlæser fil...'), get_session() as db_session:
+                    submit_job(db_session, reader, st.session_state.USER, uploaded_file.name)
+                load_jobs()
+                st.success('Filen er sat i kø - du kan følge kørslen herunder, også hvis du lukker siden')
+            except Exception as e:
+                st.error(f'Fejl: {e}')
+
+        def show_jobs():
+            if st.session_state.jobs:
+                st.subheader("Dine kørsler")
+            for job in st.session_state.jobs:
+                status = JOB_STATUS_TEXT.get(job.status, job.status)
+                st.progress(job.rows_done / job.total_rows if job.total_rows else 1.0, text=f'{job.filename} ({job.created_at:%d-%m-%Y %H:%M}) - {status}: {job.rows_done} af {job.total_rows or 0} rækker')
+                if job.status == RUNNING and st.session_state.job_results.get(job.id):
+                    st.dataframe(st.session_state.job_results[job.id], hide_index=True, use_container_width=True)
+                if job.status == FAILED and job.error:
+                    st.error(job.error)
+                if job.status == DONE:
+                    key = f'bulk_csv_{job.id}'
+                    if key not in st.session_state and st.button("Hent resultat", key=f'prepare_{job.id}'):
+                        with tempfile.TemporaryFile(mode='w+', encoding='utf-8', newline='') as output, get_session() as db_session:
+                            for i, results in enumerate(iter_job_results(db_session, job.id, job.username)):
+                                write_csv(results, output, header=i == 0)
+                            output.seek(0)
+                            st.session_state[key] = output.read().encode('utf-8-sig')
+                    if key in st.session_state:
+                        st.download_button("Hent resultat som CSV", data=st.session_state[key], file_name=f'emails_{job.id}.csv', mime='text/csv', key=f'download_{job.id}')
+
+        @st.fragment(run_every=BULK_JOB_POLL_INTERVAL)
+        def active_job_list():
+            # Jobs run in the background workers, see jobs.py, so the list refreshes itself until they are done
+            load_jobs()
+            show_jobs()
+            if not any(job.status in (QUEUED, RUNNING) for job in st.session_state.jobs):
+                st.rerun()  # switches to job_list, which does not poll
+
+        @st.fragment
+        def job_list():
+            show_jobs()
+
+        # Only users with CPR rights can submit jobs, and only their own jobs are shown
+        if st.session_state.CPR:
+            if 'jobs' not in st.session_state:
+                load_jobs()
+            if any(job.status in (QUEUED, RUNNING) for job in st.session_state.jobs):
+                active_job_list()
+            else:
+                job_list()
+
 else:
     st.write("Du er ikke logget ind")
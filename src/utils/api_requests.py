@@ -1,10 +1,119 @@
 import time
 import base64
+import random
+import socket
 import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+from utils.metrics import API_REQUEST_SECONDS, TOKEN_FETCH_SECONDS, API_RETRIES, API_CIRCUIT_REJECTIONS, RATE_LIMIT_WAIT_SECONDS
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+RETRY_STATUSES = frozenset([429, *range(500, 600)])
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    Limits requests to rate per second with bursts of up to burst requests. Callers reserve a token and sleep until it is due,
+    so waiting callers are served in order without holding the lock.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available.
+
+        :return: Seconds waited
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            if wait:
+                self.waits += 1
+                self.wait_seconds += wait
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'waits': self.waits,
+            'wait_seconds': self.wait_seconds
+        }
+
+
+class CircuitBreaker:
+    """
+    Fails requests fast after failure_threshold consecutive failures. After reset_timeout seconds one probe request is let through (half open),
+    its result decides whether the circuit closes again or stays open for another reset_timeout.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+        self.logger = logging.getLogger(__name__)
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._probing = False
+
+            if self.state == 'half_open':
+                if self._probing:
+                    return False
+                self._probing = True
+                return True
+
+            return self.state == 'closed'
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                self.logger.info('Circuit closed')
+            self.state = 'closed'
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.logger.warning(f'Circuit opened after {self.failures} failures')
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self._probing = False
 
 
 class APIClient:
-    def __init__(self, base_url, api_key=None, auth_url=None, realm=None, client_id=None, client_secret=None, username=None, password=None, cert_base64=None):
+    def __init__(self, base_url, api_key=None, auth_url=None, realm=None, client_id=None, client_secret=None, username=None, password=None, cert_base64=None, pool_size=10, keep_alive=True, background_refresh=False, refresh_margin=30,
+                 connect_timeout=None, read_timeout=None, max_retries=0, backoff_factor=0.5, backoff_max=10, circuit_breaker=None, rate_limiter=None, token_cache=None):
         self.base_url = base_url
         self.api_key = api_key
         self.auth_url = auth_url
@@ -23,8 +132,75 @@ class APIClient:
         if cert_base64:
             self.cert_data = base64.b64decode(cert_base64)
 
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._retry_errors = ()  # set with the session, so requests is only imported once the client is used
+
+        self.background_refresh = background_refresh
+        self.refresh_margin = refresh_margin
+        self._token_lock = threading.Lock()
+        self._refresh_timer = None
+
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.circuit_breaker = circuit_breaker
+        self.rate_limiter = rate_limiter  # shared by all threads using this client, e.g. all Streamlit sessions
+        self.token_cache = token_cache  # shared with other replicas, e.g. shared_cache.PostgresCache, so they log in once between them
+
         self.logger = logging.getLogger(__name__)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        import requests
+
+        if self.cert_data:
+            from requests_pkcs12 import Pkcs12Adapter
+            adapter = Pkcs12Adapter(pkcs12_data=self.cert_data, pkcs12_password=self.password, pool_maxsize=self.pool_size)
+        else:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+
+        self._retry_errors = (requests.ConnectionError, requests.Timeout)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        if self.keep_alive:
+            # TCP keep-alive stops firewalls from silently dropping idle pooled connections
+            from urllib3.connection import HTTPConnection
+            adapter.poolmanager.connection_pool_kw['socket_options'] = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        else:
+            session.headers['Connection'] = 'close'
+
+        return session
+
+    def close(self):
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
     def _authenticate(self):
         if self.api_key:
             return {'Authorization': f'Bearer {self.api_key}'}
@@ -32,73 +208,156 @@ class APIClient:
             if not self.realm:
                 raise ValueError('Realm is required for client_id and client_secret authentication')
 
-            refresh_token = False
-
-            if self.access_token:
-                if self.token_expiry:
-                    if time.time() < self.token_expiry:
-                        return {'Authorization': f'Bearer {self.access_token}'}
-                    else:
-                        if self.refresh_token:
-                            if self.refresh_token_expiry:
-                                if time.time() < self.refresh_token_expiry:
-                                    refresh_token = True
-
-            tmp_base_url = self.auth_url or self.base_url
-            tmp_url = f'{tmp_base_url}/realms/{self.realm}/protocol/openid-connect/token'
-
-            tmp_headers = {
-                'Content-Type': 'application/x-www-form-urlencoded'
-            }
-
-            tmp_json_data = {
-                'client_id': self.client_id,
-                'client_secret': self.client_secret
-            }
-
-            if refresh_token:
-                tmp_json_data['grant_type'] = 'refresh_token'
-                tmp_json_data['refresh_token'] = self.refresh_token
-            elif self.username and self.password:
-                tmp_json_data['grant_type'] = 'password'
-                tmp_json_data['username'] = self.username
-                tmp_json_data['password'] = self.password
-            else:
-                tmp_json_data['grant_type'] = 'client_credentials'
+            if self._token_valid():
+                return {'Authorization': f'Bearer {self.access_token}'}
 
-            now = time.time()
+            # Single flight: one thread fetches a new token, the others wait for it and reuse it
+            with self._token_lock:
+                if not self._token_valid():
+                    self._update_token()
 
-            import requests
+            return {'Authorization': f'Bearer {self.access_token}'}
+        else:
+            return {}
 
-            response = requests.post(tmp_url, headers=tmp_headers, data=tmp_json_data)
-            response.raise_for_status()
-            data = response.json()
+    def _token_valid(self):
+        return bool(self.access_token and self.token_expiry and time.time() < self.token_expiry)
 
-            self.access_token = data['access_token']
-            self.token_expiry = now + data['expires_in']
+    def _update_token(self):
+        # Must be called while holding _token_lock. With a token cache, a token fetched by another replica is used if it outlives the current one
+        if self.token_cache is None:
+            return self._fetch_token()
 
-            if 'refresh_token' in data:
-                self.refresh_token = data['refresh_token']
-                self.refresh_token_expiry = now + data['refresh_expires_in']
+        fresh_for = max(self.refresh_margin, (self.token_expiry or 0) - time.time() + 1)
+        token = self.token_cache.get_or_load(self._token_cache_key(), self._fetch_shared_token, ttl=lambda token: token['expires_at'] - time.time(), fresh_for=fresh_for)
+        if token['access_token'] != self.access_token:
+            self.access_token = token['access_token']
+            self.token_expiry = token['expires_at']
+            self._schedule_refresh()
 
-            return {'Authorization': f'Bearer {self.access_token}'}
+    def _token_cache_key(self):
+        return f'token:{self.auth_url or self.base_url}:{self.realm}:{self.client_id}:{self.username or ""}'
+
+    def _fetch_shared_token(self):
+        self._fetch_token()
+        return {'access_token': self.access_token, 'expires_at': self.token_expiry}
+
+    def _fetch_token(self):
+        # Must be called while holding _token_lock
+        refresh_token = bool(self.refresh_token and self.refresh_token_expiry and time.time() < self.refresh_token_expiry)
+
+        tmp_base_url = self.auth_url or self.base_url
+        tmp_url = f'{tmp_base_url}/realms/{self.realm}/protocol/openid-connect/token'
+
+        tmp_headers = {
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
+
+        tmp_json_data = {
+            'client_id': self.client_id,
+            'client_secret': self.client_secret
+        }
+
+        if refresh_token:
+            tmp_json_data['grant_type'] = 'refresh_token'
+            tmp_json_data['refresh_token'] = self.refresh_token
+        elif self.username and self.password:
+            tmp_json_data['grant_type'] = 'password'
+            tmp_json_data['username'] = self.username
+            tmp_json_data['password'] = self.password
         else:
-            return {}
+            tmp_json_data['grant_type'] = 'client_credentials'
+
+        now = time.time()
+
+        tmp_kwargs = {'timeout': self._get_timeout(None)} if self.connect_timeout or self.read_timeout else {}
+
+        with TOKEN_FETCH_SECONDS.labels(tmp_json_data['grant_type']).time():
+            response = self.session.post(tmp_url, headers=tmp_headers, data=tmp_json_data, **tmp_kwargs)
+
+        if refresh_token and response.status_code in (400, 401):
+            # Refresh token was revoked or the IdP session ended, log in again
+            self.logger.info('Refresh token rejected, fetching new token')
+            self.refresh_token = None
+            self.refresh_token_expiry = None
+            return self._fetch_token()
+
+        response.raise_for_status()
+        data = response.json()
+
+        self.access_token = data['access_token']
+        self.token_expiry = now + data['expires_in']
+
+        if 'refresh_token' in data:
+            self.refresh_token = data['refresh_token']
+            self.refresh_token_expiry = now + data['refresh_expires_in']
+
+        self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        if not self.background_refresh:
+            return
+
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+
+        remaining = self.token_expiry - time.time()
+        delay = max(remaining - self.refresh_margin, remaining / 2, 0)
+        self._refresh_timer = threading.Timer(delay, self._refresh)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _refresh(self):
+        try:
+            with self._token_lock:
+                self._update_token()
+        except Exception as e:
+            # The token is fetched on the next request instead
+            self.logger.error(f'Background token refresh failed with error: {e.__class__} {e}')
+
+    def _get_timeout(self, timeout):
+        # A single number from the caller is the read timeout, the connect timeout stays short so an unreachable host fails fast
+        if timeout is None:
+            return (self.connect_timeout, self.read_timeout)
+        if isinstance(timeout, (int, float)) and self.connect_timeout:
+            return (self.connect_timeout, timeout)
+        return timeout
+
+    def _get_retry_delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    self.logger.warning(f'Ignoring malformed Retry-After header: {retry_after}')
+                    delay = None
+            if delay is not None:
+                # Do not wait longer than the backoff allows, the caller is better off failing
+                return max(delay, 0) if delay <= self.backoff_max else None
+
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * 2 ** attempt))
 
     def make_request(self, **kwargs):
+        """
+        Make a request to the API. Idempotent requests are retried with jittered exponential backoff on connection errors,
+        timeouts, 429 and 5xx responses, up to max_retries times. POST requests can be marked as idempotent with idempotent=True.
+
+        :return: The JSON response, the response content or None if the request failed
+        """
         try:
-            if self.cert_data:
-                import requests_pkcs12 as requests
-                kwargs['pkcs12_data'] = self.cert_data
-                kwargs['pkcs12_password'] = self.password
-            else:
-                import requests
+            session = self.session
 
             if 'path' in kwargs:
                 if not isinstance(kwargs['path'], str):
                     raise ValueError('Path must be a string')
-                url = self.base_url.rstrip('/') + '/' + kwargs.pop('path').lstrip('/')
+                path = kwargs.pop('path').lstrip('/')
+                url = self.base_url.rstrip('/') + '/' + path
             else:
+                path = ''
                 url = self.base_url
 
             if 'headers' in kwargs:
@@ -110,18 +369,64 @@ class APIClient:
 
             if not any(ele in kwargs for ele in ['method', 'json', 'data', 'files']):
                 method_string = 'GET'
-                method = requests.get
+                method = session.get
             elif 'method' in kwargs:
                 method_string = kwargs.pop('method').strip().upper()
-                method = getattr(requests, method_string.lower())
+                method = getattr(session, method_string.lower())
             else:
                 method_string = 'POST'
-                method = requests.post
+                method = session.post
 
             if 'json' in kwargs:
                 kwargs['headers']['Content-Type'] = 'application/json'
 
-            response = method(url, **kwargs)
+            idempotent = kwargs.pop('idempotent', method_string in IDEMPOTENT_METHODS)
+            if self.connect_timeout or self.read_timeout or 'timeout' in kwargs:
+                kwargs['timeout'] = self._get_timeout(kwargs.get('timeout'))
+
+            attempt = 0
+            while True:
+                if self.circuit_breaker and not self.circuit_breaker.allow():
+                    API_CIRCUIT_REJECTIONS.labels(path).inc()
+                    raise CircuitOpenError(f'Circuit open for {self.base_url}, failing fast')
+
+                if self.rate_limiter:
+                    RATE_LIMIT_WAIT_SECONDS.labels(path).observe(self.rate_limiter.acquire())
+
+                start = time.perf_counter()
+                status = 'error'
+                try:
+                    response = method(url, **kwargs)
+                    status = str(response.status_code)
+                except Exception as e:
+                    if self.circuit_breaker:
+                        self.circuit_breaker.record_failure()
+                    if not isinstance(e, self._retry_errors) or not idempotent or attempt >= self.max_retries:
+                        raise
+                    delay = self._get_retry_delay(attempt)
+                    self.logger.warning(f'{method_string} request to {url} failed with error: {e.__class__} {e}, retrying in {delay:.2f} s')
+                else:
+                    # A 429 means the API is up but throttling us, so it closes the circuit like a success. Every response has to
+                    # be recorded, a half open probe that is neither a success nor a failure would keep the circuit half open for good
+                    if self.circuit_breaker:
+                        if response.status_code in RETRY_STATUSES and response.status_code != 429:
+                            self.circuit_breaker.record_failure()
+                        else:
+                            self.circuit_breaker.record_success()
+                    if response.status_code not in RETRY_STATUSES:
+                        break
+
+                    delay = self._get_retry_delay(attempt, response) if idempotent and attempt < self.max_retries else None
+                    if delay is None:
+                        break
+                    self.logger.warning(f'{method_string} request to {url} returned status {response.status_code}, retrying in {delay:.2f} s')
+                finally:
+                    API_REQUEST_SECONDS.labels(path, status).observe(time.perf_counter() - start)
+
+                API_RETRIES.labels(path).inc()
+                attempt += 1
+                time.sleep(delay)
+
             response.raise_for_status()
 
             self.logger.info(f'{method_string} request to {url} successful')
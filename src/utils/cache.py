@@ -0,0 +1,193 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, max_entries=1000, ttl=300, negative_ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        # None is cached as a miss, with the shorter negative ttl
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+class TieredCache(TTLCache):
+    """
+    A TTLCache in front of a cache shared by all replicas, e.g. shared_cache.PostgresCache. Values are read from memory first,
+    then from the shared cache, and written to both. Without a shared cache it is a plain TTLCache.
+    """
+    def __init__(self, max_entries=1000, ttl=300, negative_ttl=None, shared=None, memory_ttl=None):
+        super().__init__(max_entries, ttl, negative_ttl)
+        self.shared = shared
+        self.memory_ttl = memory_ttl  # seconds values from the shared cache are kept in memory, 0 to always read the shared cache
+
+    def _set_memory(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        if self.shared is not None and self.memory_ttl is not None:
+            ttl = min(ttl, self.memory_ttl)
+        super().set(key, value, ttl)
+
+    def get(self, key, default=MISSING):
+        value = super().get(key)
+        if value is MISSING and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not MISSING:
+                self._set_memory(key, value)
+        return default if value is MISSING else value
+
+    def get_many(self, keys):
+        """
+        Get the cached values of several keys, with one round trip to the shared cache for the keys not in memory.
+
+        :return: A dictionary of the keys found and their values
+        """
+        found = {}
+        for key in keys:
+            value = super().get(key)
+            if value is not MISSING:
+                found[key] = value
+
+        if self.shared is not None:
+            shared = self.shared.get_many([key for key in keys if key not in found])
+            for key, value in shared.items():
+                self._set_memory(key, value)
+            found |= shared
+        return found
+
+    def set(self, key, value, ttl=None):
+        self._set_memory(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def set_many(self, items):
+        for key, value in items.items():
+            self._set_memory(key, value)
+        if self.shared is not None:
+            self.shared.set_many(items)
+
+    def get_or_load(self, key, load):
+        """
+        Get a cached value, or call load and cache its result. With a shared cache only one replica calls load for a key at a time,
+        the others wait for its result.
+        """
+        value = super().get(key)
+        if value is not MISSING:
+            return value
+
+        value = self.shared.get_or_load(key, load) if self.shared is not None else load()
+        self._set_memory(key, value)
+        return value
+
+    def delete(self, key):
+        super().delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def stats(self):
+        stats = super().stats()
+        if self.shared is not None:
+            stats['shared'] = self.shared.stats()
+        return stats
+
+
+class SingleFlight:
+    """Runs a function once per key at a time. Callers asking for a key that is already being loaded wait for that call and share its result."""
+    def __init__(self):
+        self.coalesced = 0
+
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        """
+        Call function, or wait for the call already in flight for key.
+
+        :return: A tuple of the result and whether it was shared with a call in flight
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = function()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
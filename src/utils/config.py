@@ -3,6 +3,8 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+DEBUG = os.environ.get("DEBUG", "False").strip() == "True"
+
 DELTA_URL = os.environ["DELTA_URL"].strip()
 DELTA_CLIENT_ID = os.environ["DELTA_CLIENT_ID"].strip()
 DELTA_CLIENT_SECRET = os.environ["DELTA_CLIENT_SECRET"].strip()
@@ -12,6 +14,14 @@ DELTA_AUTH_URL = "https://idp.opus-universe.kmd.dk"
 KEYCLOAK_URL = os.environ["KEYCLOAK_URL"].strip()
 KEYCLOAK_REALM = os.environ["KEYCLOAK_REALM"].strip()
 KEYCLOAK_CLIENT = os.environ["KEYCLOAK_CLIENT"].strip()
+KEYCLOAK_AUDIENCE = os.environ.get("KEYCLOAK_AUDIENCE", "").strip() or KEYCLOAK_CLIENT  # the API only accepts tokens with this aud or azp
+
+API_PORT = int(os.environ.get("API_PORT", 8081))
+API_THREADS = int(os.environ.get("API_THREADS", 16))
+API_MAX_BATCH_SIZE = int(os.environ.get("API_MAX_BATCH_SIZE", 1000))
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9090))  # /metrics, /healthz and /readyz of the Streamlit app, the API serves them itself
+HEALTH_CACHE_SECONDS = float(os.environ.get("HEALTH_CACHE_SECONDS", 10))  # readiness probe results are reused for this long
+HEALTH_PROBE_TIMEOUT = float(os.environ.get("HEALTH_PROBE_TIMEOUT", 3))  # seconds
 
 DB_SCHEMA = "telefonbog"
 DB_USER = os.environ['DB_USER']
@@ -19,3 +29,61 @@ DB_PASS = os.environ['DB_PASS']
 DB_HOST = os.environ['DB_HOST']
 DB_PORT = os.environ['DB_PORT']
 DB_DATABASE = os.environ['DB_DATABASE']
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))  # seconds, -1 to keep connections forever
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").strip().lower() == "true"  # test connections on checkout, drops stale connections after a failover
+MIGRATE_ON_START = os.environ.get("MIGRATE_ON_START", "true").strip().lower() == "true"  # run migrate.py when the app starts, false when it runs as a separate step
+
+CPR_HASH_KEY = os.environ.get("CPR_HASH_KEY", "").strip()  # required, see utils.verify_cpr_hash_key
+
+DIRECTORY_SYNC_INTERVAL = int(os.environ.get("DIRECTORY_SYNC_INTERVAL", 900))  # seconds
+DIRECTORY_PAGE_SIZE = int(os.environ.get("DIRECTORY_PAGE_SIZE", 1000))
+SEARCH_INDEX_REFRESH_INTERVAL = int(os.environ.get("SEARCH_INDEX_REFRESH_INTERVAL", 60))  # seconds, each replica refreshes its own index from the employee table
+DEPARTMENT_PAGE_SIZE = int(os.environ.get("DEPARTMENT_PAGE_SIZE", 50))  # employees per page when browsing a department
+DEPARTMENT_CACHE_TTL = int(os.environ.get("DEPARTMENT_CACHE_TTL", 300))  # seconds a page of the organisation tree is cached for all Streamlit sessions
+
+CPR_BATCH_SIZE = int(os.environ.get("CPR_BATCH_SIZE", 100))
+SEARCH_CONCURRENCY = int(os.environ.get("SEARCH_CONCURRENCY", 8))
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", 10))  # seconds
+DELTA_POOL_SIZE = int(os.environ.get("DELTA_POOL_SIZE", 16))  # should be at least SEARCH_CONCURRENCY
+DELTA_CONNECT_TIMEOUT = float(os.environ.get("DELTA_CONNECT_TIMEOUT", 3.05))  # seconds
+DELTA_READ_TIMEOUT = float(os.environ.get("DELTA_READ_TIMEOUT", 30))  # seconds, for requests without their own timeout
+DELTA_MAX_RETRIES = int(os.environ.get("DELTA_MAX_RETRIES", 2))
+DELTA_BACKOFF_FACTOR = float(os.environ.get("DELTA_BACKOFF_FACTOR", 0.25))  # seconds, doubled for each retry
+DELTA_BACKOFF_MAX = float(os.environ.get("DELTA_BACKOFF_MAX", 5))  # seconds, also the longest Retry-After that is honored
+DELTA_CIRCUIT_FAILURES = int(os.environ.get("DELTA_CIRCUIT_FAILURES", 5))  # consecutive failures before failing fast
+DELTA_CIRCUIT_RESET = float(os.environ.get("DELTA_CIRCUIT_RESET", 30))  # seconds before a probe request is let through
+DELTA_RATE_LIMIT = float(os.environ.get("DELTA_RATE_LIMIT", 20))  # requests per second for the whole process, 0 to disable
+DELTA_RATE_BURST = int(os.environ.get("DELTA_RATE_BURST", 40))  # requests allowed at once before the rate limit applies
+
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 1000))
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", 300))  # seconds
+SEARCH_CACHE_NEGATIVE_TTL = int(os.environ.get("SEARCH_CACHE_NEGATIVE_TTL", 30))  # seconds, for searches without result
+SESSION_RESULT_CACHE_SIZE = int(os.environ.get("SESSION_RESULT_CACHE_SIZE", 20))  # searches with rendered results kept per Streamlit session
+
+SHARED_CACHE = os.environ.get("SHARED_CACHE", "false").strip().lower() == "true"  # share search results and the Delta token between replicas through the database
+SHARED_CACHE_KEY = os.environ.get("SHARED_CACHE_KEY", "").strip()  # hashes keys and encrypts values in the shared cache, must be the same on all replicas
+SHARED_CACHE_MEMORY_TTL = int(os.environ.get("SHARED_CACHE_MEMORY_TTL", 30))  # seconds shared search results are also kept in memory, 0 to always read the database
+SHARED_CACHE_LEASE = float(os.environ.get("SHARED_CACHE_LEASE", 10))  # seconds other replicas wait for a value being loaded, before loading it themselves
+SHARED_CACHE_CLEANUP_INTERVAL = int(os.environ.get("SHARED_CACHE_CLEANUP_INTERVAL", 3600))  # seconds
+
+AUDIT_LOG_QUEUE_SIZE = int(os.environ.get("AUDIT_LOG_QUEUE_SIZE", 10000))
+AUDIT_LOG_BATCH_SIZE = int(os.environ.get("AUDIT_LOG_BATCH_SIZE", 500))
+AUDIT_LOG_FLUSH_INTERVAL = float(os.environ.get("AUDIT_LOG_FLUSH_INTERVAL", 1))  # seconds
+AUDIT_LOG_STRICT = os.environ.get("AUDIT_LOG_STRICT", "false").strip().lower() == "true"  # write audit log before searching
+AUDIT_LOG_PARTITIONS_AHEAD = int(os.environ.get("AUDIT_LOG_PARTITIONS_AHEAD", 2))  # monthly partitions created in advance
+AUDIT_LOG_RETENTION_MONTHS = int(os.environ.get("AUDIT_LOG_RETENTION_MONTHS", 24))  # older partitions are archived and dropped
+AUDIT_LOG_ARCHIVE_DIR = os.environ.get("AUDIT_LOG_ARCHIVE_DIR", "").strip()  # persistent volume, partitions are only dropped when set
+AUDIT_LOG_MAINTENANCE_INTERVAL = int(os.environ.get("AUDIT_LOG_MAINTENANCE_INTERVAL", 86400))  # seconds
+
+POD_NAME = os.environ.get("POD_NAME", os.environ.get("HOSTNAME", "telefonbog")).strip()  # identifies the replica claiming bulk job chunks
+BULK_JOB_WORKERS = int(os.environ.get("BULK_JOB_WORKERS", 2))  # worker threads per replica, 0 to only submit jobs
+BULK_JOB_CHUNK_SIZE = int(os.environ.get("BULK_JOB_CHUNK_SIZE", 500))  # rows per chunk, results are checkpointed after each chunk
+BULK_JOB_CHUNK_RATE = float(os.environ.get("BULK_JOB_CHUNK_RATE", 1))  # chunks per second for the whole process, leaves room for interactive searches, 0 to disable
+BULK_JOB_LEASE = int(os.environ.get("BULK_JOB_LEASE", 300))  # seconds before a chunk claimed by a stopped worker is claimed again
+BULK_JOB_MAX_ATTEMPTS = int(os.environ.get("BULK_JOB_MAX_ATTEMPTS", 3))  # failed attempts of a chunk before the job fails
+BULK_JOB_POLL_INTERVAL = float(os.environ.get("BULK_JOB_POLL_INTERVAL", 5))  # seconds
+BULK_JOB_RETENTION_DAYS = int(os.environ.get("BULK_JOB_RETENTION_DAYS", 7))  # jobs hold CPR numbers and are deleted after this
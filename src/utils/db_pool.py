@@ -0,0 +1,117 @@
+import time
+import threading
+
+from sqlalchemy import event, Engine
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from utils.metrics import DB_COMMIT_SECONDS
+
+
+class PoolMetrics:
+    """Counters for connection checkouts from a MeasuredQueuePool."""
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.invalidations = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+        self._lock = threading.Lock()
+
+    def observe_wait(self, seconds: float, timed_out: bool = False) -> None:
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def observe_invalidation(self) -> None:
+        with self._lock:
+            self.invalidations += 1
+
+
+class MeasuredQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waits for a connection, including the time to open a new one."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            self.metrics.observe_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        self.metrics.observe_wait(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+def track_invalidations(engine: Engine) -> None:
+    """
+    Count connections that are thrown away, e.g. stale connections detected by pool_pre_ping after a database failover.
+
+    :param engine: Engine created with poolclass=MeasuredQueuePool
+    """
+    @event.listens_for(engine, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        engine.pool.metrics.observe_invalidation()
+
+
+def track_commits(session_factory: sessionmaker) -> None:
+    """
+    Observe the latency of every commit of sessions from session_factory in DB_COMMIT_SECONDS, including the final flush.
+
+    :param session_factory: Session factory of the engine, e.g. the one used by database.get_session
+    """
+    @event.listens_for(session_factory, 'before_commit')
+    def on_before_commit(session):
+        session.info['commit_started'] = time.perf_counter()
+
+    @event.listens_for(session_factory, 'after_commit')
+    def on_after_commit(session):
+        started = session.info.pop('commit_started', None)
+        if started is not None:
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+    @event.listens_for(session_factory, 'after_rollback')
+    def on_after_rollback(session):
+        # A failed commit is not observed
+        session.info.pop('commit_started', None)
+
+
+def get_pool_stats(pool: QueuePool) -> dict:
+    """
+    Get the current state of a connection pool.
+
+    :param pool: The pool of an engine, e.g. database.get_engine().pool
+    :return: A dictionary with pool size, connections checked out and in, overflow and checkout wait statistics
+    """
+    stats = {
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'checked_in': pool.checkedin(),
+        'overflow': max(pool.overflow(), 0),
+        'max_overflow': pool._max_overflow
+    }
+
+    metrics = getattr(pool, 'metrics', None)
+    if metrics:
+        stats |= {
+            'checkouts': metrics.checkouts,
+            'timeouts': metrics.timeouts,
+            'invalidations': metrics.invalidations,
+            'wait_seconds_total': metrics.wait_seconds_total,
+            'wait_seconds_max': metrics.wait_seconds_max,
+            'wait_seconds_avg': metrics.wait_seconds_total / metrics.checkouts if metrics.checkouts else 0.0
+        }
+    return stats
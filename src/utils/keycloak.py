@@ -0,0 +1,72 @@
+import time
+import threading
+
+import jwt
+
+
+class KeycloakTokenValidator:
+    """
+    Validates Keycloak access tokens against the signing keys of the realm. Keys are fetched from the JWKS endpoint and cached for jwks_lifespan seconds.
+    A token signed with an unknown key, e.g. after Keycloak rotated its keys, fetches the keys again at most once per jwks_refresh_interval seconds,
+    so tokens with made up key ids can not make every request fetch the keys.
+    Only tokens issued to the audience are accepted, which defaults to client_id, so a token of another client in the realm is rejected.
+    """
+    def __init__(self, url: str, realm: str, client_id: str, audience: str | None = None, leeway: int = 30, jwks_lifespan: float = 300, jwks_refresh_interval: float = 30):
+        self.issuer = f'{url.rstrip("/")}/realms/{realm}'
+        self.client_id = client_id
+        self.audience = audience or client_id
+        self.leeway = leeway
+        self.jwks_refresh_interval = jwks_refresh_interval
+        self.jwks_client = jwt.PyJWKClient(f'{self.issuer}/protocol/openid-connect/certs', cache_jwk_set=True, lifespan=jwks_lifespan)
+
+        self._refreshed_at = None
+        self._refresh_lock = threading.Lock()
+
+    def validate(self, token: str) -> dict:
+        """
+        Validate the signature, issuer, expiry and audience of a token. Keycloak puts the client a token was issued to in azp,
+        and clients it may be used with in aud, so either has to be the audience.
+
+        :param token: Bearer token from the Authorization header
+        :return: The claims of the token
+        :raises jwt.PyJWTError: If the token is not valid
+        """
+        signing_key = self._get_signing_key(token)
+        claims = jwt.decode(
+            token,
+            signing_key.key,
+            algorithms=['RS256'],
+            issuer=self.issuer,
+            leeway=self.leeway,
+            options={'require': ['exp', 'iss'], 'verify_aud': False}
+        )
+
+        audience = claims.get('aud') or []
+        if isinstance(audience, str):
+            audience = [audience]
+        if claims.get('azp') != self.audience and self.audience not in audience:
+            raise jwt.InvalidAudienceError(f'Token is not issued to {self.audience}')
+        return claims
+
+    def _get_signing_key(self, token: str) -> jwt.PyJWK:
+        kid = jwt.get_unverified_header(token).get('kid')
+        signing_key = self._find_key(self.jwks_client.get_signing_keys(), kid)
+        if signing_key:
+            return signing_key
+
+        with self._refresh_lock:
+            if self._refreshed_at is not None and time.monotonic() - self._refreshed_at < self.jwks_refresh_interval:
+                raise jwt.PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+            self._refreshed_at = time.monotonic()
+            signing_key = self._find_key(self.jwks_client.get_signing_keys(refresh=True), kid)
+        if not signing_key:
+            raise jwt.PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+        return signing_key
+
+    @staticmethod
+    def _find_key(signing_keys: list[jwt.PyJWK], kid: str | None) -> jwt.PyJWK | None:
+        return next((key for key in signing_keys if kid and key.key_id == kid), None)
+
+    def get_roles(self, claims: dict) -> list[str]:
+        """Return the client roles of the token, the same roles the Streamlit app checks."""
+        return claims.get('resource_access', {}).get(self.client_id, {}).get('roles', [])
@@ -11,7 +11,7 @@ from utils.config import DEBUG
 def set_logging_configuration():
     log_level = logging.DEBUG if DEBUG else logging.INFO
     logging.basicConfig(stream=sys.stdout, level=log_level, format='[%(asctime)s] %(levelname)s - %(name)s - %(module)s:%(funcName)s - %(message)s', datefmt='%d-%m-%Y %H:%M:%S')
-    disable_endpoint_logs(('/metrics', '/healthz'))
+    disable_endpoint_logs(('/metrics', '/healthz', '/readyz'))
 
 
 def disable_endpoint_logs(disabled_endpoints):
@@ -0,0 +1,60 @@
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+API_REQUEST_SECONDS = Histogram('telefonbog_api_request_seconds', 'Latency of HTTP requests made by APIClient.make_request', ['path', 'status'])
+API_RETRIES = Counter('telefonbog_api_retries_total', 'Requests retried by APIClient.make_request', ['path'])
+API_CIRCUIT_REJECTIONS = Counter('telefonbog_api_circuit_rejections_total', 'Requests failed fast by an open circuit breaker', ['path'])
+RATE_LIMIT_WAIT_SECONDS = Histogram('telefonbog_rate_limit_wait_seconds', 'Time requests waited for the APIClient rate limiter', ['path'], buckets=(0, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+TOKEN_FETCH_SECONDS = Histogram('telefonbog_token_fetch_seconds', 'Latency of token requests made by APIClient', ['grant_type'])
+SEARCH_PARSE_SECONDS = Histogram('telefonbog_search_parse_seconds', 'Time spent parsing Delta graph query results', buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+DB_COMMIT_SECONDS = Histogram('telefonbog_db_commit_seconds', 'Latency of database commits, including the final flush')
+SEARCH_BATCH_SIZE = Histogram('telefonbog_search_batch_size', 'Number of CPR numbers per batch search', buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
+SEARCH_COALESCED = Counter('telefonbog_search_coalesced_total', 'Searches that shared the result of an identical search already in flight')
+DELTA_ERRORS = Counter('telefonbog_delta_errors_total', 'Delta lookups that failed', ['reason'])
+
+
+class CacheCollector(Collector):
+    """Exposes the counters of a TTLCache, which counts hits and misses itself. The shared tier of a TieredCache is labelled <name>_shared."""
+    def __init__(self, name: str, cache):
+        self.name = name
+        self.cache = cache
+
+    def collect(self):
+        stats = self.cache.stats()
+        tiers = [(self.name, stats)]
+        if 'shared' in stats:
+            tiers.append((f'{self.name}_shared', stats['shared']))
+
+        for stat in ('hits', 'misses', 'evictions', 'expirations', 'errors', 'lease_waits'):
+            counter = CounterMetricFamily(f'telefonbog_cache_{stat}', f'Number of cache {stat.replace("_", " ")}', labels=['cache'])
+            for name, tier in tiers:
+                if stat in tier:
+                    counter.add_metric([name], tier[stat])
+            yield counter
+        entries = GaugeMetricFamily('telefonbog_cache_entries', 'Number of entries in the cache', labels=['cache'])
+        entries.add_metric([self.name], stats['entries'])
+        yield entries
+
+
+class PoolCollector(Collector):
+    """Exposes the statistics of a database connection pool, see utils.db_pool.get_pool_stats."""
+    def __init__(self, get_stats):
+        self.get_stats = get_stats
+
+    def collect(self):
+        stats = self.get_stats()
+        for stat in ('size', 'checked_out', 'checked_in', 'overflow'):
+            yield GaugeMetricFamily(f'telefonbog_db_pool_{stat}', f'Database connection pool {stat.replace("_", " ")}', value=stats[stat])
+        for stat in ('checkouts', 'timeouts', 'invalidations'):
+            yield CounterMetricFamily(f'telefonbog_db_pool_{stat}', f'Database connection pool {stat}', value=stats.get(stat, 0))
+        yield CounterMetricFamily('telefonbog_db_pool_wait_seconds', 'Total time spent waiting for a database connection', value=stats.get('wait_seconds_total', 0.0))
+
+
+def register_collector(collector: Collector) -> None:
+    """Register a collector with the default registry. Registering the same kind of collector twice is ignored."""
+    try:
+        REGISTRY.register(collector)
+    except ValueError:
+        # Duplicated timeseries, e.g. when Streamlit reruns a script that registers a collector
+        pass
@@ -0,0 +1,249 @@
+import re
+import heapq
+import bisect
+import threading
+from collections import Counter
+from collections.abc import Callable, Iterable, Hashable
+from typing import Any
+
+_WORD_SPLIT = re.compile(r'[\s,;:()/]+')
+_EMAIL_SPLIT = re.compile(r'[.@_+\-]+')
+
+EXACT_SCORE = 3.0
+PREFIX_SCORE = 2.0
+FUZZY_SCORE = 1.0
+
+
+def tokenize(text: str) -> list[str]:
+    """Split text into lower case words."""
+    return [token for token in _WORD_SPLIT.split(text.casefold()) if token and token != '-']
+
+
+def email_tokens(email: str) -> list[str]:
+    """The whole e-mail address and its parts, so both 'jens.hansen@' and 'hansen' match."""
+    email = email.strip().casefold()
+    if not email or email == '-':
+        return []
+    return [email] + [token for token in _EMAIL_SPLIT.split(email) if token]
+
+
+def phone_tokens(phone: str) -> list[str]:
+    """The digits of a phone number, also without a country code, so '+45 12 34 56 78' matches '1234'."""
+    digits = ''.join(c for c in phone if c.isdigit())
+    if not digits:
+        return []
+    return [digits, digits[-8:]] if len(digits) > 8 else [digits]
+
+
+def trigrams(token: str) -> set[str]:
+    # Only padded at the start, so a prefix has the same trigrams as the beginning of the word
+    padded = f'  {token}'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    Optimal string alignment distance, counting a swap of two neighbouring characters as one edit.
+
+    :return: The distance, or max_distance + 1 if it is larger than max_distance
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+class SearchIndex:
+    """
+    In-memory inverted index for search-as-you-type. Every word of a query has to match a word of the document,
+    either exactly, as a prefix or, for words of min_fuzzy_length characters or more that match nothing else, as a prefix with a typo.
+    Words with typos are found through a trigram index of the words in the index, so only similar words are compared.
+
+    Documents are added and removed with update, which only reindexes the documents that changed.
+    Searches and updates are serialized by a lock, updates are small and searches take a few milliseconds.
+    """
+    def __init__(self, get_tokens: Callable[[Any], Iterable[str]], sort_key: Callable[[Any], Any] | None = None, min_fuzzy_length: int = 4):
+        """
+        :param get_tokens: Function returning the words of a document, see tokenize, email_tokens and phone_tokens
+        :param sort_key: Orders documents with the same score, e.g. by name. Documents are ordered by id if not set
+        :param min_fuzzy_length: Query words shorter than this must match exactly or as a prefix
+        """
+        self.get_tokens = get_tokens
+        self.sort_key = sort_key
+        self.min_fuzzy_length = min_fuzzy_length
+
+        self._documents = {}  # id -> (version, document, tokens)
+        self._postings = {}  # token -> ids of the documents containing it
+        self._trigrams = {}  # trigram -> tokens containing it, only words that can be misspelled
+        self._sorted_tokens = []  # for prefix lookups with bisect
+        self._rank = {}  # id -> position by sort_key, so results are ordered without calling sort_key on every search
+        self.generation = 0  # incremented by every update that changes the index, e.g. to know when stored results are stale
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def versions(self) -> dict[Hashable, Any]:
+        """Get the version of every document in the index, e.g. to find the documents that changed since the last update."""
+        with self._lock:
+            return {id_: version for id_, (version, _, _) in self._documents.items()}
+
+    def update(self, documents: dict[Hashable, tuple[Any, Any]] | None = None, removed: Iterable[Hashable] = ()) -> None:
+        """
+        Add, replace and remove documents.
+
+        :param documents: Dictionary mapping ids to (version, document) tuples. Documents already indexed with the same version are skipped
+        :param removed: Ids of documents to remove
+        """
+        with self._lock:
+            changed = False
+            tokens_changed = False
+            for id_ in removed:
+                if id_ in self._documents:
+                    tokens_changed |= self._remove(id_)
+                    changed = True
+
+            for id_, (version, document) in (documents or {}).items():
+                existing = self._documents.get(id_)
+                if existing and existing[0] == version:
+                    continue
+                if existing:
+                    tokens_changed |= self._remove(id_)
+                changed = True
+
+                tokens = frozenset(self.get_tokens(document))
+                self._documents[id_] = (version, document, tokens)
+                for token in tokens:
+                    if token not in self._postings:
+                        self._postings[token] = set()
+                        if _can_be_misspelled(token):
+                            for trigram in trigrams(token):
+                                self._trigrams.setdefault(trigram, set()).add(token)
+                        tokens_changed = True
+                    self._postings[token].add(id_)
+
+            # Sorted once per update rather than per document, so a full build only sorts once
+            if tokens_changed:
+                self._sorted_tokens = sorted(self._postings)
+            if changed:
+                if self.sort_key:
+                    order = sorted(self._documents, key=lambda id_: self.sort_key(self._documents[id_][1]))
+                else:
+                    order = sorted(self._documents)
+                self._rank = {id_: i for i, id_ in enumerate(order)}
+                self.generation += 1
+
+    def _remove(self, id_: Hashable) -> bool:
+        _, _, tokens = self._documents.pop(id_)
+
+        tokens_removed = False
+        for token in tokens:
+            postings = self._postings[token]
+            postings.discard(id_)
+            if not postings:
+                del self._postings[token]
+                if _can_be_misspelled(token):
+                    for trigram in trigrams(token):
+                        self._trigrams[trigram].discard(token)
+                        if not self._trigrams[trigram]:
+                            del self._trigrams[trigram]
+                tokens_removed = True
+        return tokens_removed
+
+    def search(self, query: str, limit: int = 20) -> list:
+        """
+        Find the documents matching every word of the query, best matches first.
+
+        :param query: Words to search for, e.g. the start of a name, an e-mail address, a department or a phone number
+        :param limit: Maximum number of documents to return
+        :return: A list of documents
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+
+        with self._lock:
+            scores = None  # summed over the words of the query, only needed for more than one word
+            for term in sorted(terms, key=len, reverse=True):  # long words match fewer documents
+                # Set operations run in C, a short word like 'a' can match most of the index
+                levels = {}
+                found = set()
+                for score, tokens in sorted(self._match(term).items(), reverse=True):
+                    ids = set().union(*map(self._postings.__getitem__, tokens))
+                    if scores is not None:
+                        ids &= scores.keys()
+                    ids -= found
+                    found |= ids
+                    levels[score] = ids
+                if not found:
+                    return []
+
+                if len(terms) > 1:
+                    previous = scores or {}
+                    scores = {id_: previous.get(id_, 0.0) + score for score, ids in levels.items() for id_ in ids}
+
+            if len(terms) > 1:
+                levels = {}
+                for id_, score in scores.items():
+                    levels.setdefault(score, []).append(id_)
+
+            best = []
+            for score in sorted(levels, reverse=True):
+                best += heapq.nsmallest(limit - len(best), levels[score], key=self._rank.__getitem__)
+                if len(best) >= limit:
+                    break
+            return [self._documents[id_][1] for id_ in best]
+
+    def _match(self, term: str) -> dict[float, list[str]]:
+        """Get the indexed words matching a query word, grouped by score."""
+        start = bisect.bisect_left(self._sorted_tokens, term)
+        end = bisect.bisect_left(self._sorted_tokens, term[:-1] + chr(ord(term[-1]) + 1), start)
+        matches = {}
+        if start < end and self._sorted_tokens[start] == term:
+            matches[EXACT_SCORE] = [term]
+            start += 1
+        if start < end:
+            matches[PREFIX_SCORE] = self._sorted_tokens[start:end]
+
+        # Typos are only looked for when nothing starts with the word, and not in numbers, e.g. phone and DQ numbers
+        if not matches and len(term) >= self.min_fuzzy_length and _can_be_misspelled(term):
+            max_distance = 1 if len(term) < 8 else 2
+            term_trigrams = trigrams(term)
+            # Each edit changes at most three trigrams, a swap of two characters at most four
+            min_shared = max(2, len(term_trigrams) - 3 * max_distance - 1)
+
+            shared = Counter()
+            for trigram in term_trigrams:
+                shared.update(self._trigrams.get(trigram, ()))
+
+            distances = {}  # many words share their beginning, e.g. 'hansen' and 'hansens', so each beginning is only compared once
+            for token, count in shared.items():
+                if count < min_shared:
+                    continue
+                # Compared with the beginning of the word, so typos are found while the word is being typed
+                distance = max_distance + 1
+                for length in (len(term) - 1, len(term), len(term) + 1):
+                    prefix = token[:length]
+                    if prefix not in distances:
+                        distances[prefix] = edit_distance(term, prefix, max_distance)
+                    distance = min(distance, distances[prefix])
+                if distance <= max_distance:
+                    matches.setdefault(FUZZY_SCORE - 0.25 * (distance - 1), []).append(token)
+        return matches
+
+
+def _can_be_misspelled(token: str) -> bool:
+    # Numbers and whole e-mail addresses are left out of the trigram index, the parts of an address are indexed as words
+    return '@' not in token and not any(c.isdigit() for c in token)
@@ -1,5 +1,12 @@
+import re
 import sys
+import hmac
+import hashlib
 import logging
+from itertools import accumulate
+from dataclasses import dataclass, field
+
+from utils.config import CPR_HASH_KEY
 
 
 # Logging configuration
@@ -7,15 +14,67 @@ def set_logging_configuration():
     logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='[%(asctime)s] %(levelname)s - %(name)s - %(module)s:%(funcName)s - %(message)s', datefmt='%d-%m-%Y %H:%M:%S')
 
 
-def get_cpr_list(text):
-    if text:
-        text = ''.join(text.split())
-        cpr_list = text.split(',')
-        if not cpr_list[-1]:
-            cpr_list.pop()
-        if all(verify_cpr(cpr) for cpr in cpr_list):
-            cpr_list = [cpr.replace('-', '') for cpr in cpr_list]
-            return cpr_list
+CPR_SEPARATORS = str.maketrans(';\t\n', ',,,')  # entries are separated by commas, semicolons, tabs or newlines
+# A valid entry between commas, with a real date of birth. 29 February needs a year divisible by 4, where 00 is 1900
+# unless the 7th digit is 4-9, see get_cpr_year
+CPR_DATE = r'(?:(?:0[1-9]|1\d|2[0-8])(?:0[1-9]|1[0-2])|(?:29|30)(?:0[13-9]|1[0-2])|31(?:0[13578]|1[02]))\d{2}-?\d'
+CPR_LEAP_DAY = r'2902(?:(?:[02468][048]|[13579][26])(?<!00)-?\d|00-?[4-9])'
+CPR_ENTRY = re.compile(rf'(?<![^,])(?:{CPR_DATE}|{CPR_LEAP_DAY})\d{{3}}(?![^,])')
+
+
+@dataclass(slots=True)
+class InvalidCpr:
+    line: int  # line of the pasted text, from 1
+    entry: int  # entry of the pasted text, from 1, counting both valid and invalid entries
+    value: str
+
+
+@dataclass(slots=True)
+class CprList:
+    cpr_list: list[str] = field(default_factory=list)  # valid CPR numbers without dashes, in the order first pasted
+    invalid: list[InvalidCpr] = field(default_factory=list)
+    duplicates: int = 0
+
+
+def get_cpr_year(year: int, digit: int) -> int:
+    """Get the year of birth of a CPR number from the two digit year and the 7th digit, which gives the century."""
+    if digit <= 3:
+        return 1900 + year
+    if digit in (4, 9):
+        return (2000 if year <= 36 else 1900) + year
+    return (2000 if year <= 57 else 1800) + year
+
+
+def get_cpr_list(text: str | None) -> CprList:
+    """
+    Parse pasted CPR numbers. The valid entries are found by one pass of CPR_ENTRY over the whole text and the rest of the work
+    is str and dict methods over the lists at once, so Python only loops over the entries when some are invalid.
+
+    :param text: CPR numbers separated by commas, semicolons, tabs or newlines, with or without a dash
+    :return: The valid CPR numbers without duplicates, the invalid entries with their position and the number of duplicates removed
+    """
+    if not text:
+        return CprList()
+
+    text = text.replace(' ', '').replace('\r', '')
+    entries_text = text.translate(CPR_SEPARATORS)  # same length as text, so offsets in one are offsets in the other
+    found = CPR_ENTRY.findall(entries_text)
+    valid = ','.join(found).replace('-', '').split(',') if found else []
+    cpr_list = list(dict.fromkeys(valid))
+    result = CprList(cpr_list, duplicates=len(valid) - len(cpr_list))
+
+    entries = entries_text.split(',')
+    if len(entries) - entries.count('') > len(found):
+        # Positions are only worked out when needed, each separator is one character and only newlines start a line
+        found = set(found)
+        lengths = list(accumulate(map(len, entries), initial=0))
+        numbers = list(accumulate(int(bool(entry)) for entry in entries))
+        line, offset = 1, 0
+        for i in [i for i, entry in enumerate(entries) if entry and entry not in found]:
+            line += text.count('\n', offset, lengths[i] + i)
+            offset = lengths[i] + i
+            result.invalid.append(InvalidCpr(line, numbers[i], entries[i]))
+    return result
 
 
 def verify_cpr(cpr):
@@ -23,6 +82,18 @@ def verify_cpr(cpr):
     return cpr.isdigit() and len(cpr) == 10
 
 
+def verify_cpr_hash_key():
+    # Without a key the hash is unkeyed, and all valid CPR numbers are few enough to hash them all and reverse it
+    if not CPR_HASH_KEY:
+        raise ValueError('A key is required for hashing CPR numbers, set CPR_HASH_KEY')
+
+
+def hash_cpr(cpr):
+    verify_cpr_hash_key()
+    cpr = cpr.replace('-', '')
+    return hmac.new(CPR_HASH_KEY.encode(), cpr.encode(), hashlib.sha256).hexdigest()
+
+
 def markdown_template(name, user, deaprtment, email, phone, mobile):
     return f"""
         >
@@ -1,9 +1,14 @@
+import time
+import json
 import pytest
 import base64
+import socket
+import threading
 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import MagicMock, patch
 
-from utils.api_requests import APIClient
+from utils.api_requests import APIClient, CircuitBreaker, TokenBucket
 
 
 def test_init():
@@ -21,7 +26,7 @@ def test_authenticate_api_key():
 
 
 @patch('time.time')
-@patch('requests.post')
+@patch('requests.Session.post')
 def test_authenticate_client_credentials(mock_post, mock_time):
     api_client = APIClient('http://testurl.com', client_id='test_id', client_secret='test_secret', realm='test_realm')
 
@@ -42,7 +47,7 @@ def test_authenticate_client_credentials(mock_post, mock_time):
 
 
 @patch('time.time')
-@patch('requests.post')
+@patch('requests.Session.post')
 def test_authenticate_user_password(mock_post, mock_time):
     api_client = APIClient('http://testurl.com', client_id='test_id', client_secret='test_secret', realm='test_realm', username='test_user', password='test_pass')
 
@@ -68,7 +73,7 @@ def test_authenticate_cert():
 
 
 @patch('time.time')
-@patch('requests.post')
+@patch('requests.Session.post')
 def test_authenticate_refresh_token(mock_post, mock_time):
     api_client = APIClient('http://testurl.com', client_id='test_id', client_secret='test_secret', realm='test_realm')
     api_client.access_token = 'test_token'
@@ -90,6 +95,126 @@ def test_authenticate_refresh_token(mock_post, mock_time):
     assert api_client.refresh_token == 'test_refresh_token'
 
 
+@patch('time.time')
+@patch('requests.Session.post')
+def test_authenticate_refresh_token_rejected(mock_post, mock_time):
+    api_client = APIClient('http://testurl.com', client_id='test_id', client_secret='test_secret', realm='test_realm')
+    api_client.access_token = 'old_token'
+    api_client.token_expiry = 10
+    api_client.refresh_token = 'revoked_refresh_token'
+    api_client.refresh_token_expiry = 20
+
+    mock_time.return_value = 15
+
+    rejected = MagicMock()
+    rejected.status_code = 400
+    res = MagicMock()
+    res.status_code = 200
+    res.raise_for_status.return_value = None
+    res.json.return_value = {'access_token': 'test_token', 'expires_in': 10}
+    mock_post.side_effect = [rejected, res]
+
+    assert api_client._authenticate() == {'Authorization': 'Bearer test_token'}
+    assert mock_post.call_count == 2
+    assert mock_post.call_args.kwargs['data']['grant_type'] == 'client_credentials'
+    assert api_client.refresh_token is None
+
+
+@patch('requests.Session.post')
+def test_authenticate_single_flight(mock_post):
+    api_client = APIClient('http://testurl.com', client_id='test_id', client_secret='test_secret', realm='test_realm')
+
+    fetching = threading.Event()
+    release = threading.Event()
+
+    def fetch_token(*args, **kwargs):
+        fetching.set()
+        release.wait(5)
+        res = MagicMock()
+        res.raise_for_status.return_value = None
+        res.json.return_value = {'access_token': 'test_token', 'expires_in': 300}
+        return res
+
+    mock_post.side_effect = fetch_token
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(api_client._authenticate())) for _ in range(10)]
+    threads[0].start()
+    fetching.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    mock_post.assert_called_once()
+    assert results == [{'Authorization': 'Bearer test_token'}] * 10
+
+
+@patch('threading.Timer')
+@patch('time.time')
+@patch('requests.Session.post')
+def test_authenticate_background_refresh(mock_post, mock_time, mock_timer):
+    api_client = APIClient('http://testurl.com', client_id='test_id', client_secret='test_secret', realm='test_realm', background_refresh=True, refresh_margin=30)
+
+    mock_time.return_value = 0
+
+    res = MagicMock()
+    res.raise_for_status.return_value = None
+    res.json.return_value = {'access_token': 'test_token', 'expires_in': 300, 'refresh_token': 'test_refresh_token', 'refresh_expires_in': 1800}
+    mock_post.return_value = res
+
+    assert api_client._authenticate() == {'Authorization': 'Bearer test_token'}
+    mock_timer.assert_called_once_with(270, api_client._refresh)
+    mock_timer.return_value.start.assert_called_once()
+
+    # Timer fires before the token expires, the refresh token grant is used
+    mock_time.return_value = 270
+    res.json.return_value = {'access_token': 'new_token', 'expires_in': 300, 'refresh_token': 'new_refresh_token', 'refresh_expires_in': 1800}
+    api_client._refresh()
+
+    assert mock_post.call_args.kwargs['data']['grant_type'] == 'refresh_token'
+    assert mock_post.call_args.kwargs['data']['refresh_token'] == 'test_refresh_token'
+    assert api_client._authenticate() == {'Authorization': 'Bearer new_token'}
+    assert mock_post.call_count == 2
+
+    api_client.close()
+    mock_timer.return_value.cancel.assert_called()
+
+
+@patch('time.time')
+@patch('requests.Session.post')
+def test_authenticate_token_cache_shared(mock_post, mock_time):
+    token_cache = MagicMock()
+    token_cache.get_or_load.return_value = {'access_token': 'shared_token', 'expires_at': 300}
+    api_client = APIClient('http://testurl.com', client_id='test_id', client_secret='test_secret', realm='test_realm', token_cache=token_cache)
+
+    mock_time.return_value = 0
+
+    assert api_client._authenticate() == {'Authorization': 'Bearer shared_token'}
+    assert api_client.token_expiry == 300
+    mock_post.assert_not_called()
+    assert token_cache.get_or_load.call_args.kwargs['fresh_for'] == 30  # a token about to expire is refreshed instead
+
+
+@patch('time.time')
+@patch('requests.Session.post')
+def test_authenticate_token_cache_miss(mock_post, mock_time):
+    token_cache = MagicMock()
+    token_cache.get_or_load.side_effect = lambda key, load, ttl, fresh_for: load()
+    api_client = APIClient('http://testurl.com', client_id='test_id', client_secret='test_secret', realm='test_realm', token_cache=token_cache)
+
+    mock_time.return_value = 0
+    res = MagicMock()
+    res.raise_for_status.return_value = None
+    res.json.return_value = {'access_token': 'test_token', 'expires_in': 300}
+    mock_post.return_value = res
+
+    assert api_client._authenticate() == {'Authorization': 'Bearer test_token'}
+    mock_post.assert_called_once()
+    assert token_cache.get_or_load.call_args.kwargs['ttl']({'access_token': 'test_token', 'expires_at': 300}) == 300
+
+
 def test_authenticate_no_realm():
     with pytest.raises(ValueError) as excinfo:
         api_client = APIClient('http://testurl.com', client_id='test_id', client_secret='test_secret', realm='test_realm')
@@ -100,7 +225,7 @@ def test_authenticate_no_realm():
 # make_request tests
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 def test_make_request_get(mock_get):
     api_client = APIClient('http://testurl.com', api_key='test_key')
 
@@ -114,7 +239,7 @@ def test_make_request_get(mock_get):
     mock_get.assert_called_once_with('http://testurl.com/test', headers={'Authorization': 'Bearer test_key'})
 
 
-@patch('requests.post')
+@patch('requests.Session.post')
 def test_make_request_post(mock_get):
     api_client = APIClient('http://testurl.com', api_key='test_key')
 
@@ -127,7 +252,7 @@ def test_make_request_post(mock_get):
     mock_get.assert_called_once_with('http://testurl.com/test', headers={'Authorization': 'Bearer test_key', 'Content-Type': 'application/json'}, json={'test': 'test'})
 
 
-@patch('requests.put')
+@patch('requests.Session.put')
 def test_make_request_put(mock_get):
     api_client = APIClient('http://testurl.com', api_key='test_key')
 
@@ -140,7 +265,7 @@ def test_make_request_put(mock_get):
     mock_get.assert_called_once_with('http://testurl.com', headers={'Authorization': 'Bearer test_key', 'custom': 'header'}, data='test')
 
 
-@patch('requests.delete')
+@patch('requests.Session.delete')
 def test_make_request_delete(mock_get):
     api_client = APIClient('http://testurl.com', api_key='test_key')
 
@@ -153,10 +278,11 @@ def test_make_request_delete(mock_get):
     mock_get.assert_called_once_with('http://testurl.com/test', headers={'Authorization': 'Bearer test_key'}, data='test')
 
 
-@patch('requests_pkcs12.post')
-def test_make_request_get_cert(mock_get):
+@patch('requests_pkcs12.Pkcs12Adapter')
+@patch('requests.Session.post')
+def test_make_request_get_cert(mock_get, mock_adapter):
     test_base64 = base64.b64encode(b'test_cert')
-    api_client = APIClient('http://testurl.com', cert_base64=test_base64, password='test_pass')
+    api_client = APIClient('http://testurl.com', cert_base64=test_base64, password='test_pass', pool_size=5)
 
     res = MagicMock()
     res.raise_for_status.return_value = None
@@ -164,7 +290,9 @@ def test_make_request_get_cert(mock_get):
     mock_get.return_value = res
 
     assert api_client.make_request(path='/test', json={'test': 'test'}) == b'ok'
-    mock_get.assert_called_once_with('http://testurl.com/test', json={'test': 'test'}, pkcs12_data=b'test_cert', pkcs12_password='test_pass', headers={'Content-Type': 'application/json'})
+    mock_adapter.assert_called_once_with(pkcs12_data=b'test_cert', pkcs12_password='test_pass', pool_maxsize=5)
+    assert api_client.session.get_adapter('https://testurl.com') is mock_adapter.return_value
+    mock_get.assert_called_once_with('http://testurl.com/test', json={'test': 'test'}, headers={'Content-Type': 'application/json'})
 
 
 def test_make_request_wrong_path():
@@ -179,3 +307,288 @@ def test_make_request_wrong_headers():
     api_client.logger = MagicMock()
     assert api_client.make_request(headers='not a dict') is None
     api_client.logger.error.assert_called_once_with("Request failed with error: <class 'ValueError'> Headers must be a dictionary")
+
+# session tests
+
+
+@patch('requests.Session.post')
+def test_session_reused(mock_post):
+    api_client = APIClient('http://testurl.com', client_id='test_id', client_secret='test_secret', realm='test_realm')
+
+    res = MagicMock()
+    res.raise_for_status.return_value = None
+    res.json.return_value = {'access_token': 'test_token', 'expires_in': 300}
+    res.content = b'ok'
+    mock_post.return_value = res
+
+    session = api_client.session
+    api_client.make_request(path='/test', data='test')
+    api_client.make_request(path='/test', data='test')
+
+    assert api_client.session is session
+    assert mock_post.call_count == 3  # one token fetch and two requests
+
+
+def test_session_pool_size():
+    api_client = APIClient('http://testurl.com', pool_size=3)
+
+    adapter = api_client.session.get_adapter('https://testurl.com')
+    assert adapter._pool_maxsize == 3
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in adapter.poolmanager.connection_pool_kw['socket_options']
+
+
+def test_session_no_keep_alive():
+    api_client = APIClient('http://testurl.com', keep_alive=False)
+
+    assert api_client.session.headers['Connection'] == 'close'
+
+
+def test_close():
+    with APIClient('http://testurl.com') as api_client:
+        session = api_client.session
+
+    assert api_client._session is None
+    assert api_client.session is not session
+
+# retry and circuit breaker tests, against a local stub server
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.respond()
+
+    def respond(self):
+        self.server.requests.append(self.command)
+        status, headers, delay = self.server.responses.pop(0) if self.server.responses else (200, {}, 0)
+        time.sleep(delay)
+
+        body = json.dumps({'status': status}).encode()
+        try:
+            self.send_response(status)
+            for key, value in (headers | {'Content-Type': 'application/json', 'Content-Length': str(len(body))}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+        except ConnectionError:
+            pass  # the client timed out
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.responses = []
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_retry_on_server_error(stub_server):
+    stub_server.responses = [(502, {}, 0), (503, {}, 0)]
+    api_client = APIClient(stub_server.url, max_retries=2, backoff_factor=0.01)
+
+    assert api_client.make_request(path='/test') == {'status': 200}
+    assert len(stub_server.requests) == 3
+
+
+def test_retry_gives_up(stub_server):
+    stub_server.responses = [(503, {}, 0)] * 3
+    api_client = APIClient(stub_server.url, max_retries=2, backoff_factor=0.01)
+
+    assert api_client.make_request(path='/test') is None
+    assert len(stub_server.requests) == 3
+
+
+def test_retry_after(stub_server):
+    stub_server.responses = [(429, {'Retry-After': '0.2'}, 0)]
+    api_client = APIClient(stub_server.url, max_retries=1, backoff_factor=0.01)
+
+    start = time.perf_counter()
+    assert api_client.make_request(path='/test') == {'status': 200}
+    assert time.perf_counter() - start >= 0.2
+
+
+def test_retry_after_longer_than_backoff_max(stub_server):
+    stub_server.responses = [(429, {'Retry-After': '120'}, 0)]
+    api_client = APIClient(stub_server.url, max_retries=1, backoff_max=5)
+
+    assert api_client.make_request(path='/test') is None
+    assert len(stub_server.requests) == 1
+
+
+def test_post_not_retried(stub_server):
+    stub_server.responses = [(503, {}, 0)]
+    api_client = APIClient(stub_server.url, max_retries=2, backoff_factor=0.01)
+
+    assert api_client.make_request(path='/test', data='test') is None
+    assert stub_server.requests == ['POST']
+
+
+def test_idempotent_post_retried(stub_server):
+    stub_server.responses = [(503, {}, 0)]
+    api_client = APIClient(stub_server.url, max_retries=2, backoff_factor=0.01)
+
+    assert api_client.make_request(path='/test', data='test', idempotent=True) == {'status': 200}
+    assert stub_server.requests == ['POST', 'POST']
+
+
+def test_read_timeout_retried(stub_server):
+    stub_server.responses = [(200, {}, 0.5)]
+    api_client = APIClient(stub_server.url, connect_timeout=1, read_timeout=0.1, max_retries=1, backoff_factor=0.01)
+
+    start = time.perf_counter()
+    assert api_client.make_request(path='/test') == {'status': 200}
+    assert time.perf_counter() - start < 0.5
+    assert len(stub_server.requests) == 2
+
+
+def test_timeout_number_is_read_timeout(stub_server):
+    api_client = APIClient(stub_server.url, connect_timeout=1, read_timeout=30)
+
+    assert api_client._get_timeout(5) == (1, 5)
+    assert api_client._get_timeout(None) == (1, 30)
+    assert api_client._get_timeout((2, 3)) == (2, 3)
+
+
+def test_connection_refused_fails():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    api_client = APIClient(f'http://127.0.0.1:{port}', connect_timeout=1, max_retries=1, backoff_factor=0.01)
+
+    assert api_client.make_request(path='/test') is None
+
+
+def test_circuit_breaker_fails_fast_and_recovers(stub_server):
+    stub_server.responses = [(503, {}, 0)] * 2
+    circuit_breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+    api_client = APIClient(stub_server.url, circuit_breaker=circuit_breaker)
+    api_client.logger = MagicMock()
+
+    assert api_client.make_request(path='/test') is None
+    assert api_client.make_request(path='/test') is None
+    assert circuit_breaker.state == 'open'
+
+    assert api_client.make_request(path='/test') is None
+    assert len(stub_server.requests) == 2
+    assert 'CircuitOpenError' in api_client.logger.error.call_args.args[0]
+
+    time.sleep(0.2)
+    assert api_client.make_request(path='/test') == {'status': 200}
+    assert circuit_breaker.state == 'closed'
+    assert len(stub_server.requests) == 3
+
+
+def test_circuit_breaker_half_open_probe_fails(stub_server):
+    stub_server.responses = [(503, {}, 0)] * 2
+    circuit_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    api_client = APIClient(stub_server.url, circuit_breaker=circuit_breaker)
+
+    assert api_client.make_request(path='/test') is None
+    time.sleep(0.1)
+    assert api_client.make_request(path='/test') is None
+    assert circuit_breaker.state == 'open'
+    assert api_client.make_request(path='/test') is None
+    assert len(stub_server.requests) == 2
+
+
+def test_circuit_breaker_half_open_probe_throttled(stub_server):
+    stub_server.responses = [(500, {}, 0), (429, {'Retry-After': '0'}, 0)]
+    circuit_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    api_client = APIClient(stub_server.url, circuit_breaker=circuit_breaker, max_retries=1)
+
+    assert api_client.make_request(path='/test', idempotent=False) is None
+    assert circuit_breaker.state == 'open'
+    time.sleep(0.1)
+
+    # the 429 probe closes the circuit, so the retry in the same call is let through
+    assert api_client.make_request(path='/test') == {'status': 200}
+    assert circuit_breaker.state == 'closed'
+    assert len(stub_server.requests) == 3
+
+    assert api_client.make_request(path='/test') == {'status': 200}
+
+
+def test_circuit_breaker_half_open_probe_throttled_without_retry(stub_server):
+    stub_server.responses = [(500, {}, 0), (429, {}, 0)]
+    circuit_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    api_client = APIClient(stub_server.url, circuit_breaker=circuit_breaker)
+
+    assert api_client.make_request(path='/test') is None
+    time.sleep(0.1)
+    assert api_client.make_request(path='/test') is None
+    assert circuit_breaker.state == 'closed' and not circuit_breaker._probing
+    assert api_client.make_request(path='/test') == {'status': 200}
+
+
+def test_malformed_retry_after_uses_backoff(stub_server):
+    stub_server.responses = [(503, {'Retry-After': 'soon'}, 0)]
+    api_client = APIClient(stub_server.url, max_retries=1, backoff_factor=0.01)
+
+    assert api_client.make_request(path='/test') == {'status': 200}
+    assert len(stub_server.requests) == 2
+
+
+def test_circuit_breaker_single_half_open_probe():
+    circuit_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    circuit_breaker.record_failure()
+
+    assert circuit_breaker.allow() is True
+    assert circuit_breaker.allow() is False
+    circuit_breaker.record_success()
+    assert circuit_breaker.allow() is True
+
+# rate limiter tests
+
+
+@patch('time.sleep')
+@patch('time.monotonic')
+def test_token_bucket_burst_then_rate(mock_time, mock_sleep):
+    mock_time.return_value = 0
+    token_bucket = TokenBucket(rate=10, burst=2)
+
+    assert token_bucket.acquire() == 0
+    assert token_bucket.acquire() == 0
+    assert token_bucket.acquire() == pytest.approx(0.1)
+    assert token_bucket.acquire() == pytest.approx(0.2)
+    mock_sleep.assert_called_with(pytest.approx(0.2))
+
+    # Tokens refill at the rate, up to the burst
+    mock_time.return_value = 10
+    assert token_bucket.acquire() == 0
+    assert token_bucket.stats() == {'rate': 10, 'burst': 2, 'waits': 2, 'wait_seconds': pytest.approx(0.3)}
+
+
+def test_rate_limiter_applies_to_retries(stub_server):
+    stub_server.responses = [(503, {}, 0)]
+    rate_limiter = MagicMock()
+    rate_limiter.acquire.return_value = 0.0
+    api_client = APIClient(stub_server.url, max_retries=1, backoff_factor=0.01, rate_limiter=rate_limiter)
+
+    assert api_client.make_request(path='/test') == {'status': 200}
+    assert rate_limiter.acquire.call_count == 2
+
+
+def test_rate_limiter_shared_by_threads(stub_server):
+    api_client = APIClient(stub_server.url, rate_limiter=TokenBucket(rate=50, burst=1))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=api_client.make_request, kwargs={'path': '/test'}) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(stub_server.requests) == 6
+    assert time.perf_counter() - start >= 0.09  # five requests wait 20 ms each after the first
@@ -0,0 +1,213 @@
+import time
+import jwt
+import pytest
+
+from unittest.mock import MagicMock, patch
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from api import create_app
+from delta import Person, search_cache
+from utils.keycloak import KeycloakTokenValidator
+
+
+KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+PERSON = Person(name='Test Testesen', email='test@randers.dk', phone='12345678', mobile='87654321', department='IT', dq_number='DQ123456')
+
+
+def make_token(roles=(), key=KEY, expires_in=300, issuer='https://keycloak.test/realms/test', azp='telefonbog', aud='account', kid='test-key', **user):
+    claims = {
+        'iss': issuer,
+        'exp': int(time.time()) + expires_in,
+        'azp': azp,
+        'aud': aud,
+        'preferred_username': 'test_user',
+        'email': 'test@test.dk',
+        'resource_access': {'telefonbog': {'roles': list(roles)}}
+    } | user
+    return jwt.encode({name: value for name, value in claims.items() if value is not None}, key, algorithm='RS256', headers={'kid': kid})
+
+
+def make_validator(audience=None):
+    validator = KeycloakTokenValidator('https://keycloak.test', 'test', 'telefonbog', audience=audience)
+    validator.jwks_client = MagicMock()
+    validator.jwks_client.get_signing_keys.return_value = [MagicMock(key_id='test-key', key=KEY.public_key())]
+    return validator
+
+
+def auth(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+@pytest.fixture(autouse=True)
+def clear_search_cache():
+    search_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def mock_audit_log():
+    with patch('delta.audit_log') as mock_audit_log:
+        yield mock_audit_log
+
+
+@pytest.fixture
+def validator():
+    return make_validator()
+
+
+@pytest.fixture
+def client(validator):
+    return create_app(MagicMock(), validator).test_client()
+
+
+def test_missing_token(client):
+    assert client.get('/api/dq/DQ123456').status_code == 401
+
+
+@pytest.mark.parametrize('token', [
+    make_token(key=rsa.generate_private_key(public_exponent=65537, key_size=2048)),
+    make_token(expires_in=-300),
+    make_token(issuer='https://other.test/realms/test'),
+    make_token(azp='other-client'),
+    make_token(azp='other-client', aud=['account', 'other-client']),
+    'not-a-token'
+])
+def test_invalid_token(client, token):
+    response = client.get('/api/dq/DQ123456', headers=auth(token))
+
+    assert response.status_code == 401
+    assert response.json == {'error': 'Invalid bearer token'}
+
+
+@patch('api.search')
+def test_token_for_audience(mock_search, client):
+    mock_search.return_value = [PERSON]
+
+    assert client.get('/api/dq/DQ123456', headers=auth(make_token(azp='other-client', aud=['account', 'telefonbog']))).status_code == 200
+    assert client.get('/api/dq/DQ123456', headers=auth(make_token(azp='other-client', aud='telefonbog'))).status_code == 200
+
+
+def test_token_for_configured_audience():
+    validator = make_validator(audience='telefonbog-api')
+
+    assert validator.validate(make_token(azp='telefonbog-api'))['azp'] == 'telefonbog-api'
+    with pytest.raises(jwt.InvalidAudienceError):
+        validator.validate(make_token())
+
+
+def test_unknown_key_refetched_once_per_interval(client, validator):
+    for _ in range(3):
+        assert client.get('/api/dq/DQ123456', headers=auth(make_token(kid='unknown-key'))).status_code == 401
+
+    assert [call.kwargs for call in validator.jwks_client.get_signing_keys.call_args_list].count({'refresh': True}) == 1
+
+
+def test_rotated_key_is_fetched(validator):
+    rotated = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    validator.jwks_client.get_signing_keys.side_effect = lambda refresh=False: [MagicMock(key_id='rotated-key' if refresh else 'test-key', key=rotated.public_key() if refresh else KEY.public_key())]
+
+    assert validator.validate(make_token(key=rotated, kid='rotated-key'))['azp'] == 'telefonbog'
+
+
+@patch('api.search')
+def test_dq_lookup(mock_search, client):
+    mock_search.return_value = [PERSON]
+
+    response = client.get('/api/dq/DQ123456', headers=auth(make_token()))
+
+    assert response.status_code == 200
+    assert response.json['results'][0]['email'] == 'test@randers.dk'
+    query, user = mock_search.call_args.args[:2]
+    assert query.values == ['DQ123456']
+    assert user == {'username': 'test_user', 'email': 'test@test.dk'}
+
+
+@patch('api.search')
+def test_dq_lookup_delta_error(mock_search, client):
+    mock_search.side_effect = ValueError('Intet svar fra Delta')
+
+    response = client.get('/api/dq/DQ123456', headers=auth(make_token()))
+
+    assert response.status_code == 502
+
+
+@patch('api.search_concurrent')
+def test_dq_batch_lookup(mock_search_concurrent, client):
+    mock_search_concurrent.return_value = [[PERSON], None]
+
+    response = client.post('/api/dq/batch', json={'dq': ['DQ123456', ' DQ654321 ']}, headers=auth(make_token()))
+
+    assert response.status_code == 200
+    assert [(r['dq'], len(r['results'])) for r in response.json['results']] == [('DQ123456', 1), ('DQ654321', 0)]
+    assert [query.values for query in mock_search_concurrent.call_args.args[0]] == [['DQ123456'], ['DQ654321']]
+
+
+def test_dq_batch_lookup_invalid(client):
+    response = client.post('/api/dq/batch', json={'dq': ['DQ123456', '']}, headers=auth(make_token()))
+
+    assert response.status_code == 400
+
+
+def test_cpr_lookup_requires_role(client):
+    response = client.post('/api/cpr', json={'cpr': '0101011234'}, headers=auth(make_token()))
+
+    assert response.status_code == 403
+
+
+@patch('api.search')
+def test_cpr_lookup(mock_search, client, mock_audit_log):
+    mock_search.return_value = [PERSON]
+
+    response = client.post('/api/cpr', json={'cpr': '010101-1234'}, headers=auth(make_token(['cpr'])))
+
+    assert response.status_code == 200
+    assert response.json['results'][0]['dq_number'] == 'DQ123456'
+    assert mock_search.call_args.args[0].values == ['0101011234']
+    mock_audit_log.log.assert_called_once()
+
+
+@patch('api.search')
+def test_cpr_lookup_service_account(mock_search, client, mock_audit_log):
+    mock_search.return_value = [PERSON]
+    token = make_token(['cpr'], azp='helpdesk-script', aud='telefonbog', preferred_username=None, email=None)
+
+    response = client.post('/api/cpr', json={'cpr': '0101011234'}, headers=auth(token))
+
+    assert response.status_code == 200
+    assert mock_audit_log.log.call_args.args[:2] == ('helpdesk-script', '')
+
+
+def test_token_without_user_or_client(client):
+    token = make_token(azp=None, preferred_username=None, email=None, aud='telefonbog')
+
+    assert client.get('/api/dq/DQ123456', headers=auth(token)).status_code == 401
+
+
+def test_cpr_lookup_invalid_cpr(client):
+    response = client.post('/api/cpr', json={'cpr': '1234'}, headers=auth(make_token(['cpr'])))
+
+    assert response.status_code == 400
+
+
+@patch('api.search_batch')
+def test_cpr_batch_lookup(mock_search_batch, client):
+    mock_search_batch.return_value = [PERSON, None]
+
+    response = client.post('/api/cpr/batch', json={'cpr': ['0101011234', '0202021234']}, headers=auth(make_token(['cpr'])))
+
+    assert response.status_code == 200
+    assert [(r['cpr'], r['email']) for r in response.json['results']] == [('0101011234', 'test@randers.dk'), ('0202021234', 'IKKE_FUNDET')]
+    assert response.json['results'][1]['person'] is None
+
+
+def test_cpr_batch_lookup_invalid(client):
+    response = client.post('/api/cpr/batch', json={'cpr': ['0101011234', 'abc']}, headers=auth(make_token(['cpr'])))
+
+    assert response.status_code == 400
+
+
+def test_metrics(client):
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    assert b'telefonbog_cache_hits_total{cache="search"}' in response.data
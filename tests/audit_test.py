@@ -0,0 +1,232 @@
+import gzip
+import pytest
+import threading
+
+from datetime import date, datetime
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from audit import AuditLogWriter, find_searches, ensure_partitions, archive_partitions, _add_months, _get_legacy_row
+from utils.utils import hash_cpr
+
+
+def make_writer(**kwargs):
+    db_session = MagicMock()
+    session_factory = MagicMock()
+    session_factory.return_value.__enter__.return_value = db_session
+    return AuditLogWriter(session_factory, **kwargs), db_session
+
+
+def written_rows(db_session):
+    return [row for call in db_session.execute.call_args_list for row in call.args[1]]
+
+
+def test_log_strict_writes_before_returning():
+    writer, db_session = make_writer(strict=True)
+
+    writer.log('test_user', 'test@test.dk', 'cpr', 'subject')
+
+    db_session.execute.assert_called_once()
+    db_session.commit.assert_called_once()
+    row = written_rows(db_session)[0]
+    assert (row['username'], row['email'], row['search_type'], row['subject_hash']) == ('test_user', 'test@test.dk', 'cpr', 'subject')
+    assert row['created_at']
+    assert writer._thread is None
+
+
+def test_log_strict_per_call():
+    writer, db_session = make_writer()
+
+    writer.log('test_user', 'test@test.dk', 'cpr', 'subject', strict=True)
+
+    db_session.execute.assert_called_once()
+    assert writer._thread is None
+
+
+def test_log_async_batches_rows():
+    writer, db_session = make_writer(batch_size=100, flush_interval=0.05)
+
+    writer.log_many([('test_user', 'test@test.dk', 'cpr_batch', f'subject {i}') for i in range(250)])
+    writer.flush()
+
+    assert [row['subject_hash'] for row in written_rows(db_session)] == [f'subject {i}' for i in range(250)]
+    assert db_session.execute.call_count == 3
+    writer.close()
+
+
+def test_log_does_not_wait_for_database():
+    writer, db_session = make_writer(flush_interval=0.01)
+    blocked = threading.Event()
+    db_session.execute.side_effect = lambda *args: blocked.wait(1)
+
+    writer.log('test_user', 'test@test.dk', 'cpr', 'subject')
+    writer.log('test_user', 'test@test.dk', 'cpr', 'subject')
+
+    assert not blocked.is_set()
+    blocked.set()
+    writer.close()
+
+
+def test_queue_full_writes_synchronously():
+    writer, db_session = make_writer(queue_size=1, flush_interval=10)
+    writer._stopped.set()  # keeps the queue from being consumed
+    writer._thread = MagicMock()
+
+    writer.log_many([('test_user', 'test@test.dk', 'cpr', 'subject')], strict=False)
+
+    db_session.execute.assert_called_once()
+
+
+def test_close_flushes_queue():
+    writer, db_session = make_writer(flush_interval=10)
+    writer._thread = MagicMock()  # no background thread, events stay queued
+
+    writer.log_many([('test_user', 'test@test.dk', 'cpr_batch', f'subject {i}') for i in range(3)])
+    db_session.execute.assert_not_called()
+
+    writer.close()
+
+    assert len(written_rows(db_session)) == 3
+
+
+def test_failed_write_is_retried():
+    writer, db_session = make_writer(flush_interval=0.01, retry_interval=0.01)
+    db_session.execute.side_effect = [OperationalError('INSERT', {}, Exception('connection refused')), None]
+
+    writer.log('test_user', 'test@test.dk', 'cpr', 'subject')
+    writer.flush()
+
+    assert db_session.execute.call_count == 2
+    writer.close()
+
+
+def test_bad_row_is_dropped_and_the_rest_written():
+    writer, db_session = make_writer(flush_interval=0.01, retry_interval=10)
+
+    def execute(statement, rows):
+        if any(row['email'] is None for row in rows):
+            raise IntegrityError('INSERT', {}, Exception('null value in column "email"'))
+    db_session.execute.side_effect = execute
+
+    writer.log_many([('test_user', 'test@test.dk', 'cpr_batch', f'subject {i}') for i in range(3)])
+    writer.log('service', None, 'cpr', 'bad subject')
+    writer.log_many([('test_user', 'test@test.dk', 'cpr_batch', f'subject {i}') for i in range(3, 5)])
+    writer.flush(timeout=1)
+
+    written = [call.args[1] for call in db_session.execute.call_args_list if all(row['email'] for row in call.args[1])]
+    assert sorted(row['subject_hash'] for rows in written for row in rows) == [f'subject {i}' for i in range(5)]
+    writer.close()
+
+
+def test_flush_times_out_while_database_is_down():
+    writer, db_session = make_writer(flush_interval=0.01, retry_interval=0.01)
+    db_session.execute.side_effect = OperationalError('INSERT', {}, Exception('connection refused'))
+
+    writer.log('test_user', 'test@test.dk', 'cpr', 'subject')
+    with pytest.raises(TimeoutError):
+        writer.flush(timeout=0.1)
+
+    writer.close()  # logs the failed final write instead of raising
+    assert not writer._thread.is_alive()
+
+
+def test_close_waits_for_write_in_progress():
+    writer, db_session = make_writer(flush_interval=0.01, retry_interval=0.01)
+    writing = threading.Event()
+    concurrent = []
+
+    def execute(*args):
+        concurrent.append(writing.is_set())
+        writing.set()
+        threading.Event().wait(0.1)
+        writing.clear()
+    db_session.execute.side_effect = execute
+
+    writer.log('test_user', 'test@test.dk', 'cpr', 'subject')
+    writing.wait(1)
+    writer._queue.put_nowait({'subject_hash': 'queued while writing'})
+    writer.close()
+
+    assert concurrent == [False, False]
+    assert len(written_rows(db_session)) == 2
+
+
+# Audit log table tests
+
+
+def test_add_months():
+    assert _add_months(date(2024, 11, 1), 1) == date(2024, 12, 1)
+    assert _add_months(date(2024, 12, 1), 1) == date(2025, 1, 1)
+    assert _add_months(date(2024, 1, 1), -13) == date(2022, 12, 1)
+
+
+@patch('audit.date')
+@patch('audit.get_partitions')
+def test_ensure_partitions_creates_missing_months(mock_get_partitions, mock_date):
+    mock_date.today.return_value = date(2024, 11, 15)
+    mock_date.side_effect = date
+    mock_get_partitions.return_value = {'audit_log_2024_11': date(2024, 11, 1)}
+    db_session = MagicMock()
+
+    created = ensure_partitions(db_session, months_ahead=2)
+
+    assert created == ['audit_log_2024_12', 'audit_log_2025_01']
+    sql = str(db_session.execute.call_args_list[0].args[0])
+    assert 'PARTITION OF telefonbog.audit_log' in sql
+    assert "FROM ('2024-12-01') TO ('2025-01-01')" in sql
+
+
+@patch('audit.date')
+@patch('audit.get_partitions')
+def test_archive_partitions_keeps_retention_period(mock_get_partitions, mock_date, tmp_path):
+    mock_date.today.return_value = date(2024, 11, 15)
+    mock_date.side_effect = date
+    mock_get_partitions.return_value = {
+        'audit_log_2023_11': date(2023, 11, 1),
+        'audit_log_2023_09': date(2023, 9, 1),
+        'audit_log_2023_10': date(2023, 10, 1)
+    }
+    db_session = MagicMock()
+    db_session.connection.return_value.connection.cursor.return_value.copy_expert.side_effect = lambda sql, file: file.write(b'id,created_at\n')
+
+    archived = archive_partitions(db_session, retention_months=12, archive_dir=str(tmp_path))
+
+    assert archived == [str(tmp_path / 'audit_log_2023_09.csv.gz'), str(tmp_path / 'audit_log_2023_10.csv.gz')]
+    assert gzip.open(archived[0]).read() == b'id,created_at\n'
+    statements = [str(call.args[0]) for call in db_session.execute.call_args_list]
+    assert 'DROP TABLE telefonbog.audit_log_2023_10' in statements
+    assert not any('audit_log_2023_11' in statement for statement in statements)
+    assert db_session.commit.call_count == 2
+
+
+@patch('audit.get_partitions')
+def test_archive_partitions_without_archive_dir(mock_get_partitions):
+    mock_get_partitions.return_value = {'audit_log_2000_01': date(2000, 1, 1)}
+    db_session = MagicMock()
+
+    assert archive_partitions(db_session, retention_months=12, archive_dir='') == []
+    db_session.execute.assert_not_called()
+    db_session.commit.assert_not_called()
+
+
+def test_find_searches_by_cpr_and_period():
+    db_session = MagicMock()
+
+    find_searches(db_session, cpr='0101011234', start=datetime(2024, 1, 1), end=datetime(2025, 1, 1), limit=10)
+
+    stmt = db_session.scalars.call_args.args[0]
+    params = stmt.compile(dialect=postgresql.dialect()).params
+    assert hash_cpr('0101011234') in params.values()
+    assert datetime(2024, 1, 1) in params.values()
+    assert 'ORDER BY telefonbog.audit_log.created_at DESC' in str(stmt.compile(dialect=postgresql.dialect()))
+
+
+def test_get_legacy_row():
+    created_at = datetime(2023, 5, 1)
+
+    row = _get_legacy_row('Searched for cpr: 010101-1234', 'test@test.dk', 'test_user', created_at)
+
+    assert row == {'username': 'test_user', 'email': 'test@test.dk', 'search_type': 'cpr', 'subject_hash': hash_cpr('0101011234'), 'created_at': created_at}
+    assert _get_legacy_row('Something else', 'test@test.dk', 'test_user', created_at)['search_type'] == 'legacy'
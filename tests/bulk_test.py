@@ -0,0 +1,121 @@
+import io
+import pytest
+
+from unittest.mock import MagicMock, patch
+
+from openpyxl import Workbook
+
+from bulk import CprFileReader, lookup_rows, write_csv, chunked
+from delta import Person
+
+
+USER = {'username': 'test_user', 'email': 'test@test.dk'}
+
+
+def make_xlsx(rows):
+    workbook = Workbook()
+    for row in rows:
+        workbook.active.append(row)
+    file = io.BytesIO()
+    workbook.save(file)
+    file.seek(0)
+    return file
+
+
+@pytest.fixture(autouse=True)
+def mock_audit_log():
+    with patch('delta.audit_log') as mock_audit_log:
+        yield mock_audit_log
+
+
+# CprFileReader tests
+
+
+def test_read_csv_single_column():
+    file = io.BytesIO(b'0101011234\r\n010101-1235\r\n\r\n0101011236\r\n')
+    reader = CprFileReader(file, 'cpr.csv', len(file.getvalue()))
+
+    assert list(reader) == [(1, '0101011234'), (2, '010101-1235'), (4, '0101011236')]
+    assert reader.progress == 1.0
+
+
+def test_read_csv_semicolon_with_header():
+    file = io.BytesIO('\ufeffNavn;CPR-nummer\r\nTest;0101011234\r\nTest 2;0202021234\r\n'.encode('utf-8'))
+
+    assert list(CprFileReader(file, 'cpr.csv')) == [(2, '0101011234'), (3, '0202021234')]
+
+
+def test_read_csv_unknown_header_skipped():
+    file = io.BytesIO(b'nummer\n0101011234\n')
+
+    assert list(CprFileReader(file, 'cpr.csv')) == [(2, '0101011234')]
+
+
+def test_read_csv_progress_while_streaming():
+    file = io.BytesIO(b''.join(f'{i:010}\n'.encode() for i in range(10000)))
+    reader = CprFileReader(file, 'cpr.csv', len(file.getvalue()))
+
+    rows = iter(reader)
+    next(rows)
+    assert 0 < reader.progress < 1
+    assert len(list(rows)) == 9999
+    assert reader.progress == 1.0
+
+
+def test_read_xlsx():
+    file = make_xlsx([['CPR', 'Navn'], [101011234, 'Test'], ['0202021234', 'Test 2'], [None, None]])
+    reader = CprFileReader(file, 'cpr.XLSX')
+
+    assert list(reader) == [(2, '0101011234'), (3, '0202021234')]
+    assert reader.progress == 1.0
+
+
+# lookup_rows tests
+
+
+def test_chunked():
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+@patch('bulk.search_batch')
+def test_lookup_rows_chunks_and_keeps_order(mock_search_batch):
+    mock_search_batch.side_effect = lambda queries, user, db_session: [Person(email=f'{cpr}@randers.dk', dq_number='DQ1') for query in queries for cpr in query.values]
+    session_factory = MagicMock()
+    rows = [(1, '0101011234'), (2, 'abc'), (3, '010101-1235'), (4, '0101011236')]
+
+    results = list(lookup_rows(iter(rows), USER, session_factory, chunk_size=2))
+
+    assert len(results) == 2
+    assert [r for chunk in results for r in chunk] == [
+        {'række': 1, 'cpr': '0101011234', 'email': '0101011234@randers.dk'},
+        {'række': 2, 'cpr': 'abc', 'email': 'UGYLDIGT_CPR'},
+        {'række': 3, 'cpr': '010101-1235', 'email': '0101011235@randers.dk'},
+        {'række': 4, 'cpr': '0101011236', 'email': '0101011236@randers.dk'}
+    ]
+    assert session_factory.call_count == 2
+
+
+@patch('delta.audit_log')
+@patch('bulk.search_batch')
+def test_lookup_rows_without_log(mock_search_batch, mock_audit_log):
+    mock_search_batch.return_value = [None]
+
+    assert list(lookup_rows([(1, '0101011234')], USER, MagicMock(), log=False)) == [[{'række': 1, 'cpr': '0101011234', 'email': 'IKKE_FUNDET'}]]
+    mock_audit_log.log_many.assert_not_called()
+
+
+@patch('bulk.search_batch')
+def test_lookup_rows_only_invalid(mock_search_batch):
+    results = list(lookup_rows([(1, 'abc')], USER, MagicMock()))
+
+    assert results == [[{'række': 1, 'cpr': 'abc', 'email': 'UGYLDIGT_CPR'}]]
+    mock_search_batch.assert_not_called()
+
+
+def test_write_csv():
+    file = io.StringIO()
+
+    write_csv([{'række': 1, 'cpr': '0101011234', 'email': 'a@randers.dk'}], file, header=True)
+    write_csv([{'række': 2, 'cpr': '0202021234', 'email': 'IKKE_FUNDET'}], file)
+
+    assert file.getvalue() == 'række;cpr;email\r\n1;0101011234;a@randers.dk\r\n2;0202021234;IKKE_FUNDET\r\n'
@@ -0,0 +1,228 @@
+import time
+import pytest
+import threading
+
+from unittest.mock import patch
+
+from utils.cache import TTLCache, TieredCache, SingleFlight, MISSING
+
+
+@patch('time.monotonic')
+def test_get_set(mock_time):
+    mock_time.return_value = 0
+    cache = TTLCache(max_entries=10, ttl=10)
+
+    assert cache.get('a') is MISSING
+    cache.set('a', [1])
+    assert cache.get('a') == [1]
+    assert cache.stats() == {'entries': 1, 'hits': 1, 'misses': 1, 'evictions': 0, 'expirations': 0}
+
+
+@patch('time.monotonic')
+def test_ttl(mock_time):
+    mock_time.return_value = 0
+    cache = TTLCache(max_entries=10, ttl=10)
+    cache.set('a', [1])
+
+    mock_time.return_value = 9
+    assert cache.get('a') == [1]
+
+    mock_time.return_value = 10
+    assert cache.get('a') is MISSING
+    assert cache.expirations == 1
+    assert len(cache) == 0
+
+
+@patch('time.monotonic')
+def test_negative_ttl(mock_time):
+    mock_time.return_value = 0
+    cache = TTLCache(max_entries=10, ttl=10, negative_ttl=2)
+    cache.set('a', None)
+
+    mock_time.return_value = 1
+    assert cache.get('a') is None
+
+    mock_time.return_value = 2
+    assert cache.get('a') is MISSING
+
+
+def test_zero_ttl_not_cached():
+    cache = TTLCache(max_entries=10, ttl=10, negative_ttl=0)
+    cache.set('a', None)
+
+    assert cache.get('a') is MISSING
+
+
+def test_lru_eviction():
+    cache = TTLCache(max_entries=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.evictions == 1
+
+
+def test_delete_and_clear():
+    cache = TTLCache(max_entries=10, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    cache.delete('a')
+    assert cache.get('a') is MISSING
+
+    cache.clear()
+    assert len(cache) == 0
+
+# TieredCache tests
+
+
+class SharedCache(TTLCache):
+    """Stands in for shared_cache.PostgresCache."""
+    def get_many(self, keys):
+        return {key: value for key in keys if (value := self.get(key)) is not MISSING}
+
+    def set_many(self, items):
+        for key, value in items.items():
+            self.set(key, value)
+
+    def get_or_load(self, key, load):
+        value = self.get(key)
+        if value is MISSING:
+            value = load()
+            self.set(key, value)
+        return value
+
+
+def test_tiered_reads_shared_cache_of_other_replica():
+    shared = SharedCache()
+    cache = TieredCache(ttl=300, shared=shared, memory_ttl=30)
+    other_replica = TieredCache(ttl=300, shared=shared, memory_ttl=30)
+
+    other_replica.set('a', [1])
+
+    assert cache.get('a') == [1]
+    assert cache._entries['a'][1] == [1]  # kept in memory
+    assert shared.hits == 1
+    assert cache.stats()['shared']['hits'] == 1
+
+
+@patch('time.monotonic')
+def test_tiered_memory_ttl(mock_time):
+    mock_time.return_value = 0
+    shared = SharedCache(ttl=300)
+    cache = TieredCache(ttl=300, shared=shared, memory_ttl=30)
+    cache.set('a', [1])
+
+    shared.set('a', [2])  # e.g. written by another replica
+    mock_time.return_value = 29
+    assert cache.get('a') == [1]
+    mock_time.return_value = 30
+    assert cache.get('a') == [2]
+
+
+def test_tiered_get_many_and_set_many():
+    shared = SharedCache()
+    cache = TieredCache(shared=shared)
+    cache.set('a', 1)
+    shared.set('b', 2)
+
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+
+    cache.set_many({'c': 3, 'd': None})
+    assert shared.get('c') == 3 and shared.get('d') is None
+
+
+def test_tiered_get_or_load():
+    cache = TieredCache(shared=SharedCache())
+    calls = []
+
+    def load():
+        calls.append(1)
+        return [1]
+
+    assert cache.get_or_load('a', load) == [1]
+    assert cache.get_or_load('a', load) == [1]
+    assert len(calls) == 1
+    assert TieredCache().get_or_load('a', load) == [1]  # without a shared cache
+
+
+# SingleFlight tests
+
+
+def run_threads(count, target):
+    results = [None] * count
+
+    def run(i):
+        results[i] = target()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_single_flight_coalesces_calls():
+    single_flight = SingleFlight()
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.1)
+        return [1]
+
+    results = run_threads(5, lambda: single_flight.do('a', load))
+
+    assert len(calls) == 1
+    assert [value for value, _ in results] == [[1]] * 5
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+    assert single_flight.coalesced == 4
+    assert len(single_flight) == 0
+
+
+def test_single_flight_shares_exception():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def load():
+        started.set()
+        release.wait(5)
+        raise ValueError('failed')
+
+    errors = []
+
+    def call():
+        try:
+            single_flight.do('a', load)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert len(errors) == 2
+
+    # The key is released, so the next call loads again
+    with pytest.raises(ValueError):
+        single_flight.do('a', load)
+
+
+def test_single_flight_different_keys():
+    single_flight = SingleFlight()
+
+    assert single_flight.do('a', lambda: 1) == (1, False)
+    assert single_flight.do('b', lambda: 2) == (2, False)
+    assert single_flight.coalesced == 0
@@ -0,0 +1,102 @@
+import pytest
+import threading
+
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.orm import sessionmaker
+
+from utils.db_pool import MeasuredQueuePool, track_invalidations, track_commits, get_pool_stats
+
+
+def make_engine(**kwargs):
+    engine = create_engine('sqlite://', poolclass=MeasuredQueuePool, **kwargs)
+    track_invalidations(engine)
+    return engine
+
+
+def test_pool_stats_checked_out_and_overflow():
+    engine = make_engine(pool_size=1, max_overflow=1)
+
+    first = engine.connect()
+    second = engine.connect()
+    stats = get_pool_stats(engine.pool)
+    assert stats['checked_out'] == 2
+    assert stats['overflow'] == 1
+    assert stats['checkouts'] == 2
+
+    first.close()
+    second.close()
+    stats = get_pool_stats(engine.pool)
+    assert stats['checked_out'] == 0
+    assert stats['checked_in'] == 1
+    assert stats['overflow'] == 0
+
+
+def test_pool_stats_wait_time():
+    engine = make_engine(pool_size=1, max_overflow=0, pool_timeout=5)
+    connection = engine.connect()
+
+    def release():
+        connection.close()
+
+    timer = threading.Timer(0.1, release)
+    timer.start()
+    with engine.connect():
+        pass
+    timer.join()
+
+    stats = get_pool_stats(engine.pool)
+    assert stats['checkouts'] == 2
+    assert stats['wait_seconds_max'] >= 0.05
+    assert stats['wait_seconds_avg'] > 0
+
+
+def test_pool_stats_timeout():
+    engine = make_engine(pool_size=1, max_overflow=0, pool_timeout=0.05)
+
+    with engine.connect():
+        with pytest.raises(TimeoutError):
+            engine.connect()
+
+    assert get_pool_stats(engine.pool)['timeouts'] == 1
+
+
+def test_pool_stats_invalidations():
+    engine = make_engine(pool_size=1, max_overflow=0)
+
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+        connection.invalidate()
+
+    assert get_pool_stats(engine.pool)['invalidations'] == 1
+
+
+def commit_count():
+    return REGISTRY.get_sample_value('telefonbog_db_commit_seconds_count')
+
+
+def test_commit_latency():
+    session_factory = sessionmaker(bind=make_engine())
+    track_commits(session_factory)
+    before = commit_count()
+
+    with session_factory() as session:
+        session.execute(text('SELECT 1'))
+        session.commit()
+        session.execute(text('SELECT 1'))
+        session.rollback()
+        session.commit()
+
+    assert commit_count() - before == 2
+    assert 'commit_started' not in session.info
+
+
+def test_metrics_survive_pool_recreate():
+    engine = make_engine(pool_size=1, max_overflow=0)
+    with engine.connect():
+        pass
+
+    engine.dispose()
+
+    assert get_pool_stats(engine.pool)['checkouts'] == 1
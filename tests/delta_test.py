@@ -0,0 +1,376 @@
+import json
+import time
+import pytest
+import threading
+
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy.exc import OperationalError
+
+from delta import search_cache, search, search_directory, get_cache_key, search_batch, get_cpr_search, get_dq_number_search, get_cpr_batch_search, get_emails, search_concurrent, run_concurrent, get_directory_search, GraphQuery, Person, parse_people, parse_instance
+from utils.utils import hash_cpr
+
+
+USER = {'username': 'test_user', 'email': 'test@test.dk'}
+
+
+@pytest.fixture(autouse=True)
+def clear_search_cache():
+    search_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def mock_audit_log():
+    with patch('delta.audit_log') as mock_audit_log:
+        yield mock_audit_log
+
+
+def make_instance(name='Test Testesen', email='test@randers.dk', phone='89151515', mobile='12345678', department='Digitalisering', dq_number='DQ123456', cpr='0101011234', uuid='engagement-uuid'):
+    return {
+        'identity': {'uuid': uuid},
+        'attributes': [
+            {'userKey': 'APOS-Types-Engagement-Attribute-Email', 'value': email},
+            {'userKey': 'APOS-Types-Engagement-Attribute-Phone', 'value': phone},
+            {'userKey': 'APOS-Types-Engagement-Attribute-Mobile', 'value': mobile}
+        ],
+        'typeRefs': [
+            {'userKey': 'APOS-Types-Engagement-TypeRelation-AdmUnit', 'targetObject': {'identity': {'name': department}}},
+            {'userKey': 'APOS-Types-Engagement-TypeRelation-Person', 'targetObject': {
+                'identity': {'userKey': cpr},
+                'attributes': [{'userKey': 'APOS-Types-Person-Attribute-SurnameAndName', 'value': name}],
+                'inTypeRefs': [{'targetObject': {'identity': {'name': dq_number}}}]
+            }}
+        ]
+    }
+
+
+def make_employee(**kwargs):
+    employee = MagicMock()
+    employee.name = kwargs.get('name', 'Test Testesen')
+    employee.email = kwargs.get('email', 'test@randers.dk')
+    employee.phone = kwargs.get('phone', '89151515')
+    employee.mobile = kwargs.get('mobile', '12345678')
+    employee.department = kwargs.get('department', 'Digitalisering')
+    employee.dq_number = kwargs.get('dq_number', 'DQ123456')
+    return employee
+
+
+def sent_values(mock_client):
+    criteria = json.loads(mock_client.make_request.call_args.kwargs['data'])['graphQueries'][0]['graphQuery']['criteria']['criteria'][0]
+    return [c['right']['value'] for c in criteria.get('criteria', [criteria])]
+
+
+PERSON = Person(name='Test Testesen', email='test@randers.dk', phone='89151515', mobile='12345678', department='Digitalisering', dq_number='DQ123456')
+
+# parser tests
+
+
+def test_parse_instance():
+    assert parse_instance(make_instance()) == (PERSON, 'engagement-uuid', '0101011234')
+
+
+def test_parse_instance_missing_values():
+    instance = make_instance(phone='')
+    instance['typeRefs'][1]['targetObject']['inTypeRefs'] = []
+    del instance['typeRefs'][0]
+
+    person, uuid, cpr = parse_instance(instance)
+    assert person.phone == '-'
+    assert person.dq_number == '-'
+    assert person.department == '-'
+
+
+def test_parse_instance_empty():
+    assert parse_instance({}) == (Person(), None, None)
+
+
+def test_parse_instance_first_value_wins():
+    instance = make_instance()
+    instance['attributes'].append({'userKey': 'APOS-Types-Engagement-Attribute-Email', 'value': 'other@randers.dk'})
+
+    assert parse_instance(instance)[0].email == 'test@randers.dk'
+
+
+def test_parse_people_streams():
+    instances = (make_instance(dq_number=f'DQ{i:06}') for i in range(3))
+    people = parse_people(instances)
+
+    assert next(people).dq_number == 'DQ000000'
+    assert [p.dq_number for p in people] == ['DQ000001', 'DQ000002']
+
+# search_directory tests
+
+
+def test_search_directory_dq_number():
+    db_session = MagicMock()
+    db_session.query.return_value.filter.return_value.limit.return_value.all.return_value = [make_employee()]
+
+    assert search_directory(db_session, get_dq_number_search('DQ123456', USER)) == [PERSON]
+    db_session.query.return_value.filter.return_value.limit.assert_called_once_with(1)
+
+
+def test_dq_number_search_is_stripped():
+    db_session = MagicMock()
+    db_session.query.return_value.filter.return_value.limit.return_value.all.return_value = [make_employee()]
+    query = get_dq_number_search(' DQ123456\n', USER)
+
+    assert query.values == ['DQ123456'] and b'"DQ123456"' in query.body
+    assert search_directory(db_session, query) == [PERSON]
+    assert db_session.query.return_value.filter.call_args.args[0].right.value == 'DQ123456'
+    assert get_cache_key(query) == get_cache_key(get_dq_number_search('DQ123456', USER))
+
+
+def test_search_directory_cpr_is_hashed():
+    db_session = MagicMock()
+    db_session.query.return_value.filter.return_value.limit.return_value.all.return_value = [make_employee()]
+
+    assert search_directory(db_session, get_cpr_search('0101011234', USER, True)) == [PERSON]
+    criteria = db_session.query.return_value.filter.call_args.args[0]
+    assert criteria.right.value == hash_cpr('0101011234')
+
+
+def test_search_directory_database_error():
+    db_session = MagicMock()
+    db_session.query.side_effect = OperationalError('SELECT', {}, Exception('connection refused'))
+
+    assert search_directory(db_session, get_dq_number_search('DQ123456', USER)) is None
+    db_session.rollback.assert_called_once()
+
+# search tests
+
+
+@patch('delta.delta_client')
+def test_search_directory_hit(mock_client):
+    db_session = MagicMock()
+    db_session.query.return_value.filter.return_value.limit.return_value.all.return_value = [make_employee()]
+
+    assert search(get_dq_number_search('DQ123456', USER), USER, db_session) == [PERSON]
+    mock_client.make_request.assert_not_called()
+
+
+@patch('delta.delta_client')
+def test_search_directory_miss(mock_client):
+    db_session = MagicMock()
+    db_session.query.return_value.filter.return_value.limit.return_value.all.return_value = []
+    mock_client.make_request.return_value = {'graphQueryResult': [{'instances': [make_instance()]}]}
+
+    assert search(get_dq_number_search('DQ123456', USER), USER, db_session) == [PERSON]
+    mock_client.make_request.assert_called_once()
+
+
+@patch('delta.delta_client')
+def test_search_no_instances(mock_client):
+    mock_client.make_request.return_value = {'graphQueryResult': [{'instances': []}]}
+
+    assert search(get_dq_number_search('DQ123456', USER), USER) is None
+
+# search_batch tests
+
+
+def test_get_cpr_batch_search_chunks_and_logs(mock_audit_log):
+    cpr_list = [f'01010112{i:02}' for i in range(5)]
+
+    queries = get_cpr_batch_search(cpr_list, USER, True, chunk_size=2)
+    assert len(queries) == 3
+    mock_audit_log.log_many.assert_called_once()
+    assert len(mock_audit_log.log_many.call_args.args[0]) == 5
+    assert mock_audit_log.log_many.call_args.args[0][0] == (USER['username'], USER['email'], 'cpr_batch', hash_cpr(cpr_list[0]))
+
+    query = queries[0].to_dict()['graphQueries'][0]
+    criteria = query['graphQuery']['criteria']['criteria'][0]
+    assert criteria['type'] == 'OR'
+    assert [c['right']['value'] for c in criteria['criteria']] == cpr_list[:2]
+    assert query['limit'] > 2
+
+
+def test_get_cpr_batch_search_no_rights():
+    assert get_cpr_batch_search(['0101011234'], USER, False) is None
+
+
+@patch('delta.delta_client')
+def test_search_batch_keeps_order(mock_client):
+    mock_client.make_request.return_value = {'graphQueryResult': [{'instances': [
+        make_instance(email='b@randers.dk', cpr='0202021234', uuid='b'),
+        make_instance(email='a@randers.dk', cpr='0101011234', uuid='a')
+    ]}]}
+
+    queries = get_cpr_batch_search(['0101011234', '0303031234', '0202021234', '0101011234'], USER, True)
+    result = search_batch(queries, USER)
+
+    mock_client.make_request.assert_called_once()
+    assert get_emails(result) == ['a@randers.dk', 'IKKE_FUNDET', 'b@randers.dk', 'a@randers.dk']
+
+
+@patch('delta.delta_client')
+def test_search_batch_directory_first(mock_client):
+    db_session = MagicMock()
+    employee = make_employee(email='a@randers.dk')
+    employee.cpr_hash = hash_cpr('0101011234')
+    db_session.query.return_value.filter.return_value.all.return_value = [employee]
+    mock_client.make_request.return_value = {'graphQueryResult': [{'instances': [make_instance(email='b@randers.dk', cpr='0202021234')]}]}
+
+    queries = get_cpr_batch_search(['0101011234', '0202021234'], USER, True)
+    result = search_batch(queries, USER, db_session)
+
+    assert get_emails(result) == ['a@randers.dk', 'b@randers.dk']
+    assert sent_values(mock_client) == ['0202021234']
+
+# run_concurrent tests
+
+
+def test_run_concurrent_keeps_order_and_bounds_workers():
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def function(item):
+        with lock:
+            running.append(item)
+            peak.append(len(running))
+        time.sleep(0.01 * (5 - item % 5))
+        with lock:
+            running.remove(item)
+        return item * 2
+
+    assert run_concurrent(function, list(range(20)), max_workers=4) == [i * 2 for i in range(20)]
+    assert max(peak) <= 4
+
+
+def test_run_concurrent_raises():
+    def function(item):
+        if item == 3:
+            raise ValueError('Intet svar fra Delta')
+        return item
+
+    with pytest.raises(ValueError):
+        run_concurrent(function, list(range(10)), max_workers=4)
+
+
+@patch('delta.delta_client')
+def test_search_concurrent_uses_session_per_search(mock_client):
+    mock_client.make_request.side_effect = lambda **kwargs: {'graphQueryResult': [{'instances': [make_instance(dq_number=json.loads(kwargs['data'])['graphQueries'][0]['graphQuery']['criteria']['criteria'][0]['right']['value'])]}]}
+    session_factory = MagicMock()
+    session_factory.return_value.__enter__.return_value.query.return_value.filter.return_value.limit.return_value.all.return_value = []
+
+    dq_numbers = [f'DQ{i:06}' for i in range(10)]
+    result = search_concurrent([get_dq_number_search(dq, USER) for dq in dq_numbers], USER, session_factory, max_workers=4, timeout=1)
+
+    assert [r[0].dq_number for r in result] == dq_numbers
+    assert session_factory.call_count == 10
+    assert all(c.kwargs['timeout'] == 1 for c in mock_client.make_request.call_args_list)
+
+# search cache tests
+
+
+@patch('delta.delta_client')
+def test_search_cached(mock_client):
+    mock_client.make_request.return_value = {'graphQueryResult': [{'instances': [make_instance()]}]}
+
+    assert search(get_dq_number_search('DQ123456', USER), USER) == [PERSON]
+    assert search(get_dq_number_search(' DQ123456 ', USER), USER) == [PERSON]
+    mock_client.make_request.assert_called_once()
+
+
+@patch('delta.delta_client')
+def test_search_reads_shared_cache_once(mock_client):
+    shared = MagicMock()
+    shared.get_or_load.return_value = [PERSON]
+
+    with patch.object(search_cache, 'shared', shared):
+        assert search(get_dq_number_search('DQ123456', USER), USER) == [PERSON]
+        assert search(get_dq_number_search('DQ123456', USER), USER) == [PERSON]
+
+    shared.get.assert_not_called()
+    shared.get_or_load.assert_called_once()
+    mock_client.make_request.assert_not_called()
+
+
+@patch('delta.delta_client')
+def test_search_cached_miss(mock_client):
+    mock_client.make_request.return_value = {'graphQueryResult': [{'instances': []}]}
+
+    assert search(get_dq_number_search('DQ000000', USER), USER) is None
+    assert search(get_dq_number_search('DQ000000', USER), USER) is None
+    mock_client.make_request.assert_called_once()
+
+
+@patch('delta.delta_client')
+def test_search_coalesces_identical_searches(mock_client):
+    started = threading.Event()
+    release = threading.Event()
+
+    def make_request(**kwargs):
+        started.set()
+        release.wait(5)
+        return {'graphQueryResult': [{'instances': [make_instance()]}]}
+
+    mock_client.make_request.side_effect = make_request
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(search(get_dq_number_search('DQ123456', USER), USER))) for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    mock_client.make_request.assert_called_once()
+    assert results == [[PERSON]] * 5
+
+
+@patch('delta.delta_client')
+def test_search_cache_has_no_raw_cpr(mock_client):
+    mock_client.make_request.return_value = {'graphQueryResult': [{'instances': [make_instance()]}]}
+
+    search(get_cpr_search('010101-1234', USER, True), USER)
+    search(get_cpr_search('0101011234', USER, True), USER)
+
+    mock_client.make_request.assert_called_once()
+    assert not any('0101011234' in key or '010101-1234' in key for key in search_cache._entries)
+
+
+@patch('delta.delta_client')
+def test_search_batch_uses_cache(mock_client):
+    mock_client.make_request.return_value = {'graphQueryResult': [{'instances': [make_instance(email='a@randers.dk', cpr='0101011234')]}]}
+    search(get_cpr_search('0101011234', USER, True), USER)
+
+    mock_client.make_request.return_value = {'graphQueryResult': [{'instances': [make_instance(email='b@randers.dk', cpr='0202021234')]}]}
+    result = search_batch(get_cpr_batch_search(['0101011234', '0202021234'], USER, True), USER)
+    assert get_emails(result) == ['a@randers.dk', 'b@randers.dk']
+
+    assert sent_values(mock_client) == ['0202021234']
+
+    result = search_batch(get_cpr_batch_search(['0202021234', '0101011234'], USER, True), USER)
+    assert get_emails(result) == ['b@randers.dk', 'a@randers.dk']
+    assert mock_client.make_request.call_count == 2
+
+# GraphQuery tests
+
+
+def test_graph_query_dq_number():
+    query = get_dq_number_search('DQ123456', USER).to_dict()['graphQueries'][0]
+
+    assert query['limit'] == 1
+    assert 'offset' not in query
+    assert query['graphQuery']['criteria']['criteria'] == [
+        {'type': 'MATCH', 'operator': 'EQUAL', 'left': {'source': 'DEFINITION', 'alias': 'employee.person.user.$userKey'}, 'right': {'source': 'STATIC', 'value': 'DQ123456'}},
+        {'type': 'MATCH', 'operator': 'EQUAL', 'left': {'source': 'DEFINITION', 'alias': 'employee.$state'}, 'right': {'source': 'STATIC', 'value': 'STATE_ACTIVE'}}
+    ]
+    assert 'identity' not in query['graphQuery']['projection']['typeRelations'][0]['projection']
+
+
+def test_graph_query_escapes_values():
+    query = GraphQuery('employee.person.user.$userKey', ['"}, {"injected": true'])
+
+    assert query.to_dict()['graphQueries'][0]['graphQuery']['criteria']['criteria'][0]['right']['value'] == '"}, {"injected": true'
+
+
+def test_graph_query_directory():
+    query = get_directory_search(offset=2000, limit=1000).to_dict()['graphQueries'][0]
+
+    assert query['offset'] == 2000
+    assert query['limit'] == 1000
+    assert len(query['graphQuery']['criteria']['criteria']) == 1
+    assert query['graphQuery']['projection']['typeRelations'][0]['projection']['identity'] is True
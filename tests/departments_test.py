@@ -0,0 +1,91 @@
+import json
+
+from unittest.mock import MagicMock, patch
+
+from departments import UnitQuery, UnitRef, build_unit_tree, fetch_units, get_unit_id, get_unit_path, get_unit_employees, UNIT_PARENT_RELATION
+from models import AdmUnit, Employee
+
+
+def make_unit_instance(uuid, name, parent=None):
+    instance = {'identity': {'uuid': uuid, 'name': name}, 'state': 'STATE_ACTIVE', 'typeRefs': []}
+    if parent:
+        instance['typeRefs'].append({'userKey': UNIT_PARENT_RELATION, 'targetObject': {'identity': {'uuid': parent}}})
+    return instance
+
+
+def test_unit_query_body():
+    body = json.loads(UnitQuery(2000, 1000).body)['graphQueries'][0]
+
+    assert (body['offset'], body['limit']) == (2000, 1000)
+    assert body['graphQuery']['structure']['userKey'] == 'APOS-Types-AdministrativeUnit'
+
+
+@patch('departments.get_instances')
+def test_fetch_units_pages(mock_get_instances):
+    mock_get_instances.side_effect = [
+        [make_unit_instance('a', 'Kommune'), make_unit_instance('b', 'Skole', 'a')],
+        [{'identity': {}}]
+    ]
+
+    units = list(fetch_units(page_size=2))
+
+    assert units == [UnitRef('a', 'Kommune', None), UnitRef('b', 'Skole', 'a')]
+    assert [call.args[0].offset for call in mock_get_instances.call_args_list] == [0, 2]
+
+
+def test_get_unit_id():
+    instance = {'typeRefs': [
+        {'userKey': 'APOS-Types-Engagement-TypeRelation-Person', 'targetObject': {}},
+        {'userKey': 'APOS-Types-Engagement-TypeRelation-AdmUnit', 'targetObject': {'identity': {'uuid': 'unit-1', 'name': 'Skole'}}}
+    ]}
+
+    assert get_unit_id(instance) == 'unit-1'
+    assert get_unit_id({}) is None
+
+
+def test_build_unit_tree_paths_and_counts():
+    units = [UnitRef('c', 'Klasse', 'b'), UnitRef('b', 'Skole', 'a'), UnitRef('a', 'Kommune', None), UnitRef('d', 'Jobcenter', 'a')]
+
+    rows = {row['id']: row for row in build_unit_tree(units, {'a': 1, 'b': 2, 'c': 3, 'd': 4, 'unknown': 5})}
+
+    assert rows['c']['path'] == 'a/b/c' and rows['c']['depth'] == 2 and rows['c']['parent_id'] == 'b'
+    assert rows['a']['parent_id'] is None and rows['a']['child_count'] == 2
+    assert [rows[id_]['total_count'] for id_ in 'abcd'] == [10, 5, 3, 4]
+    assert [rows[id_]['employee_count'] for id_ in 'abcd'] == [1, 2, 3, 4]
+
+
+def test_build_unit_tree_orphans_and_cycles():
+    units = [UnitRef('a', 'Nedlagt forælder', 'inactive'), UnitRef('b', 'B', 'c'), UnitRef('c', 'C', 'b')]
+
+    rows = {row['id']: row for row in build_unit_tree(units, {})}
+
+    assert rows['a']['parent_id'] is None
+    # The cycle is broken where it loops back, the last unit followed becomes a top level unit
+    assert (rows['b']['path'], rows['c']['path']) == ('c/b', 'c')
+
+
+def test_get_unit_path_in_order():
+    db_session = MagicMock()
+    db_session.get.return_value = AdmUnit(id='c', path='a/b/c')
+    db_session.scalars.return_value = [AdmUnit(id='c'), AdmUnit(id='a'), AdmUnit(id='b')]
+
+    assert [unit.id for unit in get_unit_path(db_session, 'c')] == ['a', 'b', 'c']
+
+
+def test_get_unit_employees_pages():
+    db_session = MagicMock()
+    db_session.scalars.return_value = [
+        Employee(id=str(i), name=f'Medarbejder {i}', email='-', phone='-', mobile='-', department='Skole', dq_number='-') for i in range(3)
+    ]
+
+    people, cursor = get_unit_employees(db_session, 'b', limit=2)
+
+    assert [p.name for p in people] == ['Medarbejder 0', 'Medarbejder 1']
+    assert cursor == ('Medarbejder 1', '1')
+
+    db_session.scalars.return_value = db_session.scalars.return_value[2:]
+    people, cursor = get_unit_employees(db_session, 'b', after=cursor, limit=2)
+
+    assert [p.name for p in people] == ['Medarbejder 2'] and cursor is None
+    stmt = str(db_session.scalars.call_args.args[0])
+    assert 'employee.id) > (:param_1, :param_2) ORDER BY' in stmt
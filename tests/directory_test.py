@@ -0,0 +1,164 @@
+import pytest
+
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.dml import Insert, Delete
+
+from directory import fetch_directory, sync_directory, refresh_search_index, _get_employee_row, _get_person_tokens
+from models import Employee
+from utils.search_index import SearchIndex
+from utils.utils import hash_cpr
+
+
+def make_instance(uuid, name='Test Testesen', email='test@randers.dk', cpr='0101011234', unit_id='unit-uuid'):
+    return {
+        'identity': {'uuid': uuid},
+        'attributes': [{'userKey': 'APOS-Types-Engagement-Attribute-Email', 'value': email}],
+        'typeRefs': [
+            {'userKey': 'APOS-Types-Engagement-TypeRelation-AdmUnit', 'targetObject': {'identity': {'uuid': unit_id, 'name': 'Digitalisering'}}},
+            {'userKey': 'APOS-Types-Engagement-TypeRelation-Person', 'targetObject': {
+                'identity': {'userKey': cpr},
+                'attributes': [{'userKey': 'APOS-Types-Person-Attribute-SurnameAndName', 'value': name}],
+                'inTypeRefs': [{'targetObject': {'identity': {'name': 'DQ123456'}}}]
+            }}
+        ]
+    }
+
+
+def make_session(existing=(), locked=True, age=None):
+    db_session = MagicMock()
+    db_session.__enter__.return_value = db_session
+    db_session.execute.return_value.scalar.side_effect = [locked, age]
+    db_session.execute.return_value.all.return_value = list(existing)
+    return db_session
+
+
+def statements(db_session, kind):
+    return [call.args[0] for call in db_session.execute.call_args_list if isinstance(call.args[0], kind)]
+
+
+@pytest.fixture
+def mock_sync_units():
+    with patch('directory.sync_units', return_value=3) as mock_sync_units:
+        yield mock_sync_units
+
+
+def test_employee_row():
+    row = _get_employee_row(make_instance('a'))
+
+    assert row['id'] == 'a' and row['name'] == 'Test Testesen' and row['unit_id'] == 'unit-uuid' and row['dq_number'] == 'DQ123456'
+    assert row['cpr_hash'] == hash_cpr('0101011234') and '0101011234' not in row.values()
+    assert row['row_hash'] == _get_employee_row(make_instance('a'))['row_hash'] != _get_employee_row(make_instance('a', email='new@randers.dk'))['row_hash']
+
+
+def test_employee_row_without_identity_or_person():
+    assert _get_employee_row(make_instance(None)) is None
+    assert _get_employee_row(make_instance('a', cpr=None)) is None
+
+
+@patch('directory.get_instances')
+def test_fetch_directory_pages(mock_get_instances):
+    mock_get_instances.side_effect = [[make_instance('a'), make_instance(None)], [make_instance('b')]]
+
+    assert [row['id'] for row in fetch_directory(page_size=2)] == ['a', 'b']
+    assert [call.args[0].offset for call in mock_get_instances.call_args_list] == [0, 2]
+
+
+@patch('directory.get_instances')
+def test_sync_skipped_while_other_replica_syncs(mock_get_instances, mock_sync_units):
+    db_session = make_session(locked=False)
+
+    with patch('directory.get_session', return_value=db_session):
+        assert sync_directory() is None
+
+    mock_get_instances.assert_not_called()
+    mock_sync_units.assert_not_called()
+    db_session.commit.assert_not_called()
+
+
+@patch('directory.get_instances')
+def test_sync_skipped_when_synced_recently(mock_get_instances, mock_sync_units):
+    db_session = make_session(age=60)
+
+    with patch('directory.get_session', return_value=db_session):
+        assert sync_directory(min_age=900) is None
+
+    mock_get_instances.assert_not_called()
+    db_session.commit.assert_not_called()
+
+
+@patch('directory.get_instances')
+def test_sync_writes_changed_and_deletes_departed(mock_get_instances, mock_sync_units):
+    unchanged = _get_employee_row(make_instance('unchanged'))
+    existing = [('unchanged', unchanged['row_hash']), ('changed', 'old-hash'), ('departed', 'hash')]
+    mock_get_instances.return_value = [make_instance('unchanged'), make_instance('changed', name='Nyt Navn'), make_instance('new')]
+    db_session = make_session(existing, age=3600)
+    mock_sync_units.side_effect = lambda session: db_session.commit.assert_not_called() or 3  # in the same transaction as the employees
+
+    with patch('directory.get_session', return_value=db_session):
+        assert sync_directory(min_age=900) == (2, 1)
+
+    insert, = statements(db_session, Insert)
+    params = insert.compile(dialect=postgresql.dialect()).params
+    assert sorted(value for key, value in params.items() if key.startswith('id_m')) == ['changed', 'new']
+    assert 'unchanged' not in params.values() and 'Nyt Navn' in params.values()
+
+    delete, = statements(db_session, Delete)
+    assert delete.table.name == Employee.__tablename__
+    assert delete.compile(dialect=postgresql.dialect()).params['id_1'] == ['departed']
+
+    mock_sync_units.assert_called_once_with(db_session)
+    db_session.commit.assert_called_once()
+
+
+@patch('directory.get_instances')
+def test_sync_without_changes_writes_nothing(mock_get_instances, mock_sync_units):
+    row = _get_employee_row(make_instance('a'))
+    mock_get_instances.return_value = [make_instance('a')]
+    db_session = make_session([('a', row['row_hash'])])
+
+    with patch('directory.get_session', return_value=db_session):
+        assert sync_directory() == (0, 0)
+
+    assert statements(db_session, Insert) == [] and statements(db_session, Delete) == []
+    db_session.commit.assert_called_once()
+
+
+@patch('directory.get_instances')
+def test_sync_keeps_directory_when_delta_returns_nothing(mock_get_instances, mock_sync_units):
+    mock_get_instances.return_value = []
+    db_session = make_session([('a', 'hash'), ('b', 'hash')])
+
+    with patch('directory.get_session', return_value=db_session):
+        assert sync_directory() == (0, 0)
+
+    assert statements(db_session, Delete) == []
+
+
+def make_employee(id_, row_hash, name='Test Testesen'):
+    return Employee(id=id_, name=name, email='-', phone='-', mobile='-', department='Digitalisering', dq_number='DQ123456', row_hash=row_hash)
+
+
+def test_refresh_search_index_incremental():
+    index = SearchIndex(_get_person_tokens)
+    db_session = MagicMock()
+    db_session.__enter__.return_value = db_session
+
+    with patch('directory.get_session', return_value=db_session):
+        db_session.execute.return_value.all.return_value = [('a', '1'), ('b', '1')]
+        db_session.scalars.return_value = [make_employee('a', '1', 'Jens Hansen'), make_employee('b', '1', 'Mette Jørgensen')]
+        assert refresh_search_index(index) == (2, 0)
+        assert [person.name for person in index.search('jens')] == ['Jens Hansen']
+
+        # only the changed employee is read, the departed one is removed
+        db_session.execute.return_value.all.return_value = [('a', '2')]
+        db_session.scalars.return_value = [make_employee('a', '2', 'Jens Møller')]
+        assert refresh_search_index(index) == (1, 1)
+        assert db_session.scalars.call_args.args[0].compile(dialect=postgresql.dialect()).params['id_1'] == ['a']
+        assert [person.name for person in index.search('jens')] == ['Jens Møller']
+        assert index.search('mette') == []
+
+        db_session.scalars.reset_mock()
+        assert refresh_search_index(index) == (0, 0)
+        db_session.scalars.assert_not_called()
@@ -0,0 +1,139 @@
+import time
+import pytest
+import threading
+
+from unittest.mock import MagicMock, patch
+
+from flask import Flask
+
+from health import HealthCheck, monitoring, probe_token, probe_delta
+
+
+def test_check_ok_with_latency():
+    health_check = HealthCheck({'a': lambda: {'detail': 1}, 'b': lambda: None})
+
+    result = health_check.check()
+
+    assert result['status'] == 'ok'
+    assert result['cached'] is False
+    assert result['checks']['a']['status'] == 'ok'
+    assert result['checks']['a']['detail'] == 1
+    assert result['checks']['b']['latency_ms'] >= 0
+
+
+def test_check_fails_if_one_probe_fails():
+    def failing():
+        raise ConnectionError('connection refused')
+
+    result = HealthCheck({'a': lambda: None, 'b': failing}).check()
+
+    assert result['status'] == 'fail'
+    assert result['checks']['a']['status'] == 'ok'
+    assert result['checks']['b'] | {'latency_ms': 0} == {'status': 'fail', 'error': 'ConnectionError: connection refused', 'latency_ms': 0}
+
+
+def test_check_degraded_if_optional_probe_fails():
+    def failing():
+        raise ConnectionError('connection refused')
+
+    result = HealthCheck({'database': lambda: None, 'delta': failing}, required={'database'}).check()
+
+    assert result['status'] == 'degraded'
+    assert result['checks']['delta']['status'] == 'fail'
+
+
+def test_check_probe_timeout():
+    blocked = threading.Event()
+    health_check = HealthCheck({'a': lambda: None, 'b': lambda: blocked.wait(10) and None}, cache_seconds=0, timeout=0.05)
+
+    start = time.monotonic()
+    result = health_check.check()
+
+    assert time.monotonic() - start < 1
+    assert result['status'] == 'fail'
+    assert result['checks']['a']['status'] == 'ok'
+    assert result['checks']['b']['error'] == 'Timed out after 0.05 seconds'
+
+    # the hanging probe is not started again
+    running = health_check._running['b']
+    health_check.check()
+    assert health_check._running['b'] is running
+    blocked.set()
+
+
+def test_check_is_cached():
+    probe = MagicMock(return_value=None)
+    health_check = HealthCheck({'a': probe}, cache_seconds=60)
+
+    health_check.check()
+    result = health_check.check()
+
+    assert result['cached'] is True
+    probe.assert_called_once()
+
+
+def test_check_cache_expires():
+    probe = MagicMock(return_value=None)
+    health_check = HealthCheck({'a': probe}, cache_seconds=0)
+
+    health_check.check()
+    health_check.check()
+
+    assert probe.call_count == 2
+
+
+def test_check_runs_probes_once_for_concurrent_callers():
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.05)
+
+    health_check = HealthCheck({'a': slow}, cache_seconds=60)
+    threads = [threading.Thread(target=health_check.check) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+
+
+@patch('health.delta_client')
+def test_probe_token(mock_client):
+    mock_client.token_expiry = time.time() + 100
+
+    assert 99 <= probe_token()['expires_in'] <= 100
+    mock_client._authenticate.assert_called_once()
+
+
+@patch('health.delta_client')
+def test_probe_delta(mock_client):
+    mock_client.session.get.return_value.status_code = 404
+    assert probe_delta() == {'http_status': 404}
+
+    mock_client.session.get.return_value.status_code = 503
+    with pytest.raises(ConnectionError):
+        probe_delta()
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(monitoring)
+    return app.test_client()
+
+
+def test_liveness(client):
+    assert client.get('/healthz').json == {'status': 'ok'}
+
+
+@pytest.mark.parametrize('status, code', [('ok', 200), ('degraded', 200), ('fail', 503)])
+def test_readiness(client, status, code):
+    with patch('health.health_check') as mock_health_check:
+        mock_health_check.check.return_value = {'status': status, 'checks': {}}
+
+        response = client.get('/readyz')
+
+    assert response.status_code == code
+    assert response.json['status'] == status
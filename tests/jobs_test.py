@@ -0,0 +1,206 @@
+import pytest
+
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy.dialects import postgresql
+
+from jobs import submit_job, claim_chunk, complete_chunk, fail_chunk, process_next_chunk, iter_job_results, get_recent_results, QUEUED, DONE
+from models import BulkJob, BulkJobChunk
+
+
+USER = {'username': 'test_user', 'email': 'test@test.dk'}
+
+
+@pytest.fixture(autouse=True)
+def mock_log():
+    with patch('jobs.log_cpr_batch_search') as mock_log:
+        yield mock_log
+
+
+@pytest.fixture(autouse=True)
+def mock_rate_limiter():
+    with patch('jobs.chunk_rate_limiter') as mock_rate_limiter:
+        yield mock_rate_limiter
+
+
+def make_chunk(**kwargs):
+    return BulkJobChunk(**({'job_id': 1, 'chunk_index': 0, 'rows': [[1, '0101011234']], 'attempts': 1} | kwargs))
+
+
+def test_submit_job_stores_chunks():
+    db_session = MagicMock()
+    rows = [(i, f'{i:010}') for i in range(1, 8)]
+
+    submit_job(db_session, rows, USER, 'cpr.csv', chunk_size=3)
+
+    job = db_session.add.call_args_list[0].args[0]
+    chunks = db_session.add_all.call_args.args[0]
+    assert [chunk.chunk_index for chunk in chunks] == [0, 1, 2]
+    assert chunks[2].rows == [(7, '0000000007')]
+    assert (job.total_rows, job.chunk_count, job.status, job.username) == (7, 3, QUEUED, 'test_user')
+    db_session.commit.assert_called_once()
+
+
+def test_submit_empty_job_is_done():
+    db_session = MagicMock()
+
+    submit_job(db_session, [], USER, 'cpr.csv')
+
+    job = db_session.add.call_args_list[0].args[0]
+    assert job.status == DONE and job.finished_at
+    db_session.add_all.assert_not_called()
+
+
+def test_claim_chunk_skips_locked_chunks():
+    db_session = MagicMock()
+    chunk = make_chunk(attempts=0)
+    db_session.scalars.return_value.first.return_value = chunk
+
+    assert claim_chunk(db_session, 'pod-0') is chunk
+
+    stmt = str(db_session.scalars.call_args.args[0].compile(dialect=postgresql.dialect()))
+    assert 'FOR UPDATE OF bulk_job_chunk SKIP LOCKED' in stmt
+    assert 'NULLS FIRST' in stmt  # jobs that have waited longest are served first
+    assert (chunk.claimed_by, chunk.attempts) == ('pod-0', 1)
+    db_session.commit.assert_called_once()
+
+
+def test_claim_chunk_nothing_to_do():
+    db_session = MagicMock()
+    db_session.scalars.return_value.first.return_value = None
+
+    assert claim_chunk(db_session) is None
+    db_session.rollback.assert_called_once()
+    db_session.commit.assert_not_called()
+
+
+def test_complete_chunk_counts_once():
+    db_session = MagicMock()
+    db_session.execute.return_value.rowcount = 0  # already completed by another worker
+
+    assert not complete_chunk(db_session, make_chunk(), [{'række': 1, 'cpr': '0101011234', 'email': 'a@test.dk'}])
+
+    assert db_session.execute.call_count == 1
+    db_session.commit.assert_called_once()
+
+
+def test_complete_chunk_removes_cpr_numbers():
+    db_session = MagicMock()
+    db_session.execute.return_value.rowcount = 1
+
+    assert complete_chunk(db_session, make_chunk(), [{'række': 1, 'cpr': '0101011234', 'email': 'a@test.dk'}])
+
+    assert db_session.execute.call_args_list[0].args[0].compile().params['rows'] == []
+
+
+def test_fail_chunk_fails_job_after_max_attempts():
+    db_session = MagicMock()
+
+    fail_chunk(db_session, make_chunk(attempts=1), ValueError('Delta'), max_attempts=3)
+    assert db_session.execute.call_count == 1
+
+    db_session.reset_mock()
+    fail_chunk(db_session, make_chunk(attempts=3), ValueError('Delta'), max_attempts=3)
+    assert db_session.execute.call_count == 3
+    assert db_session.execute.call_args_list[1].args[0].compile().params['rows'] == []
+    assert 'ValueError: Delta' in str(db_session.execute.call_args.args[0].compile().params)
+
+
+@patch('jobs.complete_chunk')
+@patch('jobs.lookup_rows')
+@patch('jobs.claim_chunk')
+def test_process_next_chunk(mock_claim_chunk, mock_lookup_rows, mock_complete_chunk, mock_rate_limiter, mock_log):
+    chunk = make_chunk()
+    mock_claim_chunk.return_value = chunk
+    session_factory = MagicMock()
+    session_factory.return_value.__enter__.return_value.get.return_value = BulkJob(**USER)
+    results = [{'række': 1, 'cpr': '0101011234', 'email': 'a@test.dk'}]
+    mock_lookup_rows.return_value = iter([results])
+
+    assert process_next_chunk(session_factory, 'pod-0')
+
+    assert mock_lookup_rows.call_args.args[:2] == ([(1, '0101011234')], USER)
+    assert mock_lookup_rows.call_args.kwargs['log'] is False
+    assert mock_complete_chunk.call_args.args[1:] == (chunk, results)
+    mock_rate_limiter.acquire.assert_called_once()
+    mock_log.assert_called_once_with(['0101011234'], USER)
+
+
+@patch('jobs.complete_chunk', return_value=False)
+@patch('jobs.lookup_rows')
+@patch('jobs.claim_chunk')
+def test_process_next_chunk_completed_by_other_worker(mock_claim_chunk, mock_lookup_rows, mock_complete_chunk, mock_log):
+    mock_claim_chunk.return_value = make_chunk()
+    session_factory = MagicMock()
+    session_factory.return_value.__enter__.return_value.get.return_value = BulkJob(**USER)
+    mock_lookup_rows.return_value = iter([[{'række': 1, 'cpr': '0101011234', 'email': 'a@test.dk'}]])
+
+    assert process_next_chunk(session_factory)
+
+    mock_log.assert_not_called()  # logged by the worker that completed it
+
+
+@patch('jobs.chunk_rate_limiter', None)
+@patch('jobs.complete_chunk')
+@patch('jobs.lookup_rows')
+@patch('jobs.claim_chunk')
+def test_process_next_chunk_without_rate_limit(mock_claim_chunk, mock_lookup_rows, mock_complete_chunk):
+    mock_claim_chunk.return_value = make_chunk()
+    session_factory = MagicMock()
+    session_factory.return_value.__enter__.return_value.get.return_value = BulkJob(**USER)
+    mock_lookup_rows.return_value = iter([[{'række': 1, 'cpr': '0101011234', 'email': 'a@test.dk'}]])
+
+    assert process_next_chunk(session_factory)
+
+    mock_complete_chunk.assert_called_once()
+
+
+@patch('jobs.fail_chunk')
+@patch('jobs.complete_chunk')
+@patch('jobs.lookup_rows')
+@patch('jobs.claim_chunk')
+def test_process_next_chunk_failure(mock_claim_chunk, mock_lookup_rows, mock_complete_chunk, mock_fail_chunk, mock_log):
+    mock_claim_chunk.return_value = make_chunk()
+    session_factory = MagicMock()
+    session_factory.return_value.__enter__.return_value.get.return_value = BulkJob(**USER)
+    mock_lookup_rows.side_effect = ValueError('Delta')
+
+    assert process_next_chunk(session_factory)
+
+    mock_complete_chunk.assert_not_called()
+    mock_log.assert_not_called()
+    assert isinstance(mock_fail_chunk.call_args.args[2], ValueError)
+
+
+@patch('jobs.claim_chunk', return_value=None)
+def test_process_next_chunk_nothing_to_do(mock_claim_chunk):
+    assert not process_next_chunk(MagicMock())
+
+
+def test_iter_job_results_in_order():
+    db_session = MagicMock()
+    db_session.get.return_value = BulkJob(id=1, **USER)
+    chunks = [make_chunk(chunk_index=0, results=[{'række': 1}]), make_chunk(chunk_index=1, results=[{'række': 2}]), None]
+    db_session.scalars.return_value.first.side_effect = chunks
+
+    assert list(iter_job_results(db_session, 1, 'test_user')) == [[{'række': 1}], [{'række': 2}]]
+
+
+def test_recent_results_newest_last():
+    db_session = MagicMock()
+    db_session.scalars.return_value.all.return_value = [[{'række': 5}, {'række': 6}], [{'række': 1}, {'række': 2}, {'række': 3}]]  # finished last first
+
+    assert get_recent_results(db_session, 1, 'test_user', limit=4, chunk_size=3) == [{'række': 2}, {'række': 3}, {'række': 5}, {'række': 6}]
+
+    stmt = db_session.scalars.call_args.args[0]
+    params = stmt.compile(dialect=postgresql.dialect()).params
+    assert 'test_user' in params.values() and params['param_1'] == 2  # two chunks of three rows hold the newest four rows
+    assert 'ORDER BY telefonbog.bulk_job_chunk.done_at DESC' in str(stmt.compile(dialect=postgresql.dialect()))
+
+
+def test_iter_job_results_other_user():
+    db_session = MagicMock()
+    db_session.get.return_value = BulkJob(id=1, **USER)
+
+    assert list(iter_job_results(db_session, 1, 'other_user')) == []
+    db_session.scalars.assert_not_called()
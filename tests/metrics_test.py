@@ -0,0 +1,68 @@
+from unittest.mock import MagicMock, patch
+
+from prometheus_client import CollectorRegistry, REGISTRY
+
+from utils.api_requests import APIClient
+from utils.cache import TTLCache
+from utils.metrics import CacheCollector, PoolCollector
+
+
+def sample(name, labels=None):
+    return REGISTRY.get_sample_value(name, labels or {}) or 0
+
+
+@patch('requests.Session.get')
+def test_make_request_latency_by_path_and_status(mock_get):
+    mock_get.return_value = MagicMock(status_code=404, headers={})
+    mock_get.return_value.raise_for_status.side_effect = Exception('404 Not Found')
+    labels = {'path': 'metrics/test', 'status': '404'}
+    before = sample('telefonbog_api_request_seconds_count', labels)
+
+    APIClient(base_url='https://example.com').make_request(path='/metrics/test')
+
+    assert sample('telefonbog_api_request_seconds_count', labels) == before + 1
+
+
+@patch('requests.Session.get')
+def test_make_request_latency_on_connection_error(mock_get):
+    mock_get.side_effect = ConnectionError('connection refused')
+    labels = {'path': 'metrics/error', 'status': 'error'}
+    before = sample('telefonbog_api_request_seconds_count', labels)
+
+    assert APIClient(base_url='https://example.com').make_request(path='metrics/error') is None
+    assert sample('telefonbog_api_request_seconds_count', labels) == before + 1
+
+
+@patch('requests.Session.post')
+def test_token_fetch_latency(mock_post):
+    mock_post.return_value.status_code = 200
+    mock_post.return_value.json.return_value = {'access_token': 'token', 'expires_in': 300}
+    labels = {'grant_type': 'client_credentials'}
+    before = sample('telefonbog_token_fetch_seconds_count', labels)
+
+    APIClient(base_url='https://example.com', realm='test', client_id='id', client_secret='secret')._authenticate()
+
+    assert sample('telefonbog_token_fetch_seconds_count', labels) == before + 1
+
+
+def test_cache_collector():
+    registry = CollectorRegistry()
+    cache = TTLCache()
+    registry.register(CacheCollector('test', cache))
+
+    cache.set('key', 'value')
+    cache.get('key')
+    cache.get('other')
+
+    assert registry.get_sample_value('telefonbog_cache_hits_total', {'cache': 'test'}) == 1
+    assert registry.get_sample_value('telefonbog_cache_misses_total', {'cache': 'test'}) == 1
+    assert registry.get_sample_value('telefonbog_cache_entries', {'cache': 'test'}) == 1
+
+
+def test_pool_collector():
+    registry = CollectorRegistry()
+    registry.register(PoolCollector(lambda: {'size': 10, 'checked_out': 3, 'checked_in': 7, 'overflow': 0, 'checkouts': 42, 'timeouts': 1, 'invalidations': 2, 'wait_seconds_total': 0.5}))
+
+    assert registry.get_sample_value('telefonbog_db_pool_checked_out') == 3
+    assert registry.get_sample_value('telefonbog_db_pool_checkouts_total') == 42
+    assert registry.get_sample_value('telefonbog_db_pool_wait_seconds_total') == 0.5
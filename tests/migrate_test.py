@@ -0,0 +1,62 @@
+from unittest.mock import MagicMock, patch
+
+from migrate import migrate, get_schema_fingerprint, get_schema_version
+
+
+def make_session(version):
+    db_session = MagicMock()
+    db_session.__enter__.return_value = db_session
+    db_session.execute.return_value.scalar.return_value = 'telefonbog.schema_version'
+    db_session.scalars.return_value.first.return_value = version
+    return db_session
+
+
+def test_fingerprint_follows_models_and_version():
+    fingerprint = get_schema_fingerprint()
+
+    assert fingerprint == get_schema_fingerprint() and len(fingerprint) == 16
+    with patch('migrate.MIGRATION_VERSION', 2):
+        assert get_schema_fingerprint() != fingerprint
+
+
+def test_schema_version_before_first_migration():
+    db_session = make_session(None)
+    db_session.execute.return_value.scalar.return_value = None
+
+    assert get_schema_version(db_session) is None
+    db_session.scalars.assert_not_called()
+
+
+@patch('migrate.run_migrations')
+def test_migrate_skipped_when_current(mock_run):
+    db_session = make_session(get_schema_fingerprint())
+
+    with patch('database.get_session', return_value=db_session):
+        assert migrate() is False
+
+    mock_run.assert_not_called()
+    db_session.commit.assert_not_called()
+
+
+@patch('migrate.run_migrations')
+def test_migrate_runs_and_records_version(mock_run):
+    db_session = make_session('0000000000000000')
+
+    with patch('database.get_session', return_value=db_session):
+        assert migrate() is True
+
+    mock_run.assert_called_once()
+    assert 'pg_advisory_xact_lock' in str(db_session.execute.call_args_list[1].args[0])
+    assert db_session.execute.call_args.args[0].compile().params['version'] == get_schema_fingerprint()
+    db_session.commit.assert_called_once()
+
+
+@patch('migrate.run_migrations')
+def test_migrate_skipped_after_other_replica_migrated(mock_run):
+    db_session = make_session(None)
+    db_session.scalars.return_value.first.side_effect = ['0000000000000000', get_schema_fingerprint()]
+
+    with patch('database.get_session', return_value=db_session):
+        assert migrate() is False
+
+    mock_run.assert_not_called()
@@ -0,0 +1,61 @@
+import pytest
+
+from unittest.mock import MagicMock
+
+from delta import Person, GraphQuery, CPR_ALIAS, DQ_ALIAS
+from result_view import create_result_store, get_query_key, get_free_text_key, get_result_view, render_cards
+
+
+def test_query_key():
+    assert get_query_key(GraphQuery(DQ_ALIAS, ['DQ123456'])) == 'dq:DQ123456:1'
+    assert '0101901234' not in get_query_key(GraphQuery(CPR_ALIAS, ['0101901234']))
+    assert get_query_key(GraphQuery(CPR_ALIAS, ['0101901234'])) == get_query_key(GraphQuery(CPR_ALIAS, ['0101901234']))
+    assert get_query_key(GraphQuery(CPR_ALIAS, ['0101901234', '0202901234'])).startswith('query:')
+
+
+def test_free_text_key():
+    assert get_free_text_key(' Jens  Hansen', 1) == get_free_text_key('jens hansen', 1)
+    assert get_free_text_key('jens', 1) != get_free_text_key('jens', 2)
+
+
+def test_render_cards():
+    person = Person(name='Jens Hansen', email='jens@randers.dk', department='Digitalisering', dq_number='DQ123456')
+    card, = render_cards([person])
+
+    assert card.title == 'Jens Hansen' and card.expanded
+    assert card.markdown[0] == '| Navn | DQ-nummer | Afdeling |\n| --- | --- | --- |\n| Jens Hansen | DQ123456 | Digitalisering |'
+    assert card.markdown[1] == '| E-mail | Telefon | Mobil |\n| --- | --- | --- |\n| jens@randers.dk | - | - |'
+    assert [card.expanded for card in render_cards([person, Person(name='Mette')])] == [False, False]
+    assert render_cards(None) == [] and render_cards([]) == []
+
+
+def test_result_view_stored():
+    store = create_result_store()
+    search = MagicMock(return_value=[Person(name='Jens Hansen')])
+
+    view = get_result_view(store, 'dq:DQ123456:1', search)
+    assert get_result_view(store, 'dq:DQ123456:1', search) is view
+    assert view.people == [Person(name='Jens Hansen')] and view.cards[0].title == 'Jens Hansen'
+    search.assert_called_once()
+
+    get_result_view(store, 'dq:DQ654321:1', search)
+    assert search.call_count == 2
+
+
+def test_result_view_not_found_stored():
+    store = create_result_store()
+    search = MagicMock(return_value=None)
+
+    assert get_result_view(store, 'dq:DQ123456:1', search).cards == []
+    get_result_view(store, 'dq:DQ123456:1', search)
+    search.assert_called_once()
+
+
+def test_result_view_failure_not_stored():
+    store = create_result_store()
+    search = MagicMock(side_effect=[ConnectionError('Delta is down'), [Person(name='Jens Hansen')]])
+
+    with pytest.raises(ConnectionError):
+        get_result_view(store, 'dq:DQ123456:1', search)
+    assert get_result_view(store, 'dq:DQ123456:1', search).cards[0].title == 'Jens Hansen'
+    assert search.call_count == 2
@@ -0,0 +1,100 @@
+from delta import Person
+from utils.search_index import SearchIndex, tokenize, email_tokens, phone_tokens, edit_distance
+
+
+def get_tokens(person: Person) -> list[str]:
+    return tokenize(person.name) + tokenize(person.department) + email_tokens(person.email) + phone_tokens(person.phone)
+
+
+PEOPLE = {
+    '1': Person(name='Jens Hansen', email='jens.hansen@randers.dk', phone='+45 89 15 12 34', department='Digitalisering'),
+    '2': Person(name='Mette Jørgensen', email='mette.jorgensen@randers.dk', phone='89151235', department='Borgerservice'),
+    '3': Person(name='Hans Jensen', email='haje@randers.dk', phone='-', department='Digitalisering'),
+    '4': Person(name='Kirsten Hansen', email='kiha@randers.dk', phone='-', department='Jobcenter Randers'),
+}
+
+
+def make_index() -> SearchIndex:
+    index = SearchIndex(get_tokens, sort_key=lambda person: person.name)
+    index.update({id_: (1, person) for id_, person in PEOPLE.items()})
+    return index
+
+
+def names(people: list[Person]) -> list[str]:
+    return [person.name for person in people]
+
+
+def test_tokens():
+    assert tokenize('Jobcenter Randers (Vest)') == ['jobcenter', 'randers', 'vest']
+    assert email_tokens('Jens.Hansen@randers.dk') == ['jens.hansen@randers.dk', 'jens', 'hansen', 'randers', 'dk']
+    assert phone_tokens('+45 89 15 12 34') == ['4589151234', '89151234']
+    assert email_tokens('-') == phone_tokens('-') == []
+
+
+def test_edit_distance():
+    assert edit_distance('hansen', 'hansen', 1) == 0
+    assert edit_distance('hasnen', 'hansen', 1) == 1  # swapped characters count as one edit
+    assert edit_distance('hnsen', 'hansen', 1) == 1
+    assert edit_distance('jensen', 'hansen', 1) == 2
+
+
+def test_search_prefix_all_words():
+    index = make_index()
+
+    assert names(index.search('hans')) == ['Hans Jensen', 'Jens Hansen', 'Kirsten Hansen']  # exact word first, then by name
+    assert names(index.search('jens han')) == ['Jens Hansen', 'Hans Jensen']
+    assert names(index.search('kir hans')) == ['Kirsten Hansen']
+    assert index.search('jens mette') == []
+    assert index.search('  ') == []
+
+
+def test_search_email_phone_department():
+    index = make_index()
+
+    assert names(index.search('jens.hansen@')) == ['Jens Hansen']
+    assert names(index.search('haje')) == ['Hans Jensen']
+    assert names(index.search('8915123')) == ['Jens Hansen', 'Mette Jørgensen']
+    assert names(index.search('borgerserv')) == ['Mette Jørgensen']
+    assert names(index.search('digi hans')) == ['Hans Jensen', 'Jens Hansen']
+
+
+def test_search_typo():
+    index = make_index()
+
+    assert names(index.search('jørgnesen')) == ['Mette Jørgensen']
+    assert names(index.search('kirstne')) == ['Kirsten Hansen']
+    assert index.search('mte jørg') == []  # words shorter than min_fuzzy_length must match exactly
+    assert index.search('xyzzy') == []
+
+
+def test_search_limit():
+    index = make_index()
+
+    assert names(index.search('randers', limit=2)) == ['Hans Jensen', 'Jens Hansen']
+
+
+def test_update_incremental():
+    index = make_index()
+    assert index.versions() == {'1': 1, '2': 1, '3': 1, '4': 1}
+
+    index.update({'1': (2, Person(name='Jens Hansen Møller', email='jens.hansen@randers.dk')), '2': (1, Person(name='Ignored'))}, removed=['4', '5'])
+
+    assert index.versions() == {'1': 2, '2': 1, '3': 1}
+    assert names(index.search('møller')) == ['Jens Hansen Møller']
+    assert names(index.search('mette')) == ['Mette Jørgensen']  # same version is not reindexed
+    assert index.search('kirsten') == []
+    assert index.search('digitalisering jens hansen m') == []
+    assert 'kirsten' not in index._postings and 'kirsten' not in index._sorted_tokens
+    assert not any('kirsten' in tokens for tokens in index._trigrams.values())
+    assert len(index) == 3
+
+
+def test_update_generation():
+    index = make_index()
+    generation = index.generation
+
+    index.update({'1': (1, Person(name='Ignored'))})
+    assert index.generation == generation
+
+    index.update({}, removed=['4'])
+    assert index.generation == generation + 1
@@ -0,0 +1,166 @@
+import pytest
+
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import OperationalError
+
+from delta import Person, _dump_people, _load_people
+from shared_cache import PostgresCache, delete_expired_entries
+from utils.cache import MISSING
+
+
+def make_session():
+    db_session = MagicMock()
+    db_session.__enter__.return_value = db_session
+    return db_session
+
+
+def make_cache(db_session, secret='secret', **kwargs):
+    return PostgresCache(lambda: db_session, 'search', secret=secret, ttl=300, negative_ttl=30, **kwargs)
+
+
+def compile_stmt(stmt):
+    return stmt.compile(dialect=postgresql.dialect())
+
+
+def written_rows(db_session):
+    return compile_stmt(db_session.execute.call_args.args[0]).params
+
+
+def test_requires_secret():
+    with pytest.raises(ValueError):
+        PostgresCache(MagicMock(), 'search', secret='')
+
+
+def test_keys_hashed_and_values_encrypted():
+    db_session = make_session()
+    cache = make_cache(db_session, dumps=_dump_people, loads=_load_people)
+    people = [Person(name='Test Person', email='test@randers.dk')]
+
+    cache.set('cpr:0101011234:1', people)
+
+    params = written_rows(db_session)
+    key, value = params['key_m0'], params['value_m0']
+    assert '0101011234' not in key and len(key) == 64
+    assert b'Test Person' not in value and b'randers' not in value
+    db_session.commit.assert_called_once()
+
+    db_session.execute.return_value.all.return_value = [(key, value)]
+    assert cache.get('cpr:0101011234:1') == people
+    assert cache.stats()['hits'] == 1
+
+
+def test_value_from_other_secret_is_a_miss():
+    db_session = make_session()
+    make_cache(db_session, secret='old').set('a', [1])
+    params = written_rows(db_session)
+
+    db_session.execute.return_value.all.return_value = [(make_cache(db_session, secret='new')._hash('a'), params['value_m0'])]
+
+    assert make_cache(db_session, secret='new').get('a') is MISSING
+
+
+def test_set_many_one_statement_with_negative_ttl():
+    db_session = make_session()
+    cache = make_cache(db_session)
+
+    cache.set_many({'a': [1], 'b': None})
+
+    db_session.execute.assert_called_once()
+    stmt = str(compile_stmt(db_session.execute.call_args.args[0]))
+    assert 'ON CONFLICT (namespace, key) DO UPDATE' in stmt
+    params = written_rows(db_session)
+    assert (params['now_1'].total_seconds(), params['now_2'].total_seconds()) == (300, 30)
+
+
+def test_zero_ttl_is_not_written():
+    db_session = make_session()
+    cache = PostgresCache(lambda: db_session, 'search', secret='secret', ttl=300, negative_ttl=0)
+
+    cache.set('a', None)
+
+    db_session.execute.assert_not_called()
+
+
+def test_database_error_is_a_miss():
+    db_session = make_session()
+    db_session.execute.side_effect = OperationalError('SELECT', {}, Exception('connection refused'))
+    cache = make_cache(db_session)
+
+    assert cache.get('a') is MISSING
+    cache.set('a', [1])
+    assert cache.stats()['errors'] == 2
+
+
+def test_get_or_load_loads_with_lease():
+    db_session = make_session()
+    cache = make_cache(db_session)
+    load = MagicMock(return_value=[1])
+
+    with patch.object(cache, 'get', return_value=MISSING), patch.object(cache, '_acquire_lease', return_value=True), patch.object(cache, '_write', return_value=True) as mock_write:
+        assert cache.get_or_load('a', load) == [1]
+
+    load.assert_called_once()
+    mock_write.assert_called_once_with({'a': [1]}, None)
+
+
+@patch('shared_cache.time.sleep')
+def test_get_or_load_waits_for_other_replica(mock_sleep):
+    db_session = make_session()
+    cache = make_cache(db_session)
+    load = MagicMock()
+
+    with patch.object(cache, 'get', side_effect=[MISSING, MISSING, [1]]), patch.object(cache, '_acquire_lease', return_value=False):
+        assert cache.get_or_load('a', load) == [1]
+
+    load.assert_not_called()
+    assert cache.stats()['lease_waits'] == 2
+
+
+def test_get_or_load_releases_lease_on_error():
+    db_session = make_session()
+    cache = make_cache(db_session)
+
+    with patch.object(cache, 'get', return_value=MISSING), patch.object(cache, '_acquire_lease', return_value=True), patch.object(cache, '_release_lease') as mock_release:
+        with pytest.raises(ValueError):
+            cache.get_or_load('a', MagicMock(side_effect=ValueError('Intet svar fra Delta')))
+
+    mock_release.assert_called_once_with('a')
+
+
+@patch('shared_cache.time.sleep')
+def test_get_or_load_database_down_loads_without_waiting(mock_sleep):
+    db_session = make_session()
+    db_session.execute.side_effect = OperationalError('SELECT', {}, Exception('connection refused'))
+    cache = make_cache(db_session)
+    load = MagicMock(return_value=[1])
+
+    with patch.object(cache, '_release_lease') as mock_release:
+        assert cache.get_or_load('a', load) == [1]
+
+    load.assert_called_once()
+    mock_sleep.assert_not_called()
+    mock_release.assert_not_called()
+    assert cache.stats()['lease_waits'] == 0 and cache.stats()['errors'] == 3  # read, lease and write
+
+
+def test_lease_only_taken_when_free():
+    db_session = make_session()
+    db_session.execute.return_value.first.return_value = None
+
+    assert make_cache(db_session)._acquire_lease('a') is False
+
+    stmt = str(compile_stmt(db_session.execute.call_args.args[0]))
+    assert 'DO UPDATE SET lease_until = excluded.lease_until WHERE' in stmt
+    assert 'RETURNING' in stmt
+
+
+def test_delete_expired_entries_keeps_leases():
+    db_session = make_session()
+
+    delete_expired_entries(db_session)
+
+    stmt = str(compile_stmt(db_session.execute.call_args.args[0]))
+    assert 'expires_at < now()' in stmt and 'lease_until IS NULL' in stmt
+    db_session.commit.assert_called_once()
@@ -0,0 +1,68 @@
+import pytest
+
+from unittest.mock import patch
+
+from utils.utils import get_cpr_list, get_cpr_year, verify_cpr, hash_cpr, InvalidCpr
+
+
+def test_cpr_list_separators():
+    result = get_cpr_list('010190-1234, 0202901234;\n030390-1234\t0404901234,\r\n0505901234\n\n,')
+
+    assert result.cpr_list == ['0101901234', '0202901234', '0303901234', '0404901234', '0505901234']
+    assert result.invalid == [] and result.duplicates == 0
+
+
+def test_cpr_list_invalid_positions():
+    result = get_cpr_list('0101901234\n3102901234, 12345\n0101901234\n\nabcdefghij;3113901234')
+
+    assert result.cpr_list == ['0101901234']
+    assert result.invalid == [InvalidCpr(2, 2, '3102901234'), InvalidCpr(2, 3, '12345'), InvalidCpr(5, 5, 'abcdefghij'), InvalidCpr(5, 6, '3113901234')]
+    assert result.duplicates == 1
+
+
+def test_cpr_list_invalid_first_entry():
+    invalid, = get_cpr_list('01010112345').invalid
+
+    assert invalid == InvalidCpr(1, 1, '01010112345')
+    assert type(invalid.entry) is int
+
+
+def test_cpr_list_dedupe_keeps_order():
+    result = get_cpr_list('0303901234,0101901234,030390-1234,0202901234,0101901234')
+
+    assert result.cpr_list == ['0303901234', '0101901234', '0202901234']
+    assert result.duplicates == 2
+
+
+def test_cpr_list_leap_day():
+    assert get_cpr_list('2902004234').cpr_list == ['2902004234']  # digit 4: 2000 is a leap year
+    assert get_cpr_list('2902961234').cpr_list == ['2902961234']
+    assert [i.value for i in get_cpr_list('2902011234,2902001234').invalid] == ['2902011234', '2902001234']  # digit 1: 1900 is not
+
+
+def test_cpr_list_empty():
+    assert get_cpr_list('').cpr_list == [] and get_cpr_list(None).invalid == []
+    assert get_cpr_list(' ,\n ;').cpr_list == []
+
+
+def test_cpr_year():
+    assert get_cpr_year(90, 1) == 1990
+    assert get_cpr_year(10, 4) == 2010 and get_cpr_year(50, 4) == 1950
+    assert get_cpr_year(10, 6) == 2010 and get_cpr_year(90, 6) == 1890
+
+
+def test_verify_cpr():
+    assert verify_cpr('010190-1234') and verify_cpr('0101901234')
+    assert not verify_cpr('01019012') and not verify_cpr('010190123a')
+
+
+def test_hash_cpr():
+    cpr_hash = hash_cpr('0101901234')
+    assert hash_cpr('010190-1234') == cpr_hash != hash_cpr('0202901234')
+    with patch('utils.utils.CPR_HASH_KEY', 'other-key'):
+        assert hash_cpr('0101901234') != cpr_hash
+
+
+def test_hash_cpr_requires_key():
+    with patch('utils.utils.CPR_HASH_KEY', ''), pytest.raises(ValueError, match='CPR_HASH_KEY'):
+        hash_cpr('0101901234')